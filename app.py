@@ -1,14 +1,46 @@
 import streamlit as st
 from dotenv import load_dotenv
-import os
-import spotipy
-from spotipy.oauth2 import SpotifyOAuth
 from db import init_db
-from etl import load_top_tracks, load_recently_played
-from dashboards import top_tracks_viz, mood_profile_viz, recent_activity_viz, listening_heatmap_viz
+from etl import TIME_RANGES, sync_status
+from dashboards import (top_tracks_viz, mood_profile_viz, recent_activity_viz, listening_heatmap_viz, genres_viz,
+                        more_like_this_viz, diagnostics_panel)
+import tracing
+
+# Heavy libraries (spotipy, pandas, matplotlib) are imported by the code that
+# needs them, so the page starts drawing before they load.
 
 load_dotenv()  # Load .env file
 
+FIRST_SYNC_TIMEOUT = 60  # Seconds a brand-new user waits for their first sync
+
+
+@st.cache_resource
+def get_refresher():
+    """One background refresher per server process, shared by every session."""
+    from refresher import Refresher
+
+    return Refresher().start()
+
+
+@st.cache_resource
+def init_schema():
+    """Create or migrate the schema once per server process, not on every rerun."""
+    init_db()
+
+
+def get_auth_manager():
+    """This browser session's SpotifyOAuth; its token lives in the session, not on disk.
+
+    The token is written to the user's token file (for the refresher) only once
+    ``/v1/me`` has said whose it is.
+    """
+    from spotify_client import oauth_manager
+
+    if "auth_manager" not in st.session_state:
+        st.session_state["auth_manager"] = oauth_manager(show_dialog=True)
+    return st.session_state["auth_manager"]
+
+
 st.set_page_config(page_title="Spotify Music Insights", page_icon="🎵", layout="wide")
 
 # ---------- Minimal CSS to match the wireframe ----------
@@ -46,24 +78,18 @@ with left:
     st.caption("Read-only access. No sharing. Revoke anytime.")
     st.markdown('</div>', unsafe_allow_html=True)
     st.caption("GitHub • Docs")
+    # Timings for spans, API calls and SQL cover every session in the process, so
+    # they are only recorded and shown when the operator set SPOTIFY_INSIGHTS_TRACE=1;
+    # the checkbox just shows or hides them for this session.
+    show_diagnostics = tracing.ENABLED_BY_ENV and st.checkbox("Diagnostics", value=False)
     st.markdown('</div>', unsafe_allow_html=True)
 
 with right:
-    init_db()
-
-    client_id = os.getenv("SPOTIFY_CLIENT_ID")
-    client_secret = os.getenv("SPOTIFY_CLIENT_SECRET")
-    redirect_uri = os.getenv("SPOTIFY_REDIRECT_URI")
-    scope = "user-top-read user-read-recently-played"
-
-    auth_manager = SpotifyOAuth(
-        client_id=client_id,
-        client_secret=client_secret,
-        redirect_uri=redirect_uri,
-        scope=scope,
-        show_dialog=True
-    )
-    st.write("All query params:", st.query_params)
+    init_schema()
+    auth_manager = get_auth_manager()
+    # OAuth debugging output only with Diagnostics on; st.write of a non-string also pulls in pandas
+    if show_diagnostics:
+        st.write("All query params:", st.query_params)
     # `st.query_params.get('code')` can be either a list (Streamlit sometimes
     # provides values as lists) or a plain string depending on how the URL was
     # constructed. Guard against both cases so we don't accidentally take only
@@ -78,50 +104,83 @@ with right:
     if code == "":
         code = None
 
-    st.write("Parsed code:", code)
+    if show_diagnostics:
+        st.write("Parsed code:", code)
 
 
     try:
-        token_info = auth_manager.get_cached_token()
-        st.write("Code from URL:", code)
-        st.write("Token info from cache:", token_info)
+        with tracing.span("app.auth"):
+            token_info = auth_manager.get_cached_token()
+        if show_diagnostics:
+            st.write("Code from URL:", code)
         if not token_info:
             if code:
                 # Exchange the code for a token and cache it
-                token = auth_manager.get_access_token(code, as_dict=False)
-                sp = spotipy.Spotify(auth=token)
-                st.success("Connected to Spotify")
-                step1 = '<div class="step"><span class="step-dot done"></span> 1. Connect Spotify</div>'
-                step_container.markdown(step1 + step2 + step3, unsafe_allow_html=True)
+                with tracing.span("app.auth"):
+                    auth_manager.get_access_token(code, as_dict=False)
+                    token_info = auth_manager.get_cached_token()
             else:
                 auth_url = auth_manager.get_authorize_url()
                 st.warning("Please connect your Spotify account to continue.")
                 st.markdown(f"[Login with Spotify]({auth_url})")
                 st.stop()
-        else:
-            token = token_info['access_token']
-            sp = spotipy.Spotify(auth=token)
-            st.success("Connected to Spotify")
-            step1 = '<div class="step"><span class="step-dot done"></span> 1. Connect Spotify</div>'
-            step_container.markdown(step1 + step2 + step3, unsafe_allow_html=True)
 
-        st.markdown('<div class="card">', unsafe_allow_html=True)
-        st.write("#### Data Loader")
+        # One /v1/me lookup per session; the token is then handed to the background refresher
+        if "user_id" not in st.session_state:
+            from spotify_client import save_user_token, spotify_for_token
 
-        top_tracks = sp.current_user_top_tracks(limit=10)
-        recently_played = sp.current_user_recently_played(limit=10)
+            with tracing.span("app.auth"):
+                user_id = spotify_for_token(token_info["access_token"]).current_user()["id"]
+                save_user_token(user_id, token_info)
+            st.session_state["user_id"] = user_id
+        user_id = st.session_state["user_id"]
+        st.success("Connected to Spotify")
+        step1 = '<div class="step"><span class="step-dot done"></span> 1. Connect Spotify</div>'
+        step_container.markdown(step1 + step2 + step3, unsafe_allow_html=True)
 
-        st.write("#### Top Tracks")
-        for item in top_tracks['items']:
-            track = item['name']
-            artist = item['artists'][0]['name']
-            st.write(f"- {track} by {artist}")
+        st.markdown('<div class="card">', unsafe_allow_html=True)
+        st.write("#### Data Loader")
 
-        st.write("#### Recently Played")
-        for item in recently_played['items']:
-            track = item['track']['name']
-            artist = item['track']['artists'][0]['name']
-            st.write(f"- {track} by {artist}")
+        refresher = get_refresher()
+        status = sync_status(user_id)
+        if status["last_synced_at"] is None:
+            # Nothing to show yet, so the very first sync is worth waiting for; a failed one backs off
+            future = refresher.request(user_id, interactive=True)
+            if future is None:
+                wait_min = refresher.retry_in(user_id) / 60
+                st.warning(f"Couldn't load your Spotify data yet — retrying in {wait_min:.0f} min.")
+            else:
+                with st.spinner("Loading your Spotify data for the first time..."):
+                    try:
+                        future.result(timeout=FIRST_SYNC_TIMEOUT)
+                    except TimeoutError:
+                        st.info("Still syncing in the background — refresh the page in a moment.")
+                status = sync_status(user_id)
+
+        if status["last_synced_at"] is not None:
+            st.caption(f"Last synced: {status['last_synced_at']} UTC")
+            step2 = '<div class="step"><span class="step-dot done"></span> 2. Load Data</div>'
+            step3 = '<div class="step"><span class="step-dot done"></span> 3. View Insights</div>'
+            step_container.markdown(step1 + step2 + step3, unsafe_allow_html=True)
+        if st.button("Refresh now"):
+            if refresher.request(user_id, interactive=True) is None:
+                wait_min = refresher.retry_in(user_id) / 60
+                st.warning(f"Can't refresh right now — try again in {wait_min:.0f} min.")
+            else:
+                st.info("Refresh started in the background.")
+        st.markdown('</div>', unsafe_allow_html=True)
+
+        # Everything below reads SQLite only
+        time_range = st.selectbox("Time range", TIME_RANGES, index=TIME_RANGES.index("medium_term"))
+        top_tracks_viz(user_id, time_range)
+        mood_profile_viz(user_id, time_range)
+        recent_activity_viz(user_id)
+        listening_heatmap_viz(user_id)
+        genres_viz(user_id, time_range)
+        more_like_this_viz(user_id, time_range)
 
     except Exception as e:
-        st.error(f"Spotify authentication or API call failed: {e}")
\ No newline at end of file
+        st.error(f"Spotify authentication or API call failed: {e}")
+
+    if show_diagnostics:
+        diagnostics_panel()
@@ -0,0 +1,683 @@
+"""Benchmarks for the ETL and dashboard hot paths.
+
+Run with ``python bench.py <benchmark>``. Every benchmark works on a
+throwaway database seeded with synthetic data and prints its timings.
+API-facing benchmarks talk to ``fake_spotify.FakeSpotify``, so nothing here
+needs credentials or network.
+
+    python bench.py etl
+    python bench.py scale --plays 1000,100000,10000000
+    python bench.py fact_table --plays 1000000,5000000
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+
+BENCH_USER = "bench-user"
+SCALES = (1_000, 100_000, 10_000_000)
+FULL_HISTORY_MAX_PLAYS = 1_000_000  # Queries that load every play are skipped above this
+
+
+@contextmanager
+def temp_db():
+    """Point ``db.DB_PATH`` at a fresh, initialised database for the duration."""
+    import db
+
+    old_path = db.DB_PATH
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = os.path.join(tmp, "bench.db")
+        try:
+            db.init_db()
+            yield db.DB_PATH
+        finally:
+            db.close_all()
+            db.DB_PATH = old_path
+
+
+def seed_library(n_plays, n_tracks=None, n_artists=None, seed=0):
+    """Fill the current database with synthetic artists, tracks, features and plays.
+
+    Everything belongs to ``BENCH_USER``, whose medium_term top tracks are the
+    first 50 tracks.
+    """
+    from db import get_conn, insert_play_events, sync_artist_genres
+
+    rng = random.Random(seed)
+    n_tracks = n_tracks or max(1, n_plays // 20)
+    n_artists = n_artists or max(1, n_tracks // 10)
+    start_ms = 1_600_000_000_000
+
+    with get_conn() as conn:
+        conn.execute("INSERT INTO users (user_id) VALUES (?)", (BENCH_USER,))
+        conn.executemany(
+            "INSERT INTO artists (artist_id, name, genres) VALUES (?, ?, ?)",
+            ((f"artist{i}", f"Artist {i}", "pop, rock") for i in range(n_artists)),
+        )
+        conn.executemany(
+            "INSERT INTO tracks (track_id, name, artist_id, album_name, release_date, duration_ms, popularity) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            ((f"track{i}", f"Track {i}", f"artist{i % n_artists}", "Album", "2020-01-01",
+              200_000, rng.randint(0, 100)) for i in range(n_tracks)),
+        )
+        conn.executemany(
+            "INSERT INTO audio_features (track_id, danceability, energy, key, loudness, mode, speechiness, "
+            "acousticness, instrumentalness, liveness, valence, tempo) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            ((f"track{i}", rng.random(), rng.random(), rng.randint(0, 11), -rng.random() * 20, rng.randint(0, 1),
+              rng.random(), rng.random(), rng.random(), rng.random(), rng.random(), 60 + rng.random() * 120)
+             for i in range(n_tracks)),
+        )
+
+        insert_play_events(conn, (
+            (BENCH_USER, f"track{rng.randrange(n_tracks)}", start_ms + i * 180_000, "playlist")
+            for i in range(n_plays)
+        ))
+        conn.executemany(
+            "INSERT INTO top_tracks (user_id, time_range, rank, track_id) VALUES (?, 'medium_term', ?, ?)",
+            ((BENCH_USER, rank, f"track{rank - 1}") for rank in range(1, min(n_tracks, 50) + 1)),
+        )
+        sync_artist_genres(conn)
+
+
+def measure(fn, repeat):
+    """Run ``fn`` ``repeat`` times and return the wall times in milliseconds."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def report(label, timings):
+    timings = sorted(timings)
+    p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    print(f"{label:<40} median {statistics.median(timings):8.2f} ms   p95 {p95:8.2f} ms")
+
+
+@contextmanager
+def _legacy_get_conn():
+    """The original open-per-call connection helper, kept for comparison."""
+    import db
+
+    conn = sqlite3.connect(db.DB_PATH)
+    conn.execute("PRAGMA foreign_keys = ON;")
+    try:
+        yield conn
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _render_queries():
+    # One dashboard page: top_tracks_viz, mood_profile_viz, recent_activity_viz,
+    # listening_heatmap_viz each run their df_* query, bypassing the query cache
+    # so every call reaches SQLite.
+    from etl import df_top_tracks, df_recent_activity
+
+    df_top_tracks.__wrapped__(BENCH_USER)
+    df_top_tracks.__wrapped__(BENCH_USER)
+    df_recent_activity.__wrapped__(BENCH_USER)
+    df_recent_activity.__wrapped__(BENCH_USER)
+
+
+def _widget_lookups(n=20):
+    # Small per-widget reads where connection setup dominates the query itself.
+    from db import get_read_conn
+
+    for _ in range(n):
+        with get_read_conn() as conn:
+            conn.execute(
+                "SELECT COUNT(*) FROM play_events WHERE user_key = (SELECT user_key FROM users WHERE user_id = ?) "
+                "AND played_at_ms >= 1577836800000", (BENCH_USER,)  # Since 2020
+            ).fetchone()
+
+
+def bench_connections(n_plays=10_000, renders=30):
+    """Render-time query latency with open-per-call vs pooled WAL connections."""
+    import db
+
+    def with_helper(helper, fn):
+        def run():
+            pooled, db.get_read_conn = db.get_read_conn, helper
+            try:
+                fn()
+            finally:
+                db.get_read_conn = pooled
+        return run
+
+    print(f"Dashboard queries, {n_plays:,} plays, {renders} runs each (interleaved)")
+    with temp_db():
+        seed_library(n_plays)
+        for label, fn in (("4 df_* queries", _render_queries), ("20 widget lookups", _widget_lookups)):
+            legacy, current = [], []
+            fn()  # warm the OS page cache
+            for _ in range(renders):
+                legacy += measure(with_helper(_legacy_get_conn, fn), 1)
+                current += measure(with_helper(db.get_read_conn, fn), 1)
+            report(f"{label}, open-per-call", legacy)
+            report(f"{label}, pooled WAL", current)
+
+
+def bench_query_cache(n_plays=10_000, renders=30):
+    """Dashboard render queries with and without the data-version query cache."""
+    from etl import df_top_tracks, df_recent_activity
+    from query_cache import cache_stats, clear_cache
+
+    def cached_render():
+        df_top_tracks(BENCH_USER)
+        df_top_tracks(BENCH_USER)
+        df_recent_activity(BENCH_USER)
+        df_recent_activity(BENCH_USER)
+
+    print(f"Dashboard render queries, {n_plays:,} plays, {renders} renders")
+    with temp_db():
+        seed_library(n_plays)
+        clear_cache()
+        report("uncached", measure(_render_queries, renders))
+        report("query cache", measure(cached_render, renders))
+        print(f"cache stats: {cache_stats()}")
+
+
+def _table_rows(conn):
+    tables = ("play_events", "tracks", "artists", "audio_features", "top_tracks")
+    return sum(conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in tables)
+
+
+def _run_sync(label, sp, fn):
+    """Run one sync against ``sp`` and print API calls, wall time and rows/s written."""
+    from db import get_read_conn
+
+    with get_read_conn() as conn:
+        rows_before = _table_rows(conn)
+    calls_before = sum(sp.calls.values())
+    start = time.perf_counter()
+    fn()
+    seconds = time.perf_counter() - start
+    with get_read_conn() as conn:
+        rows = _table_rows(conn) - rows_before
+    calls = sum(sp.calls.values()) - calls_before
+    print(f"{label:<40} {calls:5d} API calls {seconds * 1000:9.1f} ms "
+          f"{rows:7,d} rows {rows / seconds if seconds else 0:10,.0f} rows/s")
+
+
+def bench_etl(n_plays=5_000, n_tracks=2_000, latency=0.02):
+    """End-to-end loads against the fake API: first sync, incremental sync, rate-limited sync."""
+    import etl
+    from fake_spotify import FakeSpotify
+
+    print(f"ETL against FakeSpotify, {n_plays:,} plays in history, {latency * 1000:.0f} ms per call")
+    with temp_db():
+        sp = FakeSpotify(n_tracks=n_tracks, n_plays=n_plays, recent_window=n_plays, latency=latency)
+        _run_sync("first sync, sequential loaders", sp, lambda: (
+            [etl.load_top_tracks(sp, time_range) for time_range in etl.TIME_RANGES],
+            etl.load_recently_played(sp),
+        ))
+        _run_sync("audio-features backfill", sp, lambda: etl.backfill_audio_features(sp))
+        _run_sync("audio-features backfill, nothing left", sp, lambda: etl.backfill_audio_features(sp))
+    with temp_db():
+        sp = FakeSpotify(n_tracks=n_tracks, n_plays=n_plays, recent_window=n_plays, latency=latency)
+        _run_sync("first sync, refresh_all", sp, lambda: etl.refresh_all(sp))
+        sp.listen(100)
+        _run_sync("incremental sync, 100 new plays", sp, lambda: etl.refresh_all(sp))
+        _run_sync("no-op sync", sp, lambda: etl.refresh_all(sp))
+        print(f"API calls by endpoint: {dict(sp.calls)}")
+    with temp_db():
+        sp = FakeSpotify(n_tracks=n_tracks, n_plays=n_plays, recent_window=n_plays, latency=latency,
+                         rate_limit=20)
+        _run_sync("first sync, 20 calls/s rate limit", sp, lambda: etl.refresh_all(sp))
+        print(f"429 responses: {sp.rate_limited}")
+
+
+def _scheduler_run(label, scheduled, workdir, processes, requests_each, ceiling, latency):
+    # Background clients saturate the API while one interactive client makes a call every 200 ms
+    import threading
+    import spotipy
+    from fake_spotify import FakeSpotify, FakeSpotifyTransport, spotify_id
+    from http_cache import ResponseCache, cached_session
+    from scheduler import BACKGROUND, INTERACTIVE, RequestScheduler, SchedulingAdapter, SharedTokenBucket
+    from spotify_client import call_with_backoff
+
+    fake = FakeSpotify(n_tracks=processes * requests_each + 100, rate_limit=ceiling, latency=latency)
+    path = os.path.join(workdir, f"{label}.db")
+    # One scheduler and bucket connection per simulated process: they only share the SQLite row
+    schedulers = [RequestScheduler(SharedTokenBucket(path, rate=ceiling * 0.9, burst=max(2, ceiling // 10)))
+                  for _ in range(processes)]
+
+    def client(n, priority):
+        transport = FakeSpotifyTransport(fake)
+        if scheduled:
+            transport = SchedulingAdapter(transport, schedulers[n], priority)
+        session = cached_session(cache=ResponseCache(path), inner=transport)
+        return spotipy.Spotify(auth="bench", requests_session=session, retries=0)
+
+    background, interactive, errors = [], [], []
+
+    def background_worker(n):
+        sp = client(n, BACKGROUND)
+        for i in range(requests_each):
+            start = time.perf_counter()
+            try:
+                call_with_backoff(sp.audio_features, [spotify_id("track", n * requests_each + i)], base_delay=0.1)
+            except Exception as e:
+                errors.append(e)
+            background.append((time.perf_counter() - start) * 1000)
+
+    def interactive_worker():
+        sp = client(0, INTERACTIVE)
+        for i in range(10):
+            time.sleep(0.2)
+            start = time.perf_counter()
+            call_with_backoff(sp.artist, spotify_id("artist", i), base_delay=0.1)
+            interactive.append((time.perf_counter() - start) * 1000)
+
+    threads = [threading.Thread(target=background_worker, args=(n,)) for n in range(processes)]
+    threads.append(threading.Thread(target=interactive_worker))
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+    calls = sum(fake.calls.values())
+    print(f"{label}: {calls} API calls in {seconds:.1f}s ({calls / seconds:.1f}/s against a {ceiling}/s ceiling), "
+          f"{fake.rate_limited} x 429, {len(errors)} failed requests")
+    report(f"{label}, interactive call", interactive)
+    report(f"{label}, background call", background)
+
+
+def bench_scheduler(processes=4, requests_each=60, ceiling=20, latency=0.02):
+    """Concurrent clients against a rate-limited fake API, without and with the shared request scheduler.
+
+    Each simulated process gets its own ``RequestScheduler`` on one bucket file,
+    so they coordinate only through SQLite, as separate processes would.
+    """
+    import logging
+
+    logging.getLogger("spotipy").setLevel(logging.CRITICAL)  # Every 429 is logged as an error otherwise
+    print(f"{processes} processes x {requests_each} background calls + 10 interactive calls, "
+          f"{ceiling} calls/s API limit, {latency * 1000:.0f} ms per call")
+    with tempfile.TemporaryDirectory() as workdir:
+        for label, scheduled in (("unscheduled", False), ("scheduler", True)):
+            _scheduler_run(label, scheduled, workdir, processes, requests_each, ceiling, latency)
+
+
+def bench_scale(scales=SCALES, repeat=5):
+    """Seeding rows/s and uncached dashboard query latency as the play history grows."""
+    import etl
+    import db
+
+    for n_plays in scales:
+        print(f"{n_plays:,} plays")
+        with temp_db() as path:
+            start = time.perf_counter()
+            seed_library(n_plays)
+            seconds = time.perf_counter() - start
+            with db.get_read_conn() as conn:
+                rows = _table_rows(conn)
+            size = sum(os.path.getsize(p) for p in (path, path + "-wal") if os.path.exists(p))
+            print(f"{'seed':<40} {rows:,} rows in {seconds:.1f}s ({rows / seconds:,.0f} rows/s), "
+                  f"{size / 2**20:,.1f} MB")
+            queries = [
+                ("df_top_tracks", etl.df_top_tracks),
+                ("df_mood_profile", etl.df_mood_profile),
+                ("df_listening_heatmap", etl.df_listening_heatmap),
+                ("df_daily_plays", etl.df_daily_plays),
+                ("df_recent_activity_page", etl.df_recent_activity_page),
+                ("df_recent_activity", etl.df_recent_activity),
+            ]
+            for name, fn in queries:
+                if name == "df_recent_activity" and n_plays > FULL_HISTORY_MAX_PLAYS:
+                    print(f"{name:<40} skipped, loads the full history")
+                    continue
+                fn.__wrapped__(BENCH_USER)  # Warm up imports and the page cache
+                report(name, measure(lambda: fn.__wrapped__(BENCH_USER), repeat))
+        print()
+
+
+# The plays table before play_events, rebuilt from the compatibility view for comparison
+LEGACY_PLAYS_DDL = """
+    CREATE TABLE plays (
+        user_id    TEXT NOT NULL,
+        play_id    TEXT NOT NULL,
+        track_id   TEXT NOT NULL,
+        played_at  TEXT NOT NULL,
+        context    TEXT,
+        PRIMARY KEY (user_id, play_id)
+    );
+    CREATE INDEX idx_plays_user_played_at ON plays(user_id, played_at, track_id, context);
+    CREATE TABLE tracks (track_id TEXT PRIMARY KEY, name TEXT NOT NULL, artist_id TEXT);
+    CREATE TABLE artists (artist_id TEXT PRIMARY KEY, name TEXT NOT NULL);
+"""
+
+FACT_QUERIES = {
+    "heatmap from plays": (
+        """SELECT (CAST(strftime('%w', played_at) AS INTEGER) + 6) % 7, CAST(strftime('%H', played_at) AS INTEGER),
+                  COUNT(*) FROM plays WHERE user_id = ? GROUP BY 1, 2""",
+        """SELECT local_weekday, local_hour, COUNT(*) FROM play_events
+           WHERE user_key = (SELECT user_key FROM users WHERE user_id = ?) GROUP BY 1, 2""",
+    ),
+    "recent activity, latest 50": (
+        """SELECT p.play_id, t.name, a.name, p.played_at, p.context FROM plays p
+           JOIN tracks t ON p.track_id = t.track_id JOIN artists a ON t.artist_id = a.artist_id
+           WHERE p.user_id = ? ORDER BY p.played_at DESC LIMIT 50""",
+        """SELECT t.track_id, t.name, a.name, p.played_at_ms, p.context FROM play_events p
+           JOIN tracks t ON p.track_key = t.track_key JOIN artists a ON t.artist_id = a.artist_id
+           WHERE p.user_key = (SELECT user_key FROM users WHERE user_id = ?) ORDER BY p.played_at_ms DESC LIMIT 50""",
+    ),
+    "recent activity, full history": (
+        """SELECT p.play_id, t.name, a.name, p.played_at, p.context FROM plays p
+           JOIN tracks t ON p.track_id = t.track_id JOIN artists a ON t.artist_id = a.artist_id
+           WHERE p.user_id = ? ORDER BY p.played_at DESC""",
+        """SELECT t.track_id, t.name, a.name, p.played_at_ms, p.context FROM play_events p
+           JOIN tracks t ON p.track_key = t.track_key JOIN artists a ON t.artist_id = a.artist_id
+           WHERE p.user_key = (SELECT user_key FROM users WHERE user_id = ?) ORDER BY p.played_at_ms DESC""",
+    ),
+}
+
+
+def _table_bytes(conn, names):
+    # Pages used by the given tables and indexes, from the dbstat virtual table
+    marks = ",".join("?" * len(names))
+    return conn.execute(f"SELECT COALESCE(SUM(pgsize), 0) FROM dbstat WHERE name IN ({marks})", names).fetchone()[0]
+
+
+def bench_fact_table(scales=(1_000_000, 3_000_000), repeat=5):
+    """Size and query time of the old text-keyed plays table vs play_events."""
+    import db
+
+    for n_plays in scales:
+        print(f"{n_plays:,} plays")
+        with temp_db() as path:
+            seed_library(n_plays)
+            legacy_path = path + ".legacy"
+            legacy = sqlite3.connect(legacy_path)
+            legacy.executescript(LEGACY_PLAYS_DDL)
+            legacy.execute("ATTACH DATABASE ? AS cur", (path,))
+            legacy.execute("INSERT INTO plays SELECT * FROM cur.plays ORDER BY user_id, play_id")
+            legacy.execute("INSERT INTO tracks SELECT track_id, name, artist_id FROM cur.tracks")
+            legacy.execute("INSERT INTO artists SELECT artist_id, name FROM cur.artists")
+            legacy.commit()
+            legacy.execute("DETACH DATABASE cur")
+
+            old_bytes = _table_bytes(legacy, ["plays", "sqlite_autoindex_plays_1", "idx_plays_user_played_at"])
+            with db.get_read_conn() as conn:
+                new_bytes = _table_bytes(conn, ["play_events"])
+            print(f"{'plays + indexes':<40} {old_bytes / 2**20:8.1f} MB ({old_bytes / n_plays:.0f} B/play)")
+            print(f"{'play_events':<40} {new_bytes / 2**20:8.1f} MB ({new_bytes / n_plays:.0f} B/play)")
+
+            for label, (old_sql, new_sql) in FACT_QUERIES.items():
+                with db.get_read_conn() as conn:
+                    for name, run_on, sql in (("plays", legacy, old_sql), ("play_events", conn, new_sql)):
+                        run_on.execute(sql, (BENCH_USER,)).fetchall()  # Warm the page cache
+                        report(f"{label} ({name})",
+                               measure(lambda: run_on.execute(sql, (BENCH_USER,)).fetchall(), repeat))
+            legacy.close()
+        print()
+
+
+# Runs app.py once in a fresh interpreter under Streamlit's AppTest and prints timings as JSON.
+# EAGER pre-imports what app.py and dashboards.py used to import at module load.
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, {repo!r})
+if {eager!r}:
+    import matplotlib.pyplot, pandas, spotipy.oauth2
+from streamlit.testing.v1 import AppTest
+imported = time.perf_counter()
+at = AppTest.from_file({app!r}, default_timeout=120)
+if {user_id!r}:
+    at.session_state["user_id"] = {user_id!r}
+at.run()
+first = time.perf_counter()
+at.run()
+rerun = time.perf_counter()
+assert not at.exception, at.exception
+print(json.dumps({{
+    "imports": (imported - start) * 1000, "first render": (first - imported) * 1000,
+    "rerun": (rerun - first) * 1000,
+    "heavy modules": sorted(m for m in ("matplotlib", "pandas", "spotipy") if m in sys.modules),
+}}))
+"""
+
+
+def _startup_sample(workdir, eager, user_id):
+    repo = os.path.dirname(os.path.abspath(__file__))
+    script = STARTUP_SCRIPT.format(repo=repo, app=os.path.join(repo, "app.py"), eager=eager, user_id=user_id)
+    env = dict(os.environ, SPOTIFY_CLIENT_ID="bench", SPOTIFY_CLIENT_SECRET="bench",
+               SPOTIFY_REDIRECT_URI="http://localhost:8501")
+    out = subprocess.run([sys.executable, "-c", script], cwd=workdir, env=env, capture_output=True, text=True,
+                         check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def bench_startup(runs=5):
+    """Cold-process import time, first render and rerun of app.py: eager vs lazy heavy imports.
+
+    "landing" is the login page of a visitor without a token; "dashboard" is a
+    connected user with synced data. Each sample is a new interpreter.
+    """
+    import db
+    import etl
+    from fake_spotify import FakeSpotify
+
+    with tempfile.TemporaryDirectory() as workdir:
+        old_path = db.DB_PATH
+        db.DB_PATH = os.path.join(workdir, "spotify_insights.db")
+        try:
+            db.init_db()
+            etl.refresh_all(FakeSpotify(n_plays=2_000, recent_window=2_000))
+        finally:
+            db.close_all()
+            db.DB_PATH = old_path
+
+        for page, user_id in (("landing", None), ("dashboard", "fake-user")):
+            token_path = os.path.join(workdir, ".cache")
+            if user_id:
+                # Spotipy's default token cache, so the page skips the login step
+                with open(token_path, "w") as f:
+                    json.dump({"access_token": "bench", "token_type": "Bearer", "expires_in": 3600,
+                               "scope": "user-top-read user-read-recently-played", "refresh_token": "bench",
+                               "expires_at": int(time.time()) + 3600}, f)
+            for mode, eager in (("eager imports", True), ("lazy imports", False)):
+                samples = [_startup_sample(workdir, eager, user_id) for _ in range(runs)]
+                for metric in ("imports", "first render", "rerun"):
+                    report(f"{page}, {mode}: {metric}", [sample[metric] for sample in samples])
+                print(f"{page}, {mode}: heavy modules loaded {samples[0]['heavy modules']}")
+
+
+def _rss_mb():
+    # Current resident set size, from /proc where available (peak RSS otherwise)
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        import resource
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _pyplot_render(user_id, topn):
+    # What the widgets used to do on every rerun: a new pyplot figure, never closed, saved as st.pyplot does
+    import io
+    import matplotlib.pyplot as plt
+    from etl import df_listening_heatmap, df_top_tracks
+
+    top_df = df_top_tracks(user_id).head(topn)
+    plt.figure()
+    plt.barh(top_df["track_name"][::-1], top_df["popularity"][::-1])
+    plt.savefig(io.BytesIO(), format="png", bbox_inches="tight")
+    plt.figure()
+    plt.imshow(df_listening_heatmap(user_id).values, aspect="auto")
+    plt.colorbar()
+    plt.savefig(io.BytesIO(), format="png", bbox_inches="tight")
+
+
+def _chart_render(user_id, topn, cached=True):
+    import charts
+
+    top_tracks_png, listening_heatmap_png = charts.top_tracks_png, charts.listening_heatmap_png
+    if not cached:
+        top_tracks_png, listening_heatmap_png = top_tracks_png.__wrapped__, listening_heatmap_png.__wrapped__
+    top_tracks_png(user_id, "medium_term", topn)
+    listening_heatmap_png(user_id)
+
+
+def bench_charts(n_plays=10_000, reruns=300):
+    """Top-tracks and heatmap charts over many reruns: pyplot per rerun vs the Agg renderer.
+
+    Reruns cycle through a few ``topn`` slider values, as a user dragging it
+    would. The pyplot run goes last, since the figures it leaks stay in memory.
+    """
+    import warnings
+    import charts
+
+    topns = (5, 10, 20, 50)
+    print(f"Top tracks + heatmap charts, {n_plays:,} plays, {reruns:,} reruns")
+    with temp_db():
+        seed_library(n_plays)
+        for label, render in (("charts, cached PNG", _chart_render),
+                              ("charts, rendered every rerun", lambda *args: _chart_render(*args, cached=False)),
+                              ("pyplot, new figure per rerun", _pyplot_render)):
+            charts.clear_chart_cache()
+            render(BENCH_USER, topns[0])  # Import matplotlib and warm the query cache
+            rss_before = _rss_mb()
+            timings = []
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")  # pyplot's "more than 20 figures" warning
+                for i in range(reruns):
+                    timings += measure(lambda: render(BENCH_USER, topns[i % len(topns)]), 1)
+            report(label, timings)
+            print(f"{label}: RSS {rss_before:.0f} -> {_rss_mb():.0f} MB")
+            if render is _chart_render:
+                print(f"chart cache stats: {charts.chart_cache_stats()}")
+
+
+def bench_tracing(n_plays=10_000, renders=30):
+    """Overhead of the tracing hooks on dashboard queries, disabled vs enabled."""
+    import tracing
+
+    def workload():
+        _render_queries()
+        _widget_lookups()
+
+    print(f"Dashboard queries + widget lookups, {n_plays:,} plays, {renders} runs each (interleaved)")
+    with temp_db():
+        seed_library(n_plays)
+        workload()
+        off, on = [], []
+        for _ in range(renders):
+            tracing.disable()
+            off += measure(workload, 1)
+            tracing.enable()
+            on += measure(workload, 1)
+        tracing.disable()
+        report("tracing disabled", off)
+        report("tracing enabled", on)
+        print(f"{len(tracing.snapshot()['sql'])} distinct statements recorded")
+        tracing.reset()
+
+
+def _pandas_neighbors(df, track_id, k):
+    # The naive approach: cosine similarity row by row with DataFrame.apply
+    import numpy as np
+
+    query = df.loc[track_id].to_numpy()
+    query_norm = np.linalg.norm(query)
+    scores = df.apply(lambda row: float(row.to_numpy() @ query) / (np.linalg.norm(row.to_numpy()) * query_norm),
+                      axis=1)
+    return scores.drop(track_id).nlargest(k)
+
+
+def bench_similarity(sizes=(10_000, 100_000, 1_000_000), k=10, queries=100, pandas_max=100_000):
+    """kNN over audio features: pandas row-wise vs NumPy brute force vs the IVF index."""
+    import numpy as np
+    import pandas as pd
+    from similarity import FEATURES, SimilarityIndex
+
+    rng = np.random.default_rng(0)
+    for n in sizes:
+        print(f"{n:,} tracks, k={k}")
+        track_ids = [f"track{i}" for i in range(n)]
+        features = rng.random((n, len(FEATURES)))
+        sample = [track_ids[i] for i in rng.choice(n, queries, replace=False)]
+
+        if n <= pandas_max:
+            df = pd.DataFrame(features, index=track_ids, columns=FEATURES)
+            df = (df - df.mean()) / df.std(ddof=0)
+            report("pandas row-wise, 1 query", measure(lambda: _pandas_neighbors(df, sample[0], k), 1))
+
+        start = time.perf_counter()
+        brute = SimilarityIndex.from_features(track_ids, features, ivf=False)
+        brute.positions  # Build the ID lookup outside the timings
+        print(f"{'build (normalise)':<40} {(time.perf_counter() - start) * 1000:8.1f} ms")
+        report("numpy brute force, 1 query", measure(lambda: brute.neighbors(sample[:1], k), 5))
+        report(f"numpy brute force, batch of {queries}", measure(lambda: brute.neighbors(sample, k), 3))
+
+        start = time.perf_counter()
+        ivf = SimilarityIndex(brute.vectors.copy(), brute.track_ids.copy(), brute.mean, brute.std)
+        ivf.build_ivf()
+        ivf.positions
+        print(f"{'build IVF':<40} {(time.perf_counter() - start) * 1000:8.1f} ms")
+        report("IVF, 1 query", measure(lambda: ivf.neighbors(sample[:1], k), 5))
+        report(f"IVF, batch of {queries}", measure(lambda: ivf.neighbors(sample, k), 3))
+        exact = brute.neighbors(sample, k)
+        approx = ivf.neighbors(sample, k)
+        recall = np.mean([len({t for t, _ in a} & {t for t, _ in e}) / k for a, e in zip(approx, exact)])
+        print(f"{'IVF recall@' + str(k):<40} {recall:.3f}")
+
+        with tempfile.TemporaryDirectory() as tmp:
+            ivf.save(tmp)
+            report("load (memory-mapped)", measure(lambda: SimilarityIndex.load(tmp), 5))
+
+            loaded = SimilarityIndex.load(tmp)
+            starts = iter(range(n, 2 * n, 100))
+
+            def add_and_save():
+                start = next(starts)
+                loaded.add([f"track{i}" for i in range(start, start + 100)], rng.random((100, len(FEATURES))))
+                loaded.save(tmp)
+
+            report("add 100 tracks + save (tail append)", measure(add_and_save, 5))
+        print()
+
+
+BENCHMARKS = {
+    "charts": bench_charts,
+    "connections": bench_connections,
+    "etl": bench_etl,
+    "fact_table": bench_fact_table,
+    "query_cache": bench_query_cache,
+    "scale": bench_scale,
+    "scheduler": bench_scheduler,
+    "similarity": bench_similarity,
+    "startup": bench_startup,
+    "tracing": bench_tracing,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS) + ["all"])
+    parser.add_argument("--plays", help="Comma-separated history sizes for the scale and fact_table benchmarks")
+    args = parser.parse_args()
+    names = sorted(BENCHMARKS) if args.benchmark == "all" else [args.benchmark]
+    for name in names:
+        if name in ("scale", "fact_table") and args.plays:
+            BENCHMARKS[name]([int(n) for n in args.plays.split(",")])
+        else:
+            BENCHMARKS[name]()
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Server-side rendering of the dashboard's matplotlib charts, cached as PNG bytes.
+
+Figures are built with the object-oriented API on an Agg canvas, never through
+``pyplot``, so nothing is registered in pyplot's global figure list and each
+figure is released as soon as its PNG is written. The PNGs are memoized with
+``query_cache.versioned`` in their own bounded LRU, keyed on the chart's
+arguments (user, time range, ``topn``...) and labelled with the DB data
+version: a rerun with unchanged data and widgets is a cache lookup, and the
+next ETL write invalidates every chart at once.
+"""
+import io
+
+from query_cache import QueryCache, versioned
+from tracing import span
+
+MAX_CHARTS = 64  # Rendered PNGs kept; a heatmap is ~25 KB, a top-50 bar chart ~60 KB
+DPI = 100
+
+_charts = QueryCache(MAX_CHARTS)
+
+
+def _new_figure(figsize=(6.4, 4.8)):
+    """A figure attached to its own Agg canvas, outside pyplot's figure manager."""
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=figsize, dpi=DPI)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def _to_png(fig):
+    buf = io.BytesIO()
+    try:
+        fig.savefig(buf, format="png", bbox_inches="tight")
+    finally:
+        fig.clear()  # Drop the artists now rather than whenever the figure is collected
+    return buf.getvalue()
+
+
+@versioned(_charts)
+def top_tracks_png(user_id, time_range="medium_term", topn=10):
+    """Horizontal bar chart of a user's top ``topn`` tracks by popularity, as PNG bytes."""
+    from etl import df_top_tracks
+
+    top_df = df_top_tracks(user_id, time_range).head(topn)
+    with span("charts.render", chart="top_tracks"):
+        fig = _new_figure()
+        ax = fig.add_subplot()
+        # Ranked by Spotify's top-tracks order, #1 at the top
+        ax.barh(top_df["track_name"][::-1], top_df["popularity"][::-1])
+        ax.set_xlabel("Popularity")
+        ax.set_title(f"Top {topn} Tracks")
+        return _to_png(fig)
+
+
+@versioned(_charts)
+def listening_heatmap_png(user_id):
+    """Weekday x hour play counts as an image with a colorbar, as PNG bytes."""
+    from etl import df_listening_heatmap
+
+    pivot = df_listening_heatmap(user_id)
+    with span("charts.render", chart="heatmap"):
+        fig = _new_figure()
+        ax = fig.add_subplot()
+        # Default colormap
+        image = ax.imshow(pivot.values, aspect="auto")
+        ax.set_title("Plays by Weekday (rows) and Hour (cols)")
+        ax.set_xlabel("Hour of Day (0–23)")
+        ax.set_ylabel("Weekday (0=Mon … 6=Sun)")
+        fig.colorbar(image, ax=ax, label="Play Count")
+        return _to_png(fig)
+
+
+def chart_cache_stats():
+    """Hit/miss counters and entry count of the chart cache."""
+    return _charts.stats()
+
+
+def clear_chart_cache():
+    _charts.clear()
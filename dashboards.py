@@ -1,17 +1,53 @@
+import calendar
+from datetime import timedelta
+from typing import TYPE_CHECKING
 import streamlit as st
-import pandas as pd
-import matplotlib.pyplot as plt
-from etl import df_top_tracks, df_recent_activity
-
-def _download_button(df: pd.DataFrame, label: str, filename: str):
+from etl import (CONTEXT_TYPES, df_top_tracks, df_recent_activity_page, df_listening_heatmap, df_mood_profile,
+                 df_feature_coverage, df_top_genres, df_genre_share_over_time)
+from charts import listening_heatmap_png, top_tracks_png
+from export import HAVE_PYARROW, snapshot_path
+import tracing
+from tracing import span, traced
+
+# pandas is imported inside the widgets that use it and matplotlib inside charts, keeping both off the first paint
+if TYPE_CHECKING:
+    import pandas as pd
+
+def _download_button(df: "pd.DataFrame", label: str, filename: str):
+    # Encode only on the rerun where the user asked for the file, not on every render
     if df is not None and not df.empty:
-        csv = df.to_csv(index=False).encode("utf-8")
-        st.download_button(label=label, data=csv, file_name=filename, mime="text/csv")
-
-def top_tracks_viz():
+        if st.button(label, key=f"prepare_{filename}"):
+            with span("dashboards.csv_encode", rows=len(df)):
+                csv = df.to_csv(index=False).encode("utf-8")
+            st.download_button(label=f"Save {filename}", data=csv, file_name=filename,
+                               mime="text/csv", key=f"save_{filename}")
+
+SNAPSHOT_MIME = {"parquet": "application/vnd.apache.parquet", "csv": "text/csv"}
+
+def _snapshot_download_button(name: str, user_id: str, label: str, filename: str, fmt: str = "parquet"):
+    # Snapshot file streamed from SQLite; reused until the next ETL write
+    if (fmt == "csv" or HAVE_PYARROW) and st.button(label, key=f"prepare_{filename}"):
+        with open(snapshot_path(name, user_id, fmt), "rb") as f:
+            st.download_button(label=f"Save {filename}", data=f, file_name=filename,
+                               mime=SNAPSHOT_MIME[fmt], key=f"save_{filename}")
+
+def _recent_activity_filters():
+    # Filter widgets for the Recent Activity page; returns df_recent_activity_page kwargs
+    with st.expander("Filters"):
+        artist = st.text_input("Artist contains", key="recent_artist").strip()
+        context = st.selectbox("Played from", ("any",) + CONTEXT_TYPES, key="recent_context")
+        dates = st.date_input("Played between (UTC)", value=(), key="recent_dates")
+    filters = {"artist": artist or None, "context": None if context == "any" else context}
+    if len(dates) == 2:
+        filters["start_ms"] = calendar.timegm(dates[0].timetuple()) * 1000
+        filters["end_ms"] = calendar.timegm((dates[1] + timedelta(days=1)).timetuple()) * 1000
+    return filters
+
+@traced()
+def top_tracks_viz(user_id, time_range="medium_term"):
     st.markdown('<div class="card">', unsafe_allow_html=True)
     st.write("#### Top Tracks")
-    df = df_top_tracks()
+    df = df_top_tracks(user_id, time_range)
     if df.empty:
         st.info("No tracks yet — load data to get started.")
         st.markdown('</div>', unsafe_allow_html=True)
@@ -20,74 +56,164 @@ def top_tracks_viz():
     topn = st.slider("How many tracks?", 5, 50, 10)
     top_df = df.head(topn).copy()
 
-    # Bar chart (matplotlib, single figure)
-    plt.figure()
-    plt.barh(top_df["track_name"][::-1], top_df["popularity"][::-1])
-    plt.xlabel("Popularity")
-    plt.title(f"Top {topn} Tracks by Popularity")
-    st.pyplot(plt.gcf())
+    # Rendered once per (data version, time range, topn); reruns reuse the PNG
+    st.image(top_tracks_png(user_id, time_range, topn), use_column_width=True)
 
     st.dataframe(top_df)
     _download_button(top_df, "Download Top Tracks CSV", "top_tracks.csv")
+    _snapshot_download_button("top_tracks", user_id, "Download All Top Tracks (Parquet)", "top_tracks.parquet")
     st.markdown('</div>', unsafe_allow_html=True)
 
-def mood_profile_viz():
+@traced()
+def mood_profile_viz(user_id, time_range="medium_term"):
     st.markdown('<div class="card" style="margin-top:10px;">', unsafe_allow_html=True)
     st.write("#### Mood Profile")
-    df = df_top_tracks()
-    if df.empty:
+    metrics = df_mood_profile(user_id, time_range)
+    if metrics.empty:
         st.info("Load top tracks to compute danceability, energy, and valence averages.")
         st.markdown('</div>', unsafe_allow_html=True)
         return
 
-    metrics = df[["danceability", "energy", "valence"]].dropna().mean().to_frame("Average").T
     st.table(metrics.round(2))
+    coverage = df_feature_coverage().iloc[0]
+    pending = coverage["tracks"] - coverage["with_features"] - coverage["missed"]
+    st.caption(f"Audio features for {coverage['with_features']:,} of {coverage['tracks']:,} tracks in the library"
+               + (f", {pending:,} still being fetched" if pending > 0 else ""))
     _download_button(metrics, "Download Mood Averages CSV", "mood_profile.csv")
     st.markdown('</div>', unsafe_allow_html=True)
 
-def recent_activity_viz():
+@traced()
+def recent_activity_viz(user_id):
     st.markdown('<div class="card" style="margin-top:10px;">', unsafe_allow_html=True)
     st.write("#### Recent Activity")
-    df = df_recent_activity()
-    if df.empty:
-        st.info("No recent plays captured yet.")
+    filters = _recent_activity_filters()
+
+    # Cursors of the pages walked so far; a new user or filter starts again from the newest play
+    pages_key = (user_id, tuple(sorted(filters.items())))
+    if st.session_state.get("recent_pages_key") != pages_key:
+        st.session_state["recent_pages_key"] = pages_key
+        st.session_state["recent_pages"] = [None]
+    pages = st.session_state["recent_pages"]
+
+    df, next_cursor = df_recent_activity_page(user_id, before=pages[-1], **filters)
+    if df.empty and len(pages) == 1:
+        filtered = any(value is not None for value in filters.values())
+        st.info("No plays match these filters." if filtered else "No recent plays captured yet.")
         st.markdown('</div>', unsafe_allow_html=True)
         return
 
-    st.dataframe(df.head(200))  # show a chunk
-    _download_button(df, "Download Recent Plays CSV", "recent_plays.csv")
+    st.dataframe(df, hide_index=True)
+    newer, page, older = st.columns(3)
+    newer.button("← Newer", on_click=pages.pop, disabled=len(pages) == 1, key="recent_newer")
+    page.caption(f"Page {len(pages)}")
+    older.button("Older →", on_click=pages.append, args=(next_cursor,), disabled=next_cursor is None,
+                 key="recent_older")
+    # Full-history downloads are streamed to a file, never built from the page
+    _snapshot_download_button("recent_plays", user_id, "Download All Plays CSV", "recent_plays.csv", fmt="csv")
+    _snapshot_download_button("recent_plays", user_id, "Download All Plays (Parquet)", "recent_plays.parquet")
     st.markdown('</div>', unsafe_allow_html=True)
 
-def listening_heatmap_viz():
+@traced()
+def listening_heatmap_viz(user_id):
     """Hour x Weekday listening intensity from the 'plays' table."""
     st.markdown('<div class="card" style="margin-top:10px;">', unsafe_allow_html=True)
     st.write("#### Listening Heatmap (Hour × Weekday)")
 
-    df = df_recent_activity()
-    if df.empty:
+    # Precomputed weekday x hour counts, maintained as plays are loaded
+    pivot = df_listening_heatmap(user_id)
+    if not pivot.values.any():
         st.info("Load recent plays to see your listening heatmap.")
         st.markdown('</div>', unsafe_allow_html=True)
         return
 
-    # Parse timestamps and build hour/weekday features
-    df = df.copy()
-    df["played_at"] = pd.to_datetime(df["played_at"], errors="coerce", utc=True).dt.tz_convert(None)
-    df["hour"] = df["played_at"].dt.hour
-    df["weekday"] = df["played_at"].dt.weekday  # 0=Mon ... 6=Sun
-
-    pivot = df.pivot_table(index="weekday", columns="hour", values="track_name", aggfunc="count").fillna(0)
-
-    # One chart per figure; let matplotlib pick default colormap
-    plt.figure()
-    plt.imshow(pivot.values, aspect="auto")
-    plt.title("Plays by Weekday (rows) and Hour (cols)")
-    plt.xlabel("Hour of Day (0–23)")
-    plt.ylabel("Weekday (0=Mon … 6=Sun)")
-    plt.colorbar(label="Play Count")
-    st.pyplot(plt.gcf())
+    st.image(listening_heatmap_png(user_id), use_column_width=True)
 
     # Provide downloadable raw matrix
     pivot_reset = pivot.reset_index()
     _download_button(pivot_reset, "Download Heatmap Matrix CSV", "listening_heatmap_matrix.csv")
 
     st.markdown('</div>', unsafe_allow_html=True)
+
+@traced()
+def genres_viz(user_id, time_range="medium_term"):
+    """Top genres of a snapshot and how the genre mix of plays shifts month to month."""
+    st.markdown('<div class="card" style="margin-top:10px;">', unsafe_allow_html=True)
+    st.write("#### Genres")
+    top = df_top_genres(user_id, time_range)
+    if top.empty:
+        st.info("Load top tracks to see your genre breakdown.")
+        st.markdown('</div>', unsafe_allow_html=True)
+        return
+
+    st.bar_chart(top.set_index("genre")["share"])
+    share = df_genre_share_over_time(user_id)
+    if not share.empty:
+        st.write("Share of plays by month")
+        st.line_chart(share.pivot(index="period", columns="genre", values="share").fillna(0))
+    _download_button(top, "Download Top Genres CSV", "top_genres.csv")
+    st.markdown('</div>', unsafe_allow_html=True)
+
+@traced()
+def more_like_this_viz(user_id, time_range="medium_term"):
+    """Tracks closest to one of the user's top tracks in audio-feature space."""
+    from similarity import similar_tracks
+
+    st.markdown('<div class="card" style="margin-top:10px;">', unsafe_allow_html=True)
+    st.write("#### More Like This")
+    top = df_top_tracks(user_id, time_range)
+    top = top[top["danceability"].notna()] if not top.empty else top
+    if top.empty:
+        st.info("Load top tracks with audio features to get recommendations.")
+        st.markdown('</div>', unsafe_allow_html=True)
+        return
+
+    labels = dict(zip(top["track_id"], top["track_name"] + " — " + top["artist_name"]))
+    track_id = st.selectbox("Seed track", list(labels), format_func=labels.get, key="similar_seed")
+    k = st.slider("How many similar tracks?", 5, 25, 10, key="similar_k")
+    st.dataframe(similar_tracks(track_id, k), hide_index=True)
+    st.markdown('</div>', unsafe_allow_html=True)
+
+def diagnostics_panel():
+    """Span, HTTP and SQL timings collected by ``tracing`` for this process, plus request scheduler metrics."""
+    import json
+    import pandas as pd
+    from scheduler import get_scheduler
+
+    st.markdown('<div class="card" style="margin-top:10px;">', unsafe_allow_html=True)
+    st.write("#### Diagnostics")
+    data = tracing.snapshot()
+    if not (data["spans"] or data["http"] or data["sql"]):
+        st.info("Nothing recorded yet — interact with the dashboard and rerun.")
+        st.markdown('</div>', unsafe_allow_html=True)
+        return
+
+    def table(rows, sort_by):
+        df = pd.DataFrame(rows)
+        return df.sort_values(sort_by, ascending=False) if not df.empty else df
+
+    st.write("**Spans**")
+    st.dataframe(table([{"span": name, **agg} for name, agg in data["spans"].items()], "total_ms"))
+    st.write("**Spotify API calls**")
+    st.dataframe(table([{"endpoint": key, **agg, "status": json.dumps(agg["status"])}
+                        for key, agg in data["http"].items()], "count"))
+    st.write("**Spotify request scheduler**")
+    sched = get_scheduler().stats()
+    st.caption(f"{sched['requests']:,} requests sent, {sched['coalesced']:,} coalesced, {sched['throttled']:,} × 429; "
+               f"{sched['tokens']:.1f} tokens in the shared bucket"
+               + (f", blocked {sched['blocked_for']:.1f}s by Retry-After" if sched["blocked_for"] else ""))
+    st.dataframe(pd.DataFrame([{"priority": name, "queued": sched["queued"][name], **agg}
+                               for name, agg in sched["waits"].items()]), hide_index=True)
+    st.write("**SQL statements**")
+    st.dataframe(table([{"sql": sql, "count": agg["count"], "total_ms": agg["total_ms"], "max_ms": agg["max_ms"]}
+                        for sql, agg in data["sql"].items()], "total_ms").head(25))
+    for slow in data["slow_sql"]:
+        with st.expander(f"Slow query ({slow['max_ms']:.0f} ms): {slow['sql'][:80]}"):
+            st.code(slow["sql"], language="sql")
+            if slow["plan"]:
+                st.code("\n".join(slow["plan"]))
+
+    st.download_button("Download trace (JSON)", data=json.dumps(data, indent=2, default=str),
+                       file_name="trace.json", mime="application/json", key="download_trace")
+    if st.button("Reset diagnostics", key="reset_trace"):
+        tracing.reset()
+    st.markdown('</div>', unsafe_allow_html=True)
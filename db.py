@@ -1,18 +1,149 @@
 import streamlit as st
+import hashlib
+import os
 import sqlite3
+import threading
 from contextlib import contextmanager
+from datetime import datetime
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+
+from tracing import TracingConnection
 
 DB_PATH = "spotify_insights.db"
 
+# IANA zone the heatmap's hour/weekday are computed in, stored per play at write time
+LOCAL_TIMEZONE = os.getenv("SPOTIFY_INSIGHTS_TZ", "UTC")
+
+# Applied to every pooled connection. WAL lets loader writes proceed while
+# dashboard readers keep their snapshot; NORMAL sync is durable in WAL mode
+# except for the last commits on power loss.
+PRAGMAS = (
+    "PRAGMA foreign_keys = ON;",
+    "PRAGMA busy_timeout = 5000;",
+    "PRAGMA synchronous = NORMAL;",
+    "PRAGMA cache_size = -16000;",      # ~16 MB page cache per connection
+    "PRAGMA mmap_size = 268435456;",    # 256 MB memory-mapped reads
+    "PRAGMA temp_store = MEMORY;",
+)
+POOL_MAX_IDLE = 4  # Idle connections kept per pool
+
+
+class ConnectionPool:
+    """Small pool of long-lived connections to one database file.
+
+    A connection is checked out by exactly one thread at a time, so pooled
+    connections are opened with ``check_same_thread=False`` and can be
+    reused by whichever Streamlit script thread asks next.
+    """
+
+    def __init__(self, path, readonly=False, max_idle=POOL_MAX_IDLE):
+        self.path = path
+        self.readonly = readonly
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self.readonly:
+            conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False,
+                                   factory=TracingConnection)
+        else:
+            conn = sqlite3.connect(self.path, check_same_thread=False, factory=TracingConnection)
+            conn.execute("PRAGMA journal_mode = WAL;")
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self._connect()
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+_local = threading.local()
+
+
+def _pool(readonly):
+    path = os.path.abspath(DB_PATH)
+    with _pools_lock:
+        pool = _pools.get((path, readonly))
+        if pool is None:
+            pool = _pools[(path, readonly)] = ConnectionPool(path, readonly=readonly)
+    if readonly and not os.path.exists(path):
+        # mode=ro cannot create the file; let a writer do it first
+        writer = _pool(readonly=False)
+        writer.release(writer.acquire())
+    return pool
+
+
 @contextmanager
 def get_conn():
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("PRAGMA foreign_keys = ON;")
+    """Pooled read-write connection; commits on success, rolls back on error.
+
+    Nested calls on the same thread share the outer connection and only the
+    outermost block commits.
+    """
+    held = getattr(_local, "write", None)
+    if held is not None:
+        conn, depth = held
+        _local.write = (conn, depth + 1)
+        try:
+            yield conn
+        finally:
+            _local.write = (conn, depth)
+        return
+
+    pool = _pool(readonly=False)
+    conn = pool.acquire()
+    _local.write = (conn, 1)
     try:
         yield conn
         conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
     finally:
-        conn.close()
+        _local.write = None
+        pool.release(conn)
+
+
+@contextmanager
+def get_read_conn():
+    """Pooled read-only connection for dashboard queries."""
+    pool = _pool(readonly=True)
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+
+def close_all():
+    """Close every idle pooled connection (e.g. before replacing the DB file)."""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
 
 DDL = """
     PRAGMA foreign_keys = ON;
@@ -24,10 +155,18 @@ DDL = """
     );
 
 
+    CREATE TABLE IF NOT EXISTS users (
+        user_key        INTEGER PRIMARY KEY,     -- Surrogate key used by play_events
+        user_id         TEXT NOT NULL UNIQUE,    -- Spotify user ID
+        display_name    TEXT,
+        created_at      TEXT NOT NULL DEFAULT (datetime('now'))
+    );
+
     CREATE TABLE IF NOT EXISTS tracks (
-        track_id        TEXT PRIMARY KEY, 
+        track_key       INTEGER PRIMARY KEY,     -- Surrogate key used by play_events
+        track_id        TEXT NOT NULL UNIQUE,
         name            TEXT NOT NULL, 
-        artist_id       INTEGER, 
+        artist_id       TEXT, 
         album_name      TEXT, 
         release_date    TEXT, 
         duration_ms     INTEGER, 
@@ -35,6 +174,23 @@ DDL = """
         FOREIGN KEY (artist_id) REFERENCES artists(artist_id)
     );
 
+    -- Genres normalised out of artists.genres; the text column stays as the "already fetched" marker
+    CREATE TABLE IF NOT EXISTS genres (
+        genre_id  INTEGER PRIMARY KEY,
+        name      TEXT NOT NULL UNIQUE
+    );
+
+    CREATE TABLE IF NOT EXISTS artist_genres (
+        artist_id  TEXT NOT NULL,
+        genre_id   INTEGER NOT NULL,
+        PRIMARY KEY (artist_id, genre_id),
+        FOREIGN KEY (artist_id) REFERENCES artists(artist_id),
+        FOREIGN KEY (genre_id) REFERENCES genres(genre_id)
+    ) WITHOUT ROWID;
+
+    CREATE INDEX IF NOT EXISTS idx_artist_genres_genre_id ON artist_genres(genre_id, artist_id);
+    CREATE INDEX IF NOT EXISTS idx_tracks_artist_id ON tracks(artist_id);
+
     CREATE TABLE IF NOT EXISTS audio_features (
         track_id        TEXT PRIMARY KEY,
         danceability    REAL,
@@ -51,17 +207,615 @@ DDL = """
         FOREIGN KEY (track_id) REFERENCES tracks(track_id)
     );
 
-    CREATE TABLE IF NOT EXISTS plays (
-        play_id    TEXT PRIMARY KEY, -- e.g., "{track_id}::{played_at}"
-        track_id   TEXT NOT NULL,
-        played_at  TEXT NOT NULL,    -- ISO8601 timestamp
-        context    TEXT,             -- e.g., "playlist", "album"
+    -- Tracks Spotify returned no audio features for; the backfill doesn't ask again
+    CREATE TABLE IF NOT EXISTS audio_features_misses (
+        track_id   TEXT PRIMARY KEY,
+        missed_at  TEXT NOT NULL DEFAULT (datetime('now')),
+        FOREIGN KEY (track_id) REFERENCES tracks(track_id)
+    ) WITHOUT ROWID;
+
+    -- One row per play, clustered by user and time. Integer keys and timestamps keep a play
+    -- near 30 bytes on disk; the local hour/weekday are fixed when the play is written.
+    CREATE TABLE IF NOT EXISTS play_events (
+        user_key       INTEGER NOT NULL,
+        played_at_ms   INTEGER NOT NULL,    -- Unix milliseconds, UTC
+        track_key      INTEGER NOT NULL,
+        context        TEXT,                -- e.g., "playlist", "album"
+        local_hour     INTEGER NOT NULL,    -- 0-23 in LOCAL_TIMEZONE
+        local_weekday  INTEGER NOT NULL,    -- 0=Mon ... 6=Sun in LOCAL_TIMEZONE
+        PRIMARY KEY (user_key, played_at_ms, track_key),
+        FOREIGN KEY (user_key) REFERENCES users(user_key),
+        FOREIGN KEY (track_key) REFERENCES tracks(track_key)
+    ) WITHOUT ROWID;
+
+    -- Read-only view in the shape of the old plays table, for ad-hoc queries and exports
+    CREATE VIEW IF NOT EXISTS plays AS
+    SELECT u.user_id,
+           t.track_id || '::' || strftime('%Y-%m-%dT%H:%M:%S', p.played_at_ms / 1000, 'unixepoch')
+               || printf('.%03dZ', p.played_at_ms % 1000) AS play_id,
+           t.track_id,
+           strftime('%Y-%m-%dT%H:%M:%S', p.played_at_ms / 1000, 'unixepoch')
+               || printf('.%03dZ', p.played_at_ms % 1000) AS played_at,
+           p.context
+    FROM play_events p
+    JOIN users u ON u.user_key = p.user_key
+    JOIN tracks t ON t.track_key = p.track_key;
+
+    -- Latest top-tracks snapshot per user and time range; the clustered key is the ranking
+    CREATE TABLE IF NOT EXISTS top_tracks (
+        user_id     TEXT NOT NULL,
+        time_range  TEXT NOT NULL,       -- "short_term", "medium_term" or "long_term"
+        rank        INTEGER NOT NULL,    -- 1-based position in Spotify's ranking
+        track_id    TEXT NOT NULL,
+        fetched_at  TEXT NOT NULL DEFAULT (datetime('now')),
+        PRIMARY KEY (user_id, time_range, rank),
+        FOREIGN KEY (user_id) REFERENCES users(user_id),
         FOREIGN KEY (track_id) REFERENCES tracks(track_id)
+    ) WITHOUT ROWID;
+
+    CREATE TABLE IF NOT EXISTS sync_state (
+        user_id            TEXT PRIMARY KEY,
+        last_played_at_ms  INTEGER,      -- high-water `played_at` (Unix ms) of synced plays
+        last_synced_at     TEXT          -- UTC timestamp of the last successful sync
+    );
+
+    -- Single-row counter bumped by ETL writes that change shared rows (tracks,
+    -- artists, audio features); read-side caches key on it
+    CREATE TABLE IF NOT EXISTS data_version (
+        id       INTEGER PRIMARY KEY CHECK (id = 1),
+        version  INTEGER NOT NULL
+    );
+    INSERT OR IGNORE INTO data_version (id, version) VALUES (1, 0);
+
+    -- Per-user counter bumped by ETL writes that change one user's rows (plays,
+    -- top tracks), so one user's refresh leaves other users' caches alone
+    CREATE TABLE IF NOT EXISTS user_data_versions (
+        user_id  TEXT PRIMARY KEY,
+        version  INTEGER NOT NULL
+    ) WITHOUT ROWID;
+
+    -- Resumable ETL jobs (history imports, audio-features backfills); see jobs.py
+    CREATE TABLE IF NOT EXISTS jobs (
+        job_id            INTEGER PRIMARY KEY,
+        kind              TEXT NOT NULL,       -- handler name, e.g. "import", "audio_features"
+        job_key           TEXT NOT NULL,       -- identifies the work; one unfinished job per (kind, key)
+        params            TEXT NOT NULL DEFAULT '{}',   -- JSON arguments for the handler
+        status            TEXT NOT NULL DEFAULT 'pending',  -- pending, running, failed, done, cancelled
+        checkpoint        TEXT,                -- JSON resume point, committed with each batch
+        items_done        INTEGER NOT NULL DEFAULT 0,
+        items_total       INTEGER,             -- same unit as items_done; NULL when unknown
+        batches_done      INTEGER NOT NULL DEFAULT 0,
+        attempts          INTEGER NOT NULL DEFAULT 0,
+        owner             TEXT,                -- host:pid:thread running it
+        lease_expires_at  REAL,                -- Unix seconds; renewed by every batch
+        error             TEXT,                -- last failure, cleared on success
+        result            TEXT,                -- JSON returned by the finished handler
+        created_at        REAL NOT NULL,
+        started_at        REAL,
+        finished_at       REAL                 -- set once done or cancelled
+    );
+
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_unfinished ON jobs(kind, job_key) WHERE finished_at IS NULL;
+
+    -- Committed batches of a job; the key makes a batch commit at most once
+    CREATE TABLE IF NOT EXISTS job_batches (
+        job_id        INTEGER NOT NULL,
+        batch_key     TEXT NOT NULL,
+        items         INTEGER NOT NULL,
+        seconds       REAL NOT NULL,       -- wall time from the previous commit (or job start)
+        committed_at  REAL NOT NULL,
+        PRIMARY KEY (job_id, batch_key),
+        FOREIGN KEY (job_id) REFERENCES jobs(job_id) ON DELETE CASCADE
+    ) WITHOUT ROWID;
+
+    -- Cross-process single-flight for background refreshes: one live lease per user
+    CREATE TABLE IF NOT EXISTS refresh_leases (
+        user_id     TEXT PRIMARY KEY,
+        owner       TEXT NOT NULL,     -- host:pid:thread of the refresher holding it
+        expires_at  REAL NOT NULL      -- Unix seconds; an expired lease can be taken over
     );
-    
-    CREATE INDEX IF NOT EXISTS idx_plays_played_at ON plays(played_at);
+
+    -- ---------- Summary tables, maintained by triggers in the writer's transaction ----------
+
+    -- Plays per local weekday x hour (0=Mon ... 6=Sun) for the listening heatmap
+    CREATE TABLE IF NOT EXISTS play_hour_counts (
+        user_id  TEXT NOT NULL,
+        weekday  INTEGER NOT NULL,
+        hour     INTEGER NOT NULL,
+        plays    INTEGER NOT NULL,
+        PRIMARY KEY (user_id, weekday, hour)
+    ) WITHOUT ROWID;
+
+    -- Plays per UTC calendar day
+    CREATE TABLE IF NOT EXISTS play_daily_counts (
+        user_id  TEXT NOT NULL,
+        day      TEXT NOT NULL,      -- YYYY-MM-DD
+        plays    INTEGER NOT NULL,
+        PRIMARY KEY (user_id, day)
+    ) WITHOUT ROWID;
+
+    -- Running danceability/energy/valence sums over a top-tracks snapshot
+    CREATE TABLE IF NOT EXISTS mood_totals (
+        user_id           TEXT NOT NULL,
+        time_range        TEXT NOT NULL,
+        tracks            INTEGER NOT NULL,   -- snapshot tracks that have audio features
+        danceability_sum  REAL NOT NULL,
+        energy_sum        REAL NOT NULL,
+        valence_sum       REAL NOT NULL,
+        PRIMARY KEY (user_id, time_range)
+    ) WITHOUT ROWID;
+
+    CREATE INDEX IF NOT EXISTS idx_top_tracks_track_id ON top_tracks(track_id);
+
+    CREATE TRIGGER IF NOT EXISTS trg_play_events_summary_insert AFTER INSERT ON play_events
+    BEGIN
+        INSERT INTO play_hour_counts (user_id, weekday, hour, plays)
+        SELECT user_id, NEW.local_weekday, NEW.local_hour, 1 FROM users WHERE user_key = NEW.user_key
+        ON CONFLICT (user_id, weekday, hour) DO UPDATE SET plays = plays + 1;
+
+        INSERT INTO play_daily_counts (user_id, day, plays)
+        SELECT user_id, date(NEW.played_at_ms / 1000, 'unixepoch'), 1 FROM users WHERE user_key = NEW.user_key
+        ON CONFLICT (user_id, day) DO UPDATE SET plays = plays + 1;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_play_events_summary_delete AFTER DELETE ON play_events
+    BEGIN
+        UPDATE play_hour_counts SET plays = plays - 1
+        WHERE user_id = (SELECT user_id FROM users WHERE user_key = OLD.user_key)
+          AND weekday = OLD.local_weekday AND hour = OLD.local_hour;
+
+        UPDATE play_daily_counts SET plays = plays - 1
+        WHERE user_id = (SELECT user_id FROM users WHERE user_key = OLD.user_key)
+          AND day = date(OLD.played_at_ms / 1000, 'unixepoch');
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_top_tracks_mood_insert AFTER INSERT ON top_tracks
+    BEGIN
+        INSERT INTO mood_totals (user_id, time_range, tracks, danceability_sum, energy_sum, valence_sum)
+        SELECT NEW.user_id, NEW.time_range, 1, af.danceability, af.energy, af.valence
+        FROM audio_features af
+        WHERE af.track_id = NEW.track_id
+          AND af.danceability IS NOT NULL AND af.energy IS NOT NULL AND af.valence IS NOT NULL
+        ON CONFLICT (user_id, time_range) DO UPDATE SET
+            tracks = tracks + 1,
+            danceability_sum = danceability_sum + excluded.danceability_sum,
+            energy_sum = energy_sum + excluded.energy_sum,
+            valence_sum = valence_sum + excluded.valence_sum;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_top_tracks_mood_delete AFTER DELETE ON top_tracks
+    BEGIN
+        UPDATE mood_totals SET
+            tracks = tracks - 1,
+            danceability_sum = danceability_sum - af.danceability,
+            energy_sum = energy_sum - af.energy,
+            valence_sum = valence_sum - af.valence
+        FROM audio_features af
+        WHERE mood_totals.user_id = OLD.user_id AND mood_totals.time_range = OLD.time_range
+          AND af.track_id = OLD.track_id
+          AND af.danceability IS NOT NULL AND af.energy IS NOT NULL AND af.valence IS NOT NULL;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_audio_features_mood_insert AFTER INSERT ON audio_features
+    WHEN NEW.danceability IS NOT NULL AND NEW.energy IS NOT NULL AND NEW.valence IS NOT NULL
+    BEGIN
+        INSERT INTO mood_totals (user_id, time_range, tracks, danceability_sum, energy_sum, valence_sum)
+        SELECT user_id, time_range, COUNT(*), COUNT(*) * NEW.danceability,
+               COUNT(*) * NEW.energy, COUNT(*) * NEW.valence
+        FROM top_tracks
+        WHERE track_id = NEW.track_id
+        GROUP BY user_id, time_range
+        ON CONFLICT (user_id, time_range) DO UPDATE SET
+            tracks = tracks + excluded.tracks,
+            danceability_sum = danceability_sum + excluded.danceability_sum,
+            energy_sum = energy_sum + excluded.energy_sum,
+            valence_sum = valence_sum + excluded.valence_sum;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_audio_features_mood_update
+    AFTER UPDATE OF danceability, energy, valence ON audio_features
+    BEGIN
+        -- Take the old values out of every snapshot containing the track ...
+        UPDATE mood_totals SET
+            tracks = tracks - tt.n,
+            danceability_sum = danceability_sum - tt.n * OLD.danceability,
+            energy_sum = energy_sum - tt.n * OLD.energy,
+            valence_sum = valence_sum - tt.n * OLD.valence
+        FROM (
+            SELECT user_id, time_range, COUNT(*) AS n FROM top_tracks
+            WHERE track_id = OLD.track_id GROUP BY user_id, time_range
+        ) AS tt
+        WHERE mood_totals.user_id = tt.user_id AND mood_totals.time_range = tt.time_range
+          AND OLD.danceability IS NOT NULL AND OLD.energy IS NOT NULL AND OLD.valence IS NOT NULL;
+
+        -- ... and put the new ones back in
+        INSERT INTO mood_totals (user_id, time_range, tracks, danceability_sum, energy_sum, valence_sum)
+        SELECT user_id, time_range, COUNT(*), COUNT(*) * NEW.danceability,
+               COUNT(*) * NEW.energy, COUNT(*) * NEW.valence
+        FROM top_tracks
+        WHERE track_id = NEW.track_id
+          AND NEW.danceability IS NOT NULL AND NEW.energy IS NOT NULL AND NEW.valence IS NOT NULL
+        GROUP BY user_id, time_range
+        ON CONFLICT (user_id, time_range) DO UPDATE SET
+            tracks = tracks + excluded.tracks,
+            danceability_sum = danceability_sum + excluded.danceability_sum,
+            energy_sum = energy_sum + excluded.energy_sum,
+            valence_sum = valence_sum + excluded.valence_sum;
+    END;
 """
 
+# Bump with every DDL change (and add a migration, even if it only runs the DDL):
+# init_db skips the script entirely when user_version already matches.
+SCHEMA_VERSION = 7
+
+# Owner of rows migrated from the single-user schema. Set SPOTIFY_LEGACY_USER_ID
+# to the Spotify user ID of the original listener before the first start, or
+# hand the rows over later with assign_legacy_data().
+LEGACY_USER_ID = os.getenv("SPOTIFY_LEGACY_USER_ID", "legacy")
+
+
+def _migrate_v1_multi_user(conn):
+    """Single-user -> per-user schema.
+
+    Existing plays are assigned to LEGACY_USER_ID, and the old popularity
+    ordering of ``tracks`` becomes that user's medium_term top-tracks snapshot,
+    so the dashboards keep showing what they showed before. ``tracks.artist_id``
+    becomes TEXT to match ``artists.artist_id``, letting the join use the key.
+    """
+    legacy = LEGACY_USER_ID.replace("'", "''")
+    conn.commit()
+    conn.execute("PRAGMA foreign_keys = OFF;")  # Tables are rebuilt in place
+    try:
+        conn.executescript(f"""
+            BEGIN;
+
+            CREATE TABLE IF NOT EXISTS users (
+                user_id         TEXT PRIMARY KEY,
+                display_name    TEXT,
+                created_at      TEXT NOT NULL DEFAULT (datetime('now'))
+            );
+            INSERT OR IGNORE INTO users (user_id)
+            SELECT '{legacy}' WHERE EXISTS (SELECT 1 FROM tracks);
+
+            CREATE TABLE tracks_v1 (
+                track_id        TEXT PRIMARY KEY,
+                name            TEXT NOT NULL,
+                artist_id       TEXT,
+                album_name      TEXT,
+                release_date    TEXT,
+                duration_ms     INTEGER,
+                popularity      INTEGER,
+                FOREIGN KEY (artist_id) REFERENCES artists(artist_id)
+            );
+            INSERT INTO tracks_v1 SELECT track_id, name, CAST(artist_id AS TEXT), album_name,
+                                         release_date, duration_ms, popularity FROM tracks;
+            DROP TABLE tracks;
+            ALTER TABLE tracks_v1 RENAME TO tracks;
+
+            CREATE TABLE plays_v1 (
+                user_id    TEXT NOT NULL,
+                play_id    TEXT NOT NULL,
+                track_id   TEXT NOT NULL,
+                played_at  TEXT NOT NULL,
+                context    TEXT,
+                PRIMARY KEY (user_id, play_id),
+                FOREIGN KEY (user_id) REFERENCES users(user_id),
+                FOREIGN KEY (track_id) REFERENCES tracks(track_id)
+            );
+            INSERT INTO plays_v1 (user_id, play_id, track_id, played_at, context)
+            SELECT '{legacy}', play_id, track_id, played_at, context FROM plays;
+            DROP TABLE plays;
+            ALTER TABLE plays_v1 RENAME TO plays;
+
+            CREATE TABLE IF NOT EXISTS top_tracks (
+                user_id     TEXT NOT NULL,
+                time_range  TEXT NOT NULL,
+                rank        INTEGER NOT NULL,
+                track_id    TEXT NOT NULL,
+                fetched_at  TEXT NOT NULL DEFAULT (datetime('now')),
+                PRIMARY KEY (user_id, time_range, rank),
+                FOREIGN KEY (user_id) REFERENCES users(user_id),
+                FOREIGN KEY (track_id) REFERENCES tracks(track_id)
+            ) WITHOUT ROWID;
+            INSERT INTO top_tracks (user_id, time_range, rank, track_id)
+            SELECT '{legacy}', 'medium_term',
+                   ROW_NUMBER() OVER (ORDER BY popularity DESC, track_id), track_id
+            FROM tracks;
+
+            PRAGMA user_version = 1;
+            COMMIT;
+        """)
+    except BaseException:
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+    finally:
+        conn.execute("PRAGMA foreign_keys = ON;")
+
+
+def _migrate_v2_summaries(conn):
+    """Add the summary tables; the v4 migration fills them once plays are in play_events."""
+    conn.executescript(DDL)  # Creates the tables and triggers; nothing else changed in v2
+    conn.execute("PRAGMA user_version = 2")
+    conn.commit()
+
+
+def _migrate_v3_genres(conn):
+    """Add genres/artist_genres and fill them from the comma-joined artists.genres column."""
+    conn.executescript(DDL)  # Creates the tables and indexes; nothing else changed in v3
+    sync_artist_genres(conn)
+
+
+def _migrate_v4_play_events(conn):
+    """plays -> play_events with integer surrogate keys and timestamps.
+
+    ``users`` and ``tracks`` are rebuilt with an INTEGER PRIMARY KEY in front
+    of their Spotify IDs (which stay UNIQUE, so every other table's foreign keys
+    still hold). Plays are copied over with their ISO ``played_at`` turned into
+    Unix milliseconds and the local hour/weekday filled in, then the summaries
+    are recomputed from the new table. ``plays`` comes back as a view.
+    """
+    conn.commit()
+    conn.execute("PRAGMA foreign_keys = OFF;")  # Tables are rebuilt in place
+    try:
+        conn.executescript("""
+            BEGIN;
+
+            DROP TRIGGER IF EXISTS trg_plays_summary_insert;
+            DROP TRIGGER IF EXISTS trg_plays_summary_delete;
+            DROP TRIGGER IF EXISTS trg_play_events_summary_insert;
+            DROP TRIGGER IF EXISTS trg_play_events_summary_delete;
+
+            CREATE TABLE users_v4 (
+                user_key        INTEGER PRIMARY KEY,
+                user_id         TEXT NOT NULL UNIQUE,
+                display_name    TEXT,
+                created_at      TEXT NOT NULL DEFAULT (datetime('now'))
+            );
+            INSERT INTO users_v4 (user_id, display_name, created_at)
+            SELECT user_id, display_name, created_at FROM users ORDER BY rowid;
+            DROP TABLE users;
+            ALTER TABLE users_v4 RENAME TO users;
+
+            CREATE TABLE tracks_v4 (
+                track_key       INTEGER PRIMARY KEY,
+                track_id        TEXT NOT NULL UNIQUE,
+                name            TEXT NOT NULL,
+                artist_id       TEXT,
+                album_name      TEXT,
+                release_date    TEXT,
+                duration_ms     INTEGER,
+                popularity      INTEGER,
+                FOREIGN KEY (artist_id) REFERENCES artists(artist_id)
+            );
+            INSERT INTO tracks_v4 (track_id, name, artist_id, album_name, release_date, duration_ms, popularity)
+            SELECT track_id, name, artist_id, album_name, release_date, duration_ms, popularity
+            FROM tracks ORDER BY rowid;
+            DROP TABLE tracks;
+            ALTER TABLE tracks_v4 RENAME TO tracks;
+
+            CREATE TABLE IF NOT EXISTS play_events (
+                user_key       INTEGER NOT NULL,
+                played_at_ms   INTEGER NOT NULL,
+                track_key      INTEGER NOT NULL,
+                context        TEXT,
+                local_hour     INTEGER NOT NULL,
+                local_weekday  INTEGER NOT NULL,
+                PRIMARY KEY (user_key, played_at_ms, track_key),
+                FOREIGN KEY (user_key) REFERENCES users(user_key),
+                FOREIGN KEY (track_key) REFERENCES tracks(track_key)
+            ) WITHOUT ROWID;
+        """)
+        old_plays = conn.execute("""
+            SELECT u.user_key, CAST(round((julianday(p.played_at) - 2440587.5) * 86400000) AS INTEGER),
+                   t.track_key, p.context
+            FROM plays p
+            JOIN users u ON u.user_id = p.user_id
+            JOIN tracks t ON t.track_id = p.track_id
+        """)
+        conn.executemany("""
+            INSERT OR IGNORE INTO play_events (user_key, played_at_ms, track_key, context, local_hour, local_weekday)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, ((*row, *local_hour_weekday(row[1])) for row in old_plays))
+        conn.execute("DROP TABLE plays")
+        rebuild_summaries(conn)
+        conn.execute("PRAGMA user_version = 4")
+        conn.commit()
+    except BaseException:
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+    finally:
+        conn.execute("PRAGMA foreign_keys = ON;")
+
+
+def _migrate_v5_feature_misses(conn):
+    """Add audio_features_misses."""
+    conn.executescript(DDL)  # Creates the table; nothing else changed in v5
+
+
+def _migrate_v6_jobs(conn):
+    """Add jobs/job_batches and carry import_files progress over as import jobs."""
+    conn.executescript(DDL)
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'import_files'").fetchone():
+        conn.execute("""
+            INSERT INTO jobs (kind, job_key, params, status, checkpoint, items_done, items_total,
+                              batches_done, created_at, finished_at)
+            SELECT 'import', user_id || ':' || path,
+                   json_object('path', path, 'user_id', user_id, 'size_bytes', size_bytes),
+                   CASE WHEN completed_at IS NULL THEN 'pending' ELSE 'done' END,
+                   json_object('byte_offset', byte_offset, 'entries', entries, 'plays', plays),
+                   byte_offset, size_bytes, 0, strftime('%s', 'now'),
+                   (julianday(completed_at) - 2440587.5) * 86400.0
+            FROM import_files
+        """)
+        conn.execute("DROP TABLE import_files")
+
+
+def _migrate_v7_user_data_versions(conn):
+    """Add user_data_versions."""
+    conn.executescript(DDL)
+
+
+MIGRATIONS = {
+    1: _migrate_v1_multi_user,
+    2: _migrate_v2_summaries,
+    3: _migrate_v3_genres,
+    4: _migrate_v4_play_events,
+    5: _migrate_v5_feature_misses,
+    6: _migrate_v6_jobs,
+    7: _migrate_v7_user_data_versions,
+}
+
+
 def init_db():
+    """Create the schema, migrating databases written by older versions first.
+
+    A database already at SCHEMA_VERSION costs one PRAGMA read.
+    """
     with get_conn() as conn:
-        conn.executescript(DDL)
\ No newline at end of file
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version == SCHEMA_VERSION:
+            return
+        existing = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name IN ('plays', 'play_events')"
+        ).fetchone()
+        if existing:
+            for target in range(version + 1, SCHEMA_VERSION + 1):
+                MIGRATIONS[target](conn)
+        conn.executescript(DDL)
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+
+def assign_legacy_data(user_id):
+    """Hand rows migrated from the single-user schema over to a real user."""
+    with get_conn() as conn:
+        conn.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
+        conn.execute("""
+            UPDATE OR IGNORE play_events SET user_key = (SELECT user_key FROM users WHERE user_id = ?)
+            WHERE user_key = (SELECT user_key FROM users WHERE user_id = ?)
+        """, (user_id, LEGACY_USER_ID))
+        conn.execute(
+            "DELETE FROM play_events WHERE user_key = (SELECT user_key FROM users WHERE user_id = ?)",
+            (LEGACY_USER_ID,),
+        )
+        for table in ("top_tracks", "sync_state"):
+            conn.execute(f"UPDATE OR IGNORE {table} SET user_id = ? WHERE user_id = ?", (user_id, LEGACY_USER_ID))
+            conn.execute(f"DELETE FROM {table} WHERE user_id = ?", (LEGACY_USER_ID,))
+        conn.execute("DELETE FROM users WHERE user_id = ?", (LEGACY_USER_ID,))
+        rebuild_summaries(conn)
+        bump_data_version(conn)
+
+
+def rebuild_summaries(conn):
+    """Recompute every summary table from the base tables.
+
+    The triggers keep the summaries current on insert and delete; this is for
+    migrations and bulk rewrites such as ``assign_legacy_data``.
+    """
+    conn.execute("DELETE FROM play_hour_counts")
+    conn.execute("""
+        INSERT INTO play_hour_counts (user_id, weekday, hour, plays)
+        SELECT u.user_id, p.local_weekday, p.local_hour, COUNT(*)
+        FROM play_events p
+        JOIN users u ON u.user_key = p.user_key
+        GROUP BY 1, 2, 3
+    """)
+    conn.execute("DELETE FROM play_daily_counts")
+    conn.execute("""
+        INSERT INTO play_daily_counts (user_id, day, plays)
+        SELECT u.user_id, date(p.played_at_ms / 1000, 'unixepoch'), COUNT(*)
+        FROM play_events p
+        JOIN users u ON u.user_key = p.user_key
+        GROUP BY 1, 2
+    """)
+    conn.execute("DELETE FROM mood_totals")
+    conn.execute("""
+        INSERT INTO mood_totals (user_id, time_range, tracks, danceability_sum, energy_sum, valence_sum)
+        SELECT tt.user_id, tt.time_range, COUNT(*), SUM(af.danceability), SUM(af.energy), SUM(af.valence)
+        FROM top_tracks tt
+        JOIN audio_features af ON af.track_id = tt.track_id
+        WHERE af.danceability IS NOT NULL AND af.energy IS NOT NULL AND af.valence IS NOT NULL
+        GROUP BY tt.user_id, tt.time_range
+    """)
+
+
+@lru_cache(maxsize=1 << 16)
+def _local_slot(slot, tz_name):
+    local = datetime.fromtimestamp(slot * 900, ZoneInfo(tz_name))
+    return local.hour, local.weekday()
+
+
+def local_hour_weekday(played_at_ms, tz_name=None):
+    """Hour (0-23) and weekday (0=Mon) of a Unix-ms timestamp in ``tz_name`` (LOCAL_TIMEZONE by default)."""
+    # Zone offsets are whole quarter hours, so one lookup serves a 15-minute slot
+    return _local_slot(played_at_ms // 900_000, tz_name or LOCAL_TIMEZONE)
+
+
+def insert_play_events(conn, plays):
+    """Insert ``(user_id, track_id, played_at_ms, context)`` plays, skipping stored ones.
+
+    The user and track rows must already exist; their surrogate keys are
+    looked up in the same statement.
+
+    Returns:
+        Number of plays inserted (not counting rows touched by the summary triggers).
+    """
+    def rows():
+        for user_id, track_id, played_at_ms, context in plays:
+            yield (played_at_ms, context, *local_hour_weekday(played_at_ms), user_id, track_id)
+
+    return conn.executemany("""
+        INSERT OR IGNORE INTO play_events (user_key, played_at_ms, track_key, context, local_hour, local_weekday)
+        SELECT u.user_key, ?, t.track_key, ?, ?, ?
+        FROM users u, tracks t
+        WHERE u.user_id = ? AND t.track_id = ?
+    """, rows()).rowcount
+
+def sync_artist_genres(conn, artist_ids=None, batch_size=500):
+    """Mirror ``artists.genres`` into ``genres``/``artist_genres``.
+
+    Args:
+        conn: Connection inside the caller's write transaction.
+        artist_ids: Artists to sync; every artist with genres when None.
+    """
+    if artist_ids is None:
+        rows = conn.execute("SELECT artist_id, genres FROM artists WHERE genres IS NOT NULL").fetchall()
+    else:
+        artist_ids = list(artist_ids)
+        rows = []
+        for start in range(0, len(artist_ids), batch_size):
+            batch = artist_ids[start:start + batch_size]
+            rows += conn.execute(
+                f"SELECT artist_id, genres FROM artists WHERE genres IS NOT NULL "
+                f"AND artist_id IN ({','.join('?' * len(batch))})", batch,
+            ).fetchall()
+    pairs = [(artist_id, genre.strip()) for artist_id, genres in rows for genre in genres.split(",") if genre.strip()]
+    conn.executemany("INSERT OR IGNORE INTO genres (name) VALUES (?)", sorted({(genre,) for _, genre in pairs}))
+    conn.executemany("""
+        INSERT OR IGNORE INTO artist_genres (artist_id, genre_id)
+        SELECT ?, genre_id FROM genres WHERE name = ?
+    """, pairs)
+
+def get_data_version(conn):
+    """Current value of the shared data-version counter."""
+    return conn.execute("SELECT version FROM data_version WHERE id = 1").fetchone()[0]
+
+def get_user_data_version(conn, user_id):
+    """Current value of ``user_id``'s data-version counter (0 before their first write)."""
+    row = conn.execute("SELECT version FROM user_data_versions WHERE user_id = ?", (user_id,)).fetchone()
+    return row[0] if row else 0
+
+def bump_data_version(conn, user_id=None):
+    """Advance the shared counter, or ``user_id``'s, inside the caller's write transaction."""
+    if user_id is None:
+        conn.execute("UPDATE data_version SET version = version + 1 WHERE id = 1")
+    else:
+        conn.execute("""
+            INSERT INTO user_data_versions (user_id, version) VALUES (?, 1)
+            ON CONFLICT(user_id) DO UPDATE SET version = version + 1
+        """, (user_id,))
+
+def user_file_key(user_id):
+    """Collision-free, filename-safe stand-in for a user ID in per-user file names."""
+    return hashlib.sha256(user_id.encode("utf-8")).hexdigest()
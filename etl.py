@@ -1,153 +1,912 @@
-def load_top_tracks(sp, time_range="medium_term", limit=50):
+from datetime import datetime
+
+from query_cache import cached_page, cached_query
+from tracing import traced
+
+TIME_RANGES = ("short_term", "medium_term", "long_term")
+ARTISTS_BATCH_SIZE = 50  # Max IDs per sp.artists() call
+AUDIO_FEATURES_BATCH_SIZE = 100  # Max IDs per sp.audio_features() call
+RECENTLY_PLAYED_MAX_PAGES = 100  # Safety stop when following cursor pages
+REFRESH_MAX_WORKERS = 4  # Concurrent Spotify requests during refresh_all()
+BACKFILL_MAX_WORKERS = 4  # Concurrent audio_features requests during backfill_audio_features()
+REJECTED_STATUSES = (400, 404)  # Errors meaning Spotify won't ever return features for an ID
+RECENT_PAGE_SIZE = 50  # Plays per page of df_recent_activity_page
+CONTEXT_TYPES = ("album", "artist", "playlist", "show")  # Spotify context types a play can be filtered on
+
+
+@traced()
+def enrich_artists(sp, artists):
+    """Resolve genres for a set of artists with as few API calls as possible.
+
+    Artists already resolved are skipped; the rest are fetched through the
+    multi-artist endpoint in batches of ``ARTISTS_BATCH_SIZE``. Genres are
+    stored as ``""`` for artists Spotify has none for or doesn't know.
+
+    Args:
+        sp: Authenticated Spotipy client.
+        artists: Mapping of artist_id -> artist name (distinct artists to store).
+
+    Returns:
+        List of (artist_id, name, genres) rows ready for ``_upsert_artists``.
+    """
+    from db import get_read_conn
+    from spotify_client import call_with_backoff
+
+    # Placeholder artists from history imports have no Spotify ID to look up
+    artist_ids = [artist_id for artist_id in artists if artist_id and not artist_id.startswith("import:")]
+    if not artist_ids:
+        return []
+
+    with get_read_conn() as conn:
+        placeholders = ", ".join("?" for _ in artist_ids)
+        known = {
+            row[0] for row in conn.execute(
+                f"SELECT artist_id FROM artists WHERE genres IS NOT NULL AND artist_id IN ({placeholders})",
+                artist_ids,
+            )
+        }
+
+    missing = [artist_id for artist_id in artist_ids if artist_id not in known]
+    genres_by_id = {}
+    for start in range(0, len(missing), ARTISTS_BATCH_SIZE):
+        batch = missing[start:start + ARTISTS_BATCH_SIZE]
+        for artist in call_with_backoff(sp.artists, batch).get("artists", []):
+            if artist:
+                genres_by_id[artist["id"]] = ", ".join(artist.get("genres", []))
+
+    rows = []
+    for artist_id in artist_ids:
+        if artist_id in known:
+            continue
+        # Unknown IDs come back as null: store them as resolved with no genres so they aren't refetched
+        rows.append((artist_id, artists[artist_id], genres_by_id.get(artist_id, "")))
+    return rows
+
+
+def _feature_row(af):
+    return (
+        af["id"], af["danceability"], af["energy"], af["key"], af["loudness"],
+        af["mode"], af["speechiness"], af["acousticness"], af["instrumentalness"],
+        af["liveness"], af["valence"], af["tempo"]
+    )
+
+
+@traced()
+def fetch_audio_features(sp, track_ids):
+    """Fetch audio features in chunks of ``AUDIO_FEATURES_BATCH_SIZE``.
+
+    Returns:
+        List of audio_features rows (tracks without features are skipped).
+    """
+    from spotify_client import call_with_backoff
+
+    audio_features_data = []
+    for start in range(0, len(track_ids), AUDIO_FEATURES_BATCH_SIZE):
+        batch = track_ids[start:start + AUDIO_FEATURES_BATCH_SIZE]
+        for af in call_with_backoff(sp.audio_features, tracks=batch) or []:
+            if af:  # Ensure audio features were returned
+                audio_features_data.append(_feature_row(af))
+    return audio_features_data
+
+
+def tracks_without_features(track_ids, batch_size=500):
+    """The IDs in ``track_ids`` with neither stored audio features nor a recorded miss."""
+    from db import get_read_conn
+
+    track_ids = list(dict.fromkeys(track_ids))
+    known = set()
+    with get_read_conn() as conn:
+        for start in range(0, len(track_ids), batch_size):
+            batch = track_ids[start:start + batch_size]
+            marks = ",".join("?" * len(batch))
+            known.update(row[0] for row in conn.execute(
+                f"SELECT track_id FROM audio_features WHERE track_id IN ({marks}) "
+                f"UNION ALL SELECT track_id FROM audio_features_misses WHERE track_id IN ({marks})",
+                batch + batch,
+            ))
+    return [track_id for track_id in track_ids if track_id not in known]
+
+
+def _fetch_features_chunk(sp, track_ids):
+    """Fetch one chunk of features, returning ``(rows, misses)``.
+
+    Spotify answers null for tracks it has no features for; those are misses.
+    A chunk rejected outright (e.g. one malformed ID fails the whole request)
+    is split in half until the bad IDs are isolated and recorded as misses.
+    Any other error propagates and leaves the chunk for the next run.
+    """
+    from spotify_client import call_with_backoff
+    from spotipy.exceptions import SpotifyException
+
+    try:
+        features = call_with_backoff(sp.audio_features, tracks=track_ids) or []
+    except SpotifyException as e:
+        if e.http_status not in REJECTED_STATUSES:
+            raise
+        if len(track_ids) == 1:
+            return [], list(track_ids)
+        mid = len(track_ids) // 2
+        head_rows, head_misses = _fetch_features_chunk(sp, track_ids[:mid])
+        tail_rows, tail_misses = _fetch_features_chunk(sp, track_ids[mid:])
+        return head_rows + tail_rows, head_misses + tail_misses
+    rows = [_feature_row(af) for af in features if af]
+    found = {row[0] for row in rows}
+    return rows, [track_id for track_id in track_ids if track_id not in found]
+
+
+def _missing_feature_chunks(chunk_size, after=0, max_tracks=None):
+    """Yield ``(last_track_key, track_ids)`` chunks of stored tracks still lacking features.
+
+    Tracks come in track_key order, starting after ``after``. Each chunk is its
+    own keyset query, so the scan is never held open across the writes the
+    backfill makes between chunks.
+    """
+    from db import get_read_conn
+
+    remaining = max_tracks
+    while remaining is None or remaining > 0:
+        size = chunk_size if remaining is None else min(chunk_size, remaining)
+        with get_read_conn() as conn:
+            rows = conn.execute("""
+                SELECT t.track_key, t.track_id FROM tracks t
+                WHERE t.track_key > ?
+                  AND NOT EXISTS (SELECT 1 FROM audio_features af WHERE af.track_id = t.track_id)
+                  AND NOT EXISTS (SELECT 1 FROM audio_features_misses m WHERE m.track_id = t.track_id)
+                ORDER BY t.track_key
+                LIMIT ?
+            """, (after, size)).fetchall()
+        if not rows:
+            return
+        after = rows[-1][0]
+        if remaining is not None:
+            remaining -= len(rows)
+        yield after, [track_id for _, track_id in rows]
+
+
+def _count_missing_features():
+    from db import get_read_conn
+
+    with get_read_conn() as conn:
+        return conn.execute("""
+            SELECT COUNT(*) FROM tracks t
+            WHERE NOT EXISTS (SELECT 1 FROM audio_features af WHERE af.track_id = t.track_id)
+              AND NOT EXISTS (SELECT 1 FROM audio_features_misses m WHERE m.track_id = t.track_id)
+        """).fetchone()[0]
+
+
+def _write_features(conn, rows, misses):
+    """Store one chunk's features and misses on ``conn``; returns the number of feature rows."""
+    from db import bump_data_version
+
+    changes_before = conn.total_changes
+    cursor = conn.cursor()
+    _upsert_audio_features(cursor, rows)
+    _record_feature_misses(cursor, misses)
+    if conn.total_changes != changes_before:
+        bump_data_version(conn)
+    return len(rows)
+
+
+@traced()
+def backfill_audio_features(sp, max_workers=BACKFILL_MAX_WORKERS, chunk_size=AUDIO_FEATURES_BATCH_SIZE,
+                            max_tracks=None):
+    """Fetch audio features for every stored track that has none yet.
+
+    Tracks are found in the database (e.g. ones loaded from recently played
+    or a history import), requested in chunks of up to ``chunk_size`` with
+    at most ``max_workers`` requests in flight, and each chunk is committed by
+    the calling thread together with the job's checkpoint (see ``jobs``).
+    Tracks Spotify has no features for are recorded in ``audio_features_misses``
+    and not requested again, so a run costs one call per ``chunk_size`` tracks
+    still missing. A run that dies midway is resumed from its last committed
+    chunk by the next call, in this process or another.
+
+    A chunk that fails (after ``call_with_backoff``'s retries) is skipped and
+    picked up by the next run; the other chunks are unaffected.
+
+    Args:
+        sp: Authenticated Spotipy client.
+        max_workers: Upper bound on concurrent Spotify requests.
+        chunk_size: IDs per request (max 100 per Spotify API).
+        max_tracks: Stop after this many tracks; all of them when None.
+
+    Returns:
+        Dict with ``requested``, ``stored`` and ``missed`` track counts and
+        ``failed`` chunk count for this call; all zero when another process is
+        already running the backfill.
+    """
+    import jobs
+
+    job_id = jobs.submit("audio_features", "library", {"chunk_size": chunk_size, "max_tracks": max_tracks})
+    stats = jobs.run(job_id, sp=sp, max_workers=max_workers)
+    return stats if stats is not None else {"requested": 0, "stored": 0, "missed": 0, "failed": 0}
+
+
+def _backfill_job(job, sp, max_workers=BACKFILL_MAX_WORKERS):
+    """``jobs`` handler behind ``backfill_audio_features``.
+
+    The checkpoint is the highest track_key below which every chunk has
+    been committed (or has failed). Chunks finish out of order, so a chunk
+    is committed as soon as it arrives but the checkpoint only moves past
+    the chunks submitted before it once those are in too.
+    """
+    from collections import deque
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+    chunk_size = job.params.get("chunk_size", AUDIO_FEATURES_BATCH_SIZE)
+    max_tracks = job.params.get("max_tracks")
+    if job.items_total is None:
+        missing = _count_missing_features()
+        job.set_total(missing if max_tracks is None else min(missing, max_tracks))
+    if max_tracks is not None:
+        max_tracks = max(0, max_tracks - job.items_done)
+
+    stats = {"requested": 0, "stored": 0, "missed": 0, "failed": 0}
+    checkpoint = (job.checkpoint or {}).get("after_key", 0)
+    in_order = deque()  # [last_track_key, finished] per chunk, in submission order
+    chunks = {}  # future -> its in_order entry and track IDs
+
+    def drain(futures):
+        nonlocal checkpoint
+        for future in futures:
+            entry, track_ids = chunks.pop(future)
+            entry[1] = True
+            while in_order and in_order[0][1]:
+                checkpoint = in_order.popleft()[0]
+            try:
+                rows, misses = future.result()
+            except Exception:
+                stats["failed"] += 1
+                continue
+            job.commit_batch(entry[0], lambda conn: _write_features(conn, rows, misses),
+                             {"after_key": checkpoint}, len(track_ids))
+            stats["stored"] += len(rows)
+            stats["missed"] += len(misses)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = set()
+        for last_key, chunk in _missing_feature_chunks(chunk_size, checkpoint, max_tracks):
+            stats["requested"] += len(chunk)
+            future = pool.submit(_fetch_features_chunk, sp, chunk)
+            entry = [last_key, False]
+            in_order.append(entry)
+            chunks[future] = (entry, chunk)
+            pending.add(future)
+            if len(pending) >= max_workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                drain(done)
+        drain(pending)
+    return stats
+
+
+def _track_row(track):
+    """Flatten a Spotify track object into a ``tracks`` row plus its primary artist."""
+    artist = track["artists"][0]  # Primary artist
+    row = (
+        track["id"], track["name"], artist["id"], track["album"]["name"],
+        track["album"]["release_date"], track["duration_ms"], track["popularity"],
+    )
+    return row, artist["id"], artist["name"]
+
+
+def _played_at_ms(played_at):
+    """Convert an ISO8601 ``played_at`` timestamp to Unix milliseconds."""
+    return round(datetime.fromisoformat(played_at.replace("Z", "+00:00")).timestamp() * 1000)
+
+
+def _upsert_audio_features(cursor, audio_features_data):
+    """Insert or update feature rows (an upsert, so the mood_totals update trigger sees old and new values)."""
+    cursor.executemany("""
+        INSERT INTO audio_features (
+            track_id, danceability, energy, key, loudness, mode, speechiness,
+            acousticness, instrumentalness, liveness, valence, tempo
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(track_id) DO UPDATE SET
+            danceability = excluded.danceability, energy = excluded.energy, key = excluded.key,
+            loudness = excluded.loudness, mode = excluded.mode, speechiness = excluded.speechiness,
+            acousticness = excluded.acousticness, instrumentalness = excluded.instrumentalness,
+            liveness = excluded.liveness, valence = excluded.valence, tempo = excluded.tempo
+    """, audio_features_data)
+
+
+def _record_feature_misses(cursor, track_ids):
+    """Remember tracks Spotify returned no features for, so they aren't requested again."""
+    cursor.executemany(
+        "INSERT OR IGNORE INTO audio_features_misses (track_id) VALUES (?)", [(t,) for t in track_ids]
+    )
+
+
+def _upsert_artists(cursor, artist_rows):
+    """Insert artists, filling in genres for rows stored without them, and map their genre IDs."""
+    from db import sync_artist_genres
+
+    cursor.executemany("""
+        INSERT INTO artists (artist_id, name, genres) VALUES (?, ?, ?)
+        ON CONFLICT(artist_id) DO UPDATE SET genres = excluded.genres
+        WHERE artists.genres IS NULL
+    """, artist_rows)
+    sync_artist_genres(cursor.connection, [row[0] for row in artist_rows if row[2]])
+
+
+@traced()
+def _write_batch(cursor, user_id, artist_rows=(), tracks_data=(), audio_features_data=(),
+                 plays_data=(), top_tracks=None, feature_misses=()):
+    """Write one load's rows in dependency order (artists -> tracks -> features/plays).
+
+    ``top_tracks`` maps time_range -> track IDs in rank order; each listed
+    range replaces the user's previous snapshot for that range.
+    ``feature_misses`` are track IDs Spotify returned no audio features for.
+
+    Bumps the shared data version when tracks, artists or features changed and
+    the user's when their plays or top tracks did, which invalidates cached
+    ``df_*`` results once the surrounding transaction commits. A top-tracks
+    snapshot identical to the stored one is left as is, so a refresh that
+    brings nothing new changes no version.
+    """
+    from db import bump_data_version, insert_play_events
+
+    conn = cursor.connection
+    changes_before = conn.total_changes
+
+    # Insert artists
+    _upsert_artists(cursor, artist_rows)
+
+    # Insert tracks, replacing stubs written by a history import with the API's metadata
+    cursor.executemany("""
+        INSERT INTO tracks (track_id, name, artist_id, album_name, release_date, duration_ms, popularity)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(track_id) DO UPDATE SET
+            name = excluded.name, artist_id = excluded.artist_id, album_name = excluded.album_name,
+            release_date = excluded.release_date, duration_ms = excluded.duration_ms,
+            popularity = excluded.popularity
+        WHERE tracks.artist_id LIKE 'import:%'
+    """, tracks_data)
+
+    # Insert audio features and remember the tracks that have none
+    _upsert_audio_features(cursor, audio_features_data)
+    _record_feature_misses(cursor, feature_misses)
+
+    shared_changed = conn.total_changes != changes_before
+    changes_before = conn.total_changes
+
+    cursor.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
+
+    # Insert plays
+    insert_play_events(conn, plays_data)
+
+    # Replace top-tracks snapshots that differ from the stored ones
+    for time_range, track_ids in (top_tracks or {}).items():
+        stored = [row[0] for row in cursor.execute(
+            "SELECT track_id FROM top_tracks WHERE user_id = ? AND time_range = ? ORDER BY rank",
+            (user_id, time_range),
+        )]
+        if stored == list(track_ids):
+            continue
+        cursor.execute("DELETE FROM top_tracks WHERE user_id = ? AND time_range = ?", (user_id, time_range))
+        cursor.executemany("""
+            INSERT INTO top_tracks (user_id, time_range, rank, track_id) VALUES (?, ?, ?, ?)
+        """, [(user_id, time_range, rank, track_id) for rank, track_id in enumerate(track_ids, start=1)])
+
+    if shared_changed:
+        bump_data_version(conn)
+    if conn.total_changes != changes_before:
+        bump_data_version(conn, user_id)
+
+
+def _mark_synced(cursor, user_id, high_water_ms):
+    """Record a finished sync, moving the high-water mark forward only."""
+    cursor.execute("""
+        INSERT INTO sync_state (user_id, last_played_at_ms, last_synced_at)
+        VALUES (?, ?, datetime('now'))
+        ON CONFLICT(user_id) DO UPDATE SET
+            last_played_at_ms = MAX(
+                COALESCE(sync_state.last_played_at_ms, excluded.last_played_at_ms),
+                COALESCE(excluded.last_played_at_ms, sync_state.last_played_at_ms)
+            ),
+            last_synced_at = excluded.last_synced_at
+    """, (user_id, high_water_ms))
+
+
+def _sync_cursor(user_id):
+    """Return the stored recently-played high-water mark (Unix ms) for a user."""
+    from db import get_read_conn
+
+    with get_read_conn() as conn:
+        row = conn.execute(
+            "SELECT last_played_at_ms FROM sync_state WHERE user_id = ?", (user_id,)
+        ).fetchone()
+    return row[0] if row else None
+
+
+def sync_status(user_id):
+    """Return ``{"last_synced_at", "last_played_at_ms"}`` for a user (None values if never synced)."""
+    from db import get_read_conn
+
+    with get_read_conn() as conn:
+        row = conn.execute(
+            "SELECT last_synced_at, last_played_at_ms FROM sync_state WHERE user_id = ?", (user_id,)
+        ).fetchone()
+    return {"last_synced_at": row[0] if row else None, "last_played_at_ms": row[1] if row else None}
+
+
+@traced()
+def _fetch_top_tracks(sp, time_range, limit):
+    from spotify_client import call_with_backoff
+
+    results = call_with_backoff(sp.current_user_top_tracks, time_range=time_range, limit=limit)
+    return results.get("items", [])
+
+
+@traced()
+def _fetch_recently_played(sp, cursor_ms, limit):
+    """Fetch plays after ``cursor_ms``, following cursor pages until caught up.
+
+    Without a cursor (a user's first sync) the pages run backwards from the
+    newest play through everything the API still exposes. Either way at most
+    ``RECENTLY_PLAYED_MAX_PAGES`` pages of ``limit`` plays are fetched.
+    """
+    from spotify_client import call_with_backoff
+
+    items = []
+    results = call_with_backoff(sp.current_user_recently_played, limit=limit, after=cursor_ms)
+    pages = 1
+    while results:
+        items.extend(results.get("items", []))
+        if not results.get("next") or pages >= RECENTLY_PLAYED_MAX_PAGES:
+            break
+        results = call_with_backoff(sp.next, results)
+        pages += 1
+    return items
+
+
+def _current_user_id(sp):
+    from spotify_client import call_with_backoff
+
+    return call_with_backoff(sp.current_user)["id"]
+
+
+def _parse_plays(items, cursor_ms, user_id):
+    """Split recently-played items into plays/tracks/artists, dropping already-synced plays.
+
+    Returns:
+        (plays_data, tracks_data, artists_data, high_water_ms)
+    """
+    plays_data = []
+    tracks_data = []
+    artists_data = {}
+    high_water = None
+
+    for item in items:
+        played_at_ms = _played_at_ms(item["played_at"])
+        if cursor_ms is not None and played_at_ms <= cursor_ms:
+            continue  # Already synced
+        high_water = max(high_water or played_at_ms, played_at_ms)
+
+        track_row, artist_id, artist_name = _track_row(item["track"])
+        track_id = track_row[0]
+        context = (item.get("context") or {}).get("type")  # e.g., "playlist", "album"
+
+        plays_data.append((user_id, track_id, played_at_ms, context))
+        tracks_data.append(track_row)
+        artists_data.setdefault(artist_id, artist_name)
+
+    return plays_data, tracks_data, artists_data, high_water
+
+
+@traced()
+def load_top_tracks(sp, time_range="medium_term", limit=50, user_id=None):
     """Load user's top tracks and their audio features into the DB.
 
     Args:
         sp: Authenticated Spotipy client.
         time_range: One of "short_term" (4 weeks), "medium_term" (6 months), or "long_term" (several years).
         limit: Number of top tracks to fetch (max 50 per Spotify API).
+        user_id: Spotify user ID; looked up via ``sp.current_user()`` if omitted.
 
     Returns:
         Number of tracks loaded.
     """
     from db import get_conn
 
-    results = sp.current_user_top_tracks(time_range=time_range, limit=limit)
-    items = results.get("items", [])
+    if user_id is None:
+        user_id = _current_user_id(sp)
+
+    items = _fetch_top_tracks(sp, time_range, limit)
     if not items:
         return 0
 
     tracks_data = []
     artists_data = {}
-    audio_features_data = []
 
     for item in items:
-        track_id = item["id"]
-        track_name = item["name"]
-        artist = item["artists"][0]  # Primary artist
-        artist_id = artist["id"]
-        artist_name = artist["name"]
-        genres = ", ".join(sp.artist(artist_id).get("genres", []))  # Fetch genres
-        album_name = item["album"]["name"]
-        release_date = item["album"]["release_date"]
-        duration_ms = item["duration_ms"]
-        popularity = item["popularity"]
-
-        tracks_data.append((track_id, track_name, artist_id, album_name, release_date, duration_ms, popularity))
-        if artist_id not in artists_data:
-            artists_data[artist_id] = (artist_id, artist_name, genres)
-
-    # Fetch audio features in bulk
-    track_ids = [item["id"] for item in items]
-    audio_features_list = sp.audio_features(tracks=track_ids)
-    for af in audio_features_list:
-        if af:  # Ensure audio features were returned
-            audio_features_data.append((
-                af["id"], af["danceability"], af["energy"], af["key"], af["loudness"],
-                af["mode"], af["speechiness"], af["acousticness"], af["instrumentalness"],
-                af["liveness"], af["valence"], af["tempo"]
-            ))
+        track_row, artist_id, artist_name = _track_row(item)
+        tracks_data.append(track_row)
+        artists_data.setdefault(artist_id, artist_name)
+
+    # Fetch genres only for artists we haven't resolved yet
+    artist_rows = enrich_artists(sp, artists_data)
+
+    # Fetch audio features in bulk, only for tracks not looked up before
+    wanted = tracks_without_features(row[0] for row in tracks_data)
+    audio_features_data = fetch_audio_features(sp, wanted)
+    found = {row[0] for row in audio_features_data}
 
     with get_conn() as conn:
-        cursor = conn.cursor()
+        _write_batch(
+            conn.cursor(), user_id, artist_rows, tracks_data, audio_features_data,
+            top_tracks={time_range: [row[0] for row in tracks_data]},
+            feature_misses=[track_id for track_id in wanted if track_id not in found],
+        )
 
-        # Insert artists
-        cursor.executemany("""
-            INSERT OR IGNORE INTO artists (artist_id, name, genres) VALUES (?, ?, ?)
-        """, artists_data.values())
+    return len(tracks_data)
 
 
-def load_recently_played(sp, limit=50):
+@traced()
+def load_recently_played(sp, limit=50, user_id=None):
     """Load user's recently played tracks into the DB.
 
+    Only plays newer than the stored high-water mark in ``sync_state`` are
+    requested, following the API's cursor pages until caught up. The first
+    sync for a user follows the pages back through every play the API still
+    exposes (see ``_fetch_recently_played``).
+
     Args:
         sp: Authenticated Spotipy client.
-        limit: Number of recent plays to fetch (max 50 per Spotify API).
+        limit: Number of recent plays per page (max 50 per Spotify API).
+        user_id: Spotify user ID; looked up via ``sp.current_user()`` if omitted.
 
     Returns:
         Number of plays loaded.
     """
     from db import get_conn
 
-    results = sp.current_user_recently_played(limit=limit)
-    items = results.get("items", [])
-    if not items:
-        return 0
+    if user_id is None:
+        user_id = _current_user_id(sp)
 
-    plays_data = []
-    tracks_data = []
-    artists_data = {}
+    cursor_ms = _sync_cursor(user_id)
+    items = _fetch_recently_played(sp, cursor_ms, limit)
+    plays_data, tracks_data, artists_data, high_water = _parse_plays(items, cursor_ms, user_id)
 
-    for item in items:
-        track = item["track"]
-        track_id = track["id"]
-        track_name = track["name"]
-        artist = track["artists"][0]  # Primary artist
-        artist_id = artist["id"]
-        artist_name = artist["name"]
-        album_name = track["album"]["name"]
-        release_date = track["album"]["release_date"]
-        duration_ms = track["duration_ms"]
-        popularity = track["popularity"]
-        played_at = item["played_at"]
-        context = item.get("context", {}).get("type", None)  # e.g., "playlist", "album"
-
-        play_id = f"{track_id}::{played_at}"
-        plays_data.append((play_id, track_id, played_at, context))
-        tracks_data.append((track_id, track_name, artist_id, album_name, release_date, duration_ms, popularity))
-        if artist_id not in artists_data:
-            genres = ", ".join(sp.artist(artist_id).get("genres", []))  # Fetch genres
-            artists_data[artist_id] = (artist_id, artist_name, genres)
+    # Fetch genres only for artists we haven't resolved yet
+    artist_rows = enrich_artists(sp, artists_data)
 
     with get_conn() as conn:
         cursor = conn.cursor()
+        _write_batch(cursor, user_id, artist_rows, tracks_data, plays_data=plays_data)
 
-        # Insert artists
-        cursor.executemany("""
-            INSERT OR IGNORE INTO artists (artist_id, name, genres) VALUES (?, ?, ?)
-        """, artists_data.values())
+        # Advance the cursor in the same transaction as the plays
+        _mark_synced(cursor, user_id, high_water)
 
-        # Insert tracks
-        cursor.executemany("""
-            INSERT OR IGNORE INTO tracks (track_id, name, artist_id, album_name, release_date, duration_ms, popularity)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, tracks_data)
+    return len(plays_data)
 
-        # Insert plays
-        cursor.executemany("""
-            INSERT OR IGNORE INTO plays (play_id, track_id, played_at, context) VALUES (?, ?, ?, ?)
-        """, plays_data)
 
+@traced()
+def refresh_all(sp, user_id=None, limit=50, max_workers=REFRESH_MAX_WORKERS):
+    """Refresh top tracks (every time range) and recent plays concurrently.
 
-def df_top_tracks():
-    """Fetch top tracks with audio features as a DataFrame."""
-    import pandas as pd
+    The four fetches run in a bounded thread pool, artist genres and audio
+    features for the combined result are resolved in one shared phase (only
+    for artists and tracks not looked up before), and
+    everything is written by the calling thread in a single transaction, so
+    SQLite only ever sees one writer.
+
+    Args:
+        sp: Authenticated Spotipy client.
+        user_id: Spotify user ID; looked up via ``sp.current_user()`` if omitted.
+        limit: Page size for each fetch (max 50 per Spotify API).
+        max_workers: Upper bound on concurrent Spotify requests.
+
+    Returns:
+        Dict with the number of top tracks per time range and plays loaded.
+    """
+    from concurrent.futures import ThreadPoolExecutor
     from db import get_conn
 
+    if user_id is None:
+        user_id = _current_user_id(sp)
+    cursor_ms = _sync_cursor(user_id)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        # Fetch phase: every request chain runs at once
+        top_futures = {
+            time_range: pool.submit(_fetch_top_tracks, sp, time_range, limit)
+            for time_range in TIME_RANGES
+        }
+        recent_future = pool.submit(_fetch_recently_played, sp, cursor_ms, limit)
+        top_items = {time_range: future.result() for time_range, future in top_futures.items()}
+        recent_items = recent_future.result()
+
+        plays_data, tracks_data, artists_data, high_water = _parse_plays(recent_items, cursor_ms, user_id)
+        tracks_by_id = {row[0]: row for row in tracks_data}
+        for items in top_items.values():
+            for item in items:
+                track_row, artist_id, artist_name = _track_row(item)
+                tracks_by_id[track_row[0]] = track_row
+                artists_data.setdefault(artist_id, artist_name)
+
+        # Enrichment phase: one pass over the combined artists and tracks
+        artists_future = pool.submit(enrich_artists, sp, artists_data)
+        wanted = tracks_without_features(tracks_by_id)
+        features_future = pool.submit(fetch_audio_features, sp, wanted)
+        artist_rows = artists_future.result()
+        audio_features_data = features_future.result()
+        found = {row[0] for row in audio_features_data}
+
+    # Write phase: a single writer and a single transaction
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        _write_batch(
+            cursor, user_id, artist_rows, list(tracks_by_id.values()), audio_features_data, plays_data,
+            top_tracks={
+                time_range: [_track_row(item)[0][0] for item in items]
+                for time_range, items in top_items.items()
+            },
+            feature_misses=[track_id for track_id in wanted if track_id not in found],
+        )
+        _mark_synced(cursor, user_id, high_water)
+
+    summary = {time_range: len(items) for time_range, items in top_items.items()}
+    summary["plays"] = len(plays_data)
+    return summary
+
+
+@cached_query
+@traced()
+def df_top_tracks(user_id, time_range="medium_term"):
+    """Fetch a user's top tracks for a time range, with audio features, as a DataFrame."""
+    import pandas as pd
+    from db import get_read_conn
+
     query = """
-        SELECT t.track_id, t.name AS track_name, a.name AS artist_name, t.album_name,
+        SELECT tt.rank, t.track_id, t.name AS track_name, a.name AS artist_name, t.album_name,
                t.release_date, t.duration_ms, t.popularity,
                af.danceability, af.energy, af.valence
-        FROM tracks t
+        FROM top_tracks tt
+        JOIN tracks t ON tt.track_id = t.track_id
         JOIN artists a ON t.artist_id = a.artist_id
         LEFT JOIN audio_features af ON t.track_id = af.track_id
-        ORDER BY t.popularity DESC
+        WHERE tt.user_id = ? AND tt.time_range = ?
+        ORDER BY tt.rank
     """
-    with get_conn() as conn:
-        df = pd.read_sql_query(query, conn)
+    with get_read_conn() as conn:
+        df = pd.read_sql_query(query, conn, params=(user_id, time_range))
     return df
 
-def df_recent_activity():
-    """Fetch recent plays as a DataFrame."""
+
+@cached_query
+@traced()
+def df_recent_activity(user_id):
+    """Fetch a user's whole play history as a DataFrame, newest first.
+
+    Cost grows with the history; the dashboard pages through
+    ``df_recent_activity_page`` instead.
+    """
     import pandas as pd
-    from db import get_conn
+    from db import get_read_conn
 
     query = """
-        SELECT p.play_id, t.name AS track_name, a.name AS artist_name, p.played_at, p.context
-        FROM plays p
-        JOIN tracks t ON p.track_id = t.track_id
+        SELECT t.track_id || '::' || p.played_at AS play_id, t.name AS track_name, a.name AS artist_name,
+               p.played_at, p.context
+        FROM (
+            SELECT played_at_ms, track_key, context,
+                   strftime('%Y-%m-%dT%H:%M:%S', played_at_ms / 1000, 'unixepoch')
+                       || printf('.%03dZ', played_at_ms % 1000) AS played_at
+            FROM play_events
+            WHERE user_key = (SELECT user_key FROM users WHERE user_id = ?)
+        ) p
+        JOIN tracks t ON p.track_key = t.track_key
         JOIN artists a ON t.artist_id = a.artist_id
-        ORDER BY p.played_at DESC
+        ORDER BY p.played_at_ms DESC
     """
-    with get_conn() as conn:
+    with get_read_conn() as conn:
+        df = pd.read_sql_query(query, conn, params=(user_id,))
+    return df
+
+
+@cached_page
+@traced()
+def df_recent_activity_page(user_id, before=None, limit=RECENT_PAGE_SIZE, artist=None, context=None,
+                            start_ms=None, end_ms=None):
+    """Fetch one page of a user's plays, newest first, with filters applied in SQL.
+
+    Pages are keyset-paginated on the ``play_events`` primary key, so each one
+    is a bounded range scan no matter how deep into the history it is, and
+    pages stay stable while new plays arrive.
+
+    Args:
+        user_id: Spotify user ID.
+        before: Cursor returned with the previous page; None for the newest plays.
+        limit: Plays per page.
+        artist: Keep plays whose artist name contains this text (ASCII case-insensitive).
+        context: Keep plays started from this context type, one of CONTEXT_TYPES.
+        start_ms: Keep plays at or after this Unix-ms time.
+        end_ms: Keep plays before this Unix-ms time.
+
+    Returns:
+        ``(df, next_cursor)``: the page with the ``df_recent_activity`` columns,
+        and the cursor of the following page (None on the last page).
+    """
+    import pandas as pd
+    from db import get_read_conn
+
+    filters, params = [], [user_id]
+    if before is not None:
+        filters.append("(p.played_at_ms, p.track_key) < (?, ?)")
+        params += before
+    if start_ms is not None:
+        filters.append("p.played_at_ms >= ?")
+        params.append(start_ms)
+    if end_ms is not None:
+        filters.append("p.played_at_ms < ?")
+        params.append(end_ms)
+    if context is not None:
+        filters.append("p.context = ?")
+        params.append(context)
+    if artist:
+        escaped = artist.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        filters.append("a.name LIKE ? ESCAPE '\\'")
+        params.append(f"%{escaped}%")
+    query = f"""
+        SELECT t.track_id || '::' || p.played_at AS play_id, t.name AS track_name, a.name AS artist_name,
+               p.played_at, p.context, p.played_at_ms, p.track_key
+        FROM (
+            SELECT played_at_ms, track_key, context,
+                   strftime('%Y-%m-%dT%H:%M:%S', played_at_ms / 1000, 'unixepoch')
+                       || printf('.%03dZ', played_at_ms % 1000) AS played_at
+            FROM play_events
+            WHERE user_key = (SELECT user_key FROM users WHERE user_id = ?)
+        ) p
+        JOIN tracks t ON p.track_key = t.track_key
+        JOIN artists a ON t.artist_id = a.artist_id
+        {"WHERE " + " AND ".join(filters) if filters else ""}
+        ORDER BY p.played_at_ms DESC, p.track_key DESC
+        LIMIT ?
+    """
+    params.append(limit + 1)  # One extra row tells whether another page follows
+    with get_read_conn() as conn:
+        df = pd.read_sql_query(query, conn, params=params)
+    next_cursor = None
+    if len(df) > limit:
+        df = df.iloc[:limit]
+        last = df.iloc[-1]
+        next_cursor = (int(last["played_at_ms"]), int(last["track_key"]))
+    return df.drop(columns=["played_at_ms", "track_key"]), next_cursor
+
+
+@cached_query
+@traced()
+def df_listening_heatmap(user_id):
+    """Plays per weekday (rows, 0=Mon) and hour (cols, 0-23) as a full 7x24 DataFrame."""
+    import pandas as pd
+    from db import get_read_conn
+
+    query = "SELECT weekday, hour, plays FROM play_hour_counts WHERE user_id = ? AND plays > 0"
+    with get_read_conn() as conn:
+        df = pd.read_sql_query(query, conn, params=(user_id,))
+    pivot = df.pivot(index="weekday", columns="hour", values="plays")
+    pivot = pivot.reindex(index=range(7), columns=range(24)).fillna(0).astype(int)
+    return pivot.rename_axis(index="weekday", columns="hour")
+
+
+@cached_query
+@traced()
+def df_daily_plays(user_id):
+    """Plays per UTC day as a DataFrame."""
+    import pandas as pd
+    from db import get_read_conn
+
+    query = "SELECT day, plays FROM play_daily_counts WHERE user_id = ? AND plays > 0 ORDER BY day"
+    with get_read_conn() as conn:
+        df = pd.read_sql_query(query, conn, params=(user_id,))
+    return df
+
+
+@cached_query
+@traced()
+def df_mood_profile(user_id, time_range="medium_term"):
+    """Average danceability/energy/valence of a top-tracks snapshot as a one-row DataFrame.
+
+    Empty when no track in the snapshot has audio features.
+    """
+    import pandas as pd
+    from db import get_read_conn
+
+    query = """
+        SELECT danceability_sum / tracks AS danceability,
+               energy_sum / tracks AS energy,
+               valence_sum / tracks AS valence
+        FROM mood_totals
+        WHERE user_id = ? AND time_range = ? AND tracks > 0
+    """
+    with get_read_conn() as conn:
+        df = pd.read_sql_query(query, conn, params=(user_id, time_range))
+    df.index = ["Average"] * len(df)
+    return df
+
+
+@cached_query
+@traced()
+def df_feature_coverage():
+    """Library-wide audio-feature coverage: track count, tracks with features, tracks Spotify has none for."""
+    import pandas as pd
+    from db import get_read_conn
+
+    query = """
+        SELECT (SELECT COUNT(*) FROM tracks) AS tracks,
+               (SELECT COUNT(*) FROM audio_features) AS with_features,
+               (SELECT COUNT(*) FROM audio_features_misses) AS missed
+    """
+    with get_read_conn() as conn:
         df = pd.read_sql_query(query, conn)
-    return df
\ No newline at end of file
+    return df
+
+
+GENRE_PERIODS = {"day": "%Y-%m-%d", "month": "%Y-%m", "year": "%Y"}  # strftime format of a UTC period
+
+
+@cached_query
+@traced()
+def df_top_genres(user_id, time_range="medium_term", limit=10):
+    """Most common genres in a top-tracks snapshot, with their share of the snapshot's tracks."""
+    import pandas as pd
+    from db import get_read_conn
+
+    query = """
+        SELECT g.name AS genre, COUNT(*) AS tracks,
+               CAST(COUNT(*) AS REAL) / (
+                   SELECT COUNT(*) FROM top_tracks WHERE user_id = ? AND time_range = ?
+               ) AS share
+        FROM top_tracks tt
+        JOIN tracks t ON tt.track_id = t.track_id
+        JOIN artist_genres ag ON t.artist_id = ag.artist_id
+        JOIN genres g ON ag.genre_id = g.genre_id
+        WHERE tt.user_id = ? AND tt.time_range = ?
+        GROUP BY g.genre_id
+        ORDER BY tracks DESC, genre
+        LIMIT ?
+    """
+    with get_read_conn() as conn:
+        df = pd.read_sql_query(query, conn, params=(user_id, time_range, user_id, time_range, limit))
+    return df
+
+
+@cached_query
+@traced()
+def df_genre_share_over_time(user_id, period="month", top_n=8):
+    """Share of plays per period for the user's ``top_n`` genres, in long format.
+
+    A play counts once for each genre of its artist, so shares within a period
+    can add up to more than 1.
+    """
+    import pandas as pd
+    from db import get_read_conn
+
+    fmt = GENRE_PERIODS[period]
+    query = f"""
+        WITH genre_plays AS (
+            SELECT strftime('{fmt}', p.played_at_ms / 1000, 'unixepoch') AS period, ag.genre_id, COUNT(*) AS plays
+            FROM play_events p
+            JOIN tracks t ON p.track_key = t.track_key
+            JOIN artist_genres ag ON t.artist_id = ag.artist_id
+            WHERE p.user_key = (SELECT user_key FROM users WHERE user_id = ?)
+            GROUP BY period, ag.genre_id
+        ),
+        period_totals AS (
+            SELECT strftime('{fmt}', played_at_ms / 1000, 'unixepoch') AS period, COUNT(*) AS plays
+            FROM play_events
+            WHERE user_key = (SELECT user_key FROM users WHERE user_id = ?)
+            GROUP BY period
+        ),
+        top_genres AS (
+            SELECT genre_id FROM genre_plays GROUP BY genre_id ORDER BY SUM(plays) DESC LIMIT ?
+        )
+        SELECT gp.period, g.name AS genre, gp.plays, CAST(gp.plays AS REAL) / pt.plays AS share
+        FROM genre_plays gp
+        JOIN top_genres USING (genre_id)
+        JOIN genres g USING (genre_id)
+        JOIN period_totals pt USING (period)
+        ORDER BY gp.period, gp.plays DESC
+    """
+    with get_read_conn() as conn:
+        df = pd.read_sql_query(query, conn, params=(user_id, user_id, top_n))
+    return df
@@ -0,0 +1,226 @@
+"""Columnar exports and on-disk snapshots of the dashboard tables.
+
+Snapshots are streamed straight from SQLite into Parquet (or Arrow IPC) in
+row-group sized chunks, so a large play history is never held as one big
+string or DataFrame. Names are dictionary-encoded and ``played_at`` is a real
+UTC timestamp, taken straight from the stored Unix milliseconds.
+
+Snapshots are built on demand, when a download is asked for. Each file is
+tagged with the data versions it was built from (the shared one and the
+user's own, see ``query_cache``), so ``snapshot_path`` hands out the existing
+file to repeated downloads until the next ETL write touching that user's
+data. The dashboards themselves read SQLite, not snapshots.
+
+Parquet and Arrow need ``pyarrow`` (``HAVE_PYARROW`` is False when it isn't
+installed); CSV snapshots are written with the standard library.
+"""
+import importlib.util
+import os
+import re
+import tempfile
+
+from db import DB_PATH
+
+EXPORT_DIR = os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "exports")
+CHUNK_ROWS = 50_000  # Rows fetched from SQLite and written per row group
+
+HAVE_PYARROW = importlib.util.find_spec("pyarrow") is not None
+
+# name -> query (one `?` for user_id) and column types. Types are pyarrow
+# factory names so this module imports without pyarrow installed.
+SNAPSHOTS = {
+    "recent_plays": {
+        "query": """
+            SELECT t.track_id || '::' || strftime('%Y-%m-%dT%H:%M:%S', p.played_at_ms / 1000, 'unixepoch')
+                       || printf('.%03dZ', p.played_at_ms % 1000) AS play_id,
+                   t.name AS track_name, a.name AS artist_name, p.played_at_ms AS played_at, p.context
+            FROM play_events p
+            JOIN tracks t ON p.track_key = t.track_key
+            JOIN artists a ON t.artist_id = a.artist_id
+            WHERE p.user_key = (SELECT user_key FROM users WHERE user_id = ?)
+            ORDER BY p.played_at_ms DESC
+        """,
+        "columns": {
+            "play_id": "string",
+            "track_name": "dictionary",
+            "artist_name": "dictionary",
+            "played_at": "timestamp",
+            "context": "dictionary",
+        },
+    },
+    "top_tracks": {
+        "query": """
+            SELECT tt.time_range, tt.rank, t.track_id, t.name AS track_name, a.name AS artist_name,
+                   t.album_name, t.release_date, t.duration_ms, t.popularity,
+                   af.danceability, af.energy, af.valence
+            FROM top_tracks tt
+            JOIN tracks t ON tt.track_id = t.track_id
+            JOIN artists a ON t.artist_id = a.artist_id
+            LEFT JOIN audio_features af ON t.track_id = af.track_id
+            WHERE tt.user_id = ?
+            ORDER BY tt.time_range, tt.rank
+        """,
+        "columns": {
+            "time_range": "dictionary",
+            "rank": "int16",
+            "track_id": "string",
+            "track_name": "dictionary",
+            "artist_name": "dictionary",
+            "album_name": "dictionary",
+            "release_date": "string",
+            "duration_ms": "int32",
+            "popularity": "int8",
+            "danceability": "float32",
+            "energy": "float32",
+            "valence": "float32",
+        },
+    },
+}
+
+
+def _require_pyarrow():
+    if not HAVE_PYARROW:
+        raise RuntimeError("Columnar exports need pyarrow: pip install pyarrow")
+
+
+def _arrow_schema(columns):
+    import pyarrow as pa
+
+    types = {
+        "string": pa.string(),
+        "dictionary": pa.dictionary(pa.int32(), pa.string()),
+        "timestamp": pa.timestamp("ms", tz="UTC"),
+        "int8": pa.int8(),
+        "int16": pa.int16(),
+        "int32": pa.int32(),
+        "float32": pa.float32(),
+    }
+    return pa.schema([(name, types[kind]) for name, kind in columns.items()])
+
+
+def iter_record_batches(name, user_id, chunk_rows=CHUNK_ROWS):
+    """Yield a snapshot's rows as typed Arrow record batches of ``chunk_rows``."""
+    _require_pyarrow()
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    from db import get_read_conn
+
+    spec = SNAPSHOTS[name]
+    schema = _arrow_schema(spec["columns"])
+    with get_read_conn() as conn:
+        cursor = conn.execute(spec["query"], (user_id,))
+        while True:
+            rows = cursor.fetchmany(chunk_rows)
+            if not rows:
+                break
+            arrays = []
+            for i, field in enumerate(schema):
+                values = pa.array([row[i] for row in rows])
+                if pa.types.is_dictionary(field.type):
+                    values = pc.dictionary_encode(values.cast(pa.string()))
+                arrays.append(values.cast(field.type))
+            yield pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def write_parquet(name, user_id, path, chunk_rows=CHUNK_ROWS):
+    """Stream a snapshot into a Parquet file, one row group per chunk. Returns row count."""
+    _require_pyarrow()
+    import pyarrow.parquet as pq
+
+    schema = _arrow_schema(SNAPSHOTS[name]["columns"])
+    rows = 0
+    with pq.ParquetWriter(path, schema, compression="zstd", use_dictionary=True) as writer:
+        for batch in iter_record_batches(name, user_id, chunk_rows):
+            writer.write_batch(batch, row_group_size=chunk_rows)
+            rows += batch.num_rows
+    return rows
+
+
+def write_arrow_ipc(name, user_id, path, chunk_rows=CHUNK_ROWS):
+    """Stream a snapshot into an Arrow IPC (Feather v2) file. Returns row count."""
+    _require_pyarrow()
+    import pyarrow as pa
+
+    schema = _arrow_schema(SNAPSHOTS[name]["columns"])
+    rows = 0
+    with pa.OSFile(path, "wb") as sink, pa.ipc.new_file(sink, schema) as writer:
+        for batch in iter_record_batches(name, user_id, chunk_rows):
+            writer.write_batch(batch)
+            rows += batch.num_rows
+    return rows
+
+
+def write_csv(name, user_id, path, chunk_rows=CHUNK_ROWS):
+    """Stream a snapshot into a CSV file, ``chunk_rows`` at a time. Returns row count.
+
+    Timestamp columns are written as ISO8601 UTC with milliseconds.
+    """
+    import csv
+    from datetime import datetime, timezone
+    from db import get_read_conn
+
+    spec = SNAPSHOTS[name]
+    stamps = [i for i, kind in enumerate(spec["columns"].values()) if kind == "timestamp"]
+
+    def iso(ms):
+        stamp = datetime.fromtimestamp(ms / 1000, timezone.utc)
+        return stamp.isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+    rows = 0
+    with get_read_conn() as conn, open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(spec["columns"])
+        cursor = conn.execute(spec["query"], (user_id,))
+        while True:
+            chunk = cursor.fetchmany(chunk_rows)
+            if not chunk:
+                break
+            if stamps:
+                chunk = [tuple(iso(v) if i in stamps and v is not None else v for i, v in enumerate(row))
+                         for row in chunk]
+            writer.writerows(chunk)
+            rows += len(chunk)
+    return rows
+
+
+WRITERS = {"parquet": write_parquet, "arrow": write_arrow_ipc, "csv": write_csv}
+
+
+def snapshot_path(name, user_id, fmt="parquet"):
+    """Path of the snapshot for the current data version, building it if missing.
+
+    Files for older versions of the same snapshot are removed once the new
+    one is in place.
+    """
+    from db import get_read_conn, get_data_version, get_user_data_version, user_file_key
+
+    with get_read_conn() as conn:
+        version = f"{get_data_version(conn)}.{get_user_data_version(conn, user_id)}"
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    ext = fmt if fmt in WRITERS else "parquet"
+    stem = f"{name}-{user_file_key(user_id)}"
+    path = os.path.join(EXPORT_DIR, f"{stem}-v{version}.{ext}")
+    if os.path.exists(path):
+        return path
+
+    # A unique temp file per build: sessions share a process, so the PID alone would collide
+    fd, tmp_path = tempfile.mkstemp(dir=EXPORT_DIR, prefix=f"{stem}-", suffix=".tmp")
+    os.close(fd)
+    try:
+        WRITERS[ext](name, user_id, tmp_path)
+        os.replace(tmp_path, path)  # Readers never see a half-written file
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    # Only this exact snapshot's other versions, never another user's or snapshot's files
+    stale_name = re.compile(rf"{re.escape(stem)}-v\d+\.\d+\.{re.escape(ext)}")
+    for entry in os.listdir(EXPORT_DIR):
+        stale = os.path.join(EXPORT_DIR, entry)
+        if stale != path and stale_name.fullmatch(entry):
+            try:
+                os.remove(stale)
+            except OSError:
+                pass  # Another process may still be reading it
+    return path
+
@@ -0,0 +1,311 @@
+"""Offline stand-in for ``spotipy.Spotify``.
+
+``FakeSpotify`` serves deterministic, realistically shaped payloads for the
+endpoints the loaders use (current user, top tracks, recently played with
+cursor paging, artists and audio features). Scale, per-call latency and a
+rate limit are configurable, and every call is counted, so ETL code paths
+can be exercised and benchmarked without credentials or network.
+
+    sp = FakeSpotify(n_tracks=5_000, n_plays=20_000, latency=0.05)
+    etl.refresh_all(sp)
+    sp.calls  # Counter of API calls by endpoint
+
+``FakeSpotifyTransport`` serves the same fake over HTTP semantics instead, so
+a real ``spotipy.Spotify`` can run through the app's transport stack (response
+cache, request scheduler) against it.
+"""
+import json
+import random
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from spotipy.exceptions import SpotifyException
+
+API = "https://api.spotify.com/v1"
+BASE62 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+GENRES = ["pop", "rock", "indie", "hip hop", "rap", "edm", "house", "jazz", "soul", "r&b",
+          "country", "folk", "metal", "punk", "latin", "k-pop", "classical", "ambient", "techno", "funk"]
+CONTEXTS = ["playlist", "album", "artist", None]
+TIME_RANGE_OFFSETS = {"short_term": 0, "medium_term": 7, "long_term": 13}
+
+
+def spotify_id(kind, n):
+    """Deterministic 22-character base62 ID, like Spotify's."""
+    rng = random.Random(f"{kind}:{n}")
+    return "".join(rng.choice(BASE62) for _ in range(22))
+
+
+def iso_ms(ms):
+    return datetime.fromtimestamp(ms / 1000, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.") + f"{ms % 1000:03d}Z"
+
+
+class FakeSpotify:
+    """Drop-in for the subset of ``spotipy.Spotify`` used by this app.
+
+    Args:
+        n_tracks: Catalogue size.
+        n_artists: Number of distinct artists (defaults to n_tracks // 10).
+        n_plays: Plays in the user's history, one every ``play_interval_ms``.
+        recent_window: How many of the latest plays the recently-played endpoint
+            exposes (the real API stops at 50).
+        latency: Seconds added to every call (``latency_jitter`` adds up to that much more).
+        rate_limit: Calls per second before answering 429 with Retry-After, or None.
+        features_missing: Fraction of tracks ``audio_features`` answers null for.
+        user_id: ID returned by ``current_user``.
+        seed: Seed for all generated data.
+    """
+
+    def __init__(self, n_tracks=1_000, n_artists=None, n_plays=1_000, recent_window=50,
+                 play_interval_ms=180_000, latency=0.0, latency_jitter=0.0, rate_limit=None,
+                 features_missing=0.0, user_id="fake-user", seed=0, now_ms=1_700_000_000_000):
+        self.n_tracks = n_tracks
+        self.n_artists = n_artists or max(1, n_tracks // 10)
+        self.n_plays = n_plays
+        self.recent_window = recent_window
+        self.play_interval_ms = play_interval_ms
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.rate_limit = rate_limit
+        self.features_missing = features_missing
+        self.user_id = user_id
+        self.seed = seed
+        self.now_ms = now_ms
+        self.calls = Counter()
+        self.rate_limited = 0
+        self._lock = threading.Lock()
+        self._window_start = time.monotonic()
+        self._window_calls = 0
+
+    # ---------- Simulation controls ----------
+
+    def listen(self, plays):
+        """Append ``plays`` new plays to the history, as if the user kept listening."""
+        with self._lock:
+            self.n_plays += plays
+            self.now_ms += plays * self.play_interval_ms
+
+    # ---------- Internals ----------
+
+    def _call(self, endpoint):
+        with self._lock:
+            self.calls[endpoint] += 1
+            if self.rate_limit is not None:
+                now = time.monotonic()
+                if now - self._window_start >= 1.0:
+                    self._window_start, self._window_calls = now, 0
+                self._window_calls += 1
+                if self._window_calls > self.rate_limit:
+                    self.rate_limited += 1
+                    retry_after = max(0.0, 1.0 - (now - self._window_start))
+                    raise SpotifyException(
+                        429, -1, f"{API}/{endpoint}:\n API rate limit exceeded",
+                        headers={"Retry-After": f"{retry_after:.3f}"},
+                    )
+        if self.latency or self.latency_jitter:
+            time.sleep(self.latency + random.random() * self.latency_jitter)
+
+    def _artist(self, n):
+        rng = random.Random(f"{self.seed}:artist:{n}")
+        artist_id = spotify_id("artist", n)
+        return {
+            "id": artist_id,
+            "name": f"Artist {n}",
+            "type": "artist",
+            "uri": f"spotify:artist:{artist_id}",
+            "genres": rng.sample(GENRES, rng.randint(0, 3)),
+            "popularity": rng.randint(0, 100),
+            "followers": {"href": None, "total": rng.randint(0, 5_000_000)},
+        }
+
+    def _track(self, n):
+        rng = random.Random(f"{self.seed}:track:{n}")
+        artist_n = n % self.n_artists
+        artist_id = spotify_id("artist", artist_n)
+        track_id = spotify_id("track", n)
+        return {
+            "id": track_id,
+            "name": f"Track {n}",
+            "type": "track",
+            "uri": f"spotify:track:{track_id}",
+            "artists": [{"id": artist_id, "name": f"Artist {artist_n}", "type": "artist",
+                         "uri": f"spotify:artist:{artist_id}"}],
+            "album": {
+                "id": spotify_id("album", n // 10),
+                "name": f"Album {n // 10}",
+                "release_date": f"{rng.randint(1970, 2024)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+                "release_date_precision": "day",
+            },
+            "duration_ms": rng.randint(90_000, 420_000),
+            "popularity": rng.randint(0, 100),
+            "explicit": rng.random() < 0.2,
+        }
+
+    def _track_index(self, track_id):
+        # IDs are only looked up for tracks this fake handed out, so a reverse map is cheap
+        if not hasattr(self, "_ids"):
+            self._ids = {spotify_id("track", n): n for n in range(self.n_tracks)}
+        return self._ids.get(track_id)
+
+    def _audio_features(self, n):
+        if self.features_missing and random.Random(f"{self.seed}:no-features:{n}").random() < self.features_missing:
+            return None
+        rng = random.Random(f"{self.seed}:features:{n}")
+        track_id = spotify_id("track", n)
+        return {
+            "id": track_id, "type": "audio_features", "uri": f"spotify:track:{track_id}",
+            "danceability": rng.random(), "energy": rng.random(), "key": rng.randint(0, 11),
+            "loudness": -rng.random() * 30, "mode": rng.randint(0, 1), "speechiness": rng.random() * 0.5,
+            "acousticness": rng.random(), "instrumentalness": rng.random() ** 3, "liveness": rng.random() * 0.6,
+            "valence": rng.random(), "tempo": 60 + rng.random() * 140, "duration_ms": 200_000,
+            "time_signature": 4,
+        }
+
+    def _play(self, i):
+        """The i-th play of the history (0 = oldest)."""
+        rng = random.Random(f"{self.seed}:play:{i}")
+        played_ms = self.now_ms - (self.n_plays - 1 - i) * self.play_interval_ms
+        # Skewed towards a favourite subset, like real listening
+        n = int(self.n_tracks * rng.random() ** 2)
+        context = rng.choice(CONTEXTS)
+        return {
+            "track": self._track(n),
+            "played_at": iso_ms(played_ms),
+            "context": {"type": context, "uri": f"spotify:{context}:x"} if context else None,
+        }
+
+    # ---------- Spotipy API surface ----------
+
+    def current_user(self):
+        self._call("me")
+        return {"id": self.user_id, "display_name": "Fake Listener", "type": "user"}
+
+    def current_user_top_tracks(self, limit=20, offset=0, time_range="medium_term"):
+        self._call("me/top/tracks")
+        shift = TIME_RANGE_OFFSETS.get(time_range, 0)
+        count = max(0, min(limit, self.n_tracks - offset))
+        items = [self._track((offset + i + shift) % self.n_tracks) for i in range(count)]
+        return {"items": items, "total": self.n_tracks, "limit": limit, "offset": offset,
+                "next": None, "previous": None}
+
+    def current_user_recently_played(self, limit=50, after=None, before=None):
+        self._call("me/player/recently-played")
+        lowest = max(0, self.n_plays - self.recent_window)  # Oldest play the API still exposes
+        first_ms = self.now_ms - (self.n_plays - 1) * self.play_interval_ms
+        ms_of = lambda i: first_ms + i * self.play_interval_ms  # noqa: E731
+        if after is not None:
+            # Oldest plays newer than the cursor first, returned newest-first per page
+            first = max(lowest, (int(after) - first_ms) // self.play_interval_ms + 1)
+            indices = list(range(first, min(first + limit, self.n_plays)))
+            more = first + limit < self.n_plays
+        else:
+            last = self.n_plays
+            if before is not None:
+                last = max(lowest, min(last, -(-(int(before) - first_ms) // self.play_interval_ms)))
+            indices = list(range(max(lowest, last - limit), last))
+            more = bool(indices) and indices[0] > lowest
+
+        items = [self._play(i) for i in reversed(indices)]
+        cursors = None
+        next_url = None
+        if indices:
+            cursors = {"after": str(ms_of(indices[-1])), "before": str(ms_of(indices[0]))}
+            if more:
+                key = "after" if after is not None else "before"
+                next_url = f"{API}/me/player/recently-played?{key}={cursors[key]}&limit={limit}"
+        return {"items": items, "next": next_url, "cursors": cursors, "limit": limit,
+                "href": f"{API}/me/player/recently-played"}
+
+    def next(self, result):
+        if not result.get("next"):
+            return None
+        query = {k: v[0] for k, v in parse_qs(urlsplit(result["next"]).query).items()}
+        return self.current_user_recently_played(
+            limit=int(query.get("limit", 50)), after=query.get("after"), before=query.get("before")
+        )
+
+    def artist(self, artist_id):
+        self._call("artists/{id}")
+        n = self._artist_index(artist_id)
+        if n is None:
+            raise SpotifyException(404, -1, f"{API}/artists/{artist_id}:\n Resource not found")
+        return self._artist(n)
+
+    def artists(self, artists):
+        self._call("artists")
+        if len(artists) > 50:
+            raise SpotifyException(400, -1, f"{API}/artists:\n Too many ids requested")
+        return {"artists": [self._artist(n) if n is not None else None
+                            for n in map(self._artist_index, artists)]}
+
+    def _artist_index(self, artist_id):
+        if not hasattr(self, "_artist_ids"):
+            self._artist_ids = {spotify_id("artist", n): n for n in range(self.n_artists)}
+        return self._artist_ids.get(artist_id)
+
+    def audio_features(self, tracks=[]):
+        self._call("audio-features")
+        if len(tracks) > 100:
+            raise SpotifyException(400, -1, f"{API}/audio-features:\n Too many ids requested")
+        if any(len(track_id) != 22 or track_id.strip(BASE62) for track_id in tracks):
+            raise SpotifyException(400, -1, f"{API}/audio-features:\n invalid request")
+        return [self._audio_features(n) if n is not None else None for n in map(self._track_index, tracks)]
+
+
+class FakeSpotifyTransport:
+    """``requests`` transport answering Spotify Web API URLs from a ``FakeSpotify``.
+
+    Errors the fake raises (429 with Retry-After, 400, 404) become HTTP error
+    responses, which Spotipy turns back into ``SpotifyException``::
+
+        session = cached_session(cache=ResponseCache(path), inner=SchedulingAdapter(FakeSpotifyTransport(fake)))
+        sp = spotipy.Spotify(auth="fake-token", requests_session=session)
+    """
+
+    def __init__(self, fake):
+        self.fake = fake
+
+    def _route(self, path, query):
+        fake = self.fake
+        ids = query.get("ids", "").split(",") if query.get("ids") else []
+        if path == "/v1/me":
+            return fake.current_user()
+        if path == "/v1/me/top/tracks":
+            return fake.current_user_top_tracks(limit=int(query.get("limit", 20)), offset=int(query.get("offset", 0)),
+                                                time_range=query.get("time_range", "medium_term"))
+        if path == "/v1/me/player/recently-played":
+            return fake.current_user_recently_played(limit=int(query.get("limit", 50)), after=query.get("after"),
+                                                     before=query.get("before"))
+        if path == "/v1/artists":
+            return fake.artists(ids)
+        if path.startswith("/v1/artists/"):
+            return fake.artist(path.rsplit("/", 1)[-1])
+        if path == "/v1/audio-features":
+            return {"audio_features": fake.audio_features(tracks=ids)}
+        raise SpotifyException(404, -1, f"{API}{path[3:]}:\n Service not found")
+
+    def send(self, request, **kwargs):
+        url = urlsplit(request.url)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        try:
+            status, headers = 200, {}
+            body = self._route(url.path.rstrip("/"), query)
+        except SpotifyException as e:
+            status, headers = e.http_status, dict(e.headers or {})
+            body = {"error": {"status": e.http_status, "message": e.msg.split("\n")[-1].strip()}}
+        response = requests.Response()
+        response.status_code = status
+        response.reason = "OK" if status == 200 else "Error"
+        response.headers = CaseInsensitiveDict({"Content-Type": "application/json", **headers})
+        response._content = json.dumps(body).encode("utf-8")
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
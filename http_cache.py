@@ -0,0 +1,293 @@
+"""On-disk response cache for Spotify Web API GET requests.
+
+The cache sits under Spotipy as a ``requests`` transport adapter, so every
+client call (top tracks, recent plays, artists, audio features, ...) is served
+from SQLite while it is fresh, revalidated with ``If-None-Match`` once it is
+stale, and only goes to the network when neither works. By default those
+network calls are paced by the shared rate-limit scheduler (see ``scheduler``).
+
+The wrapped transport is anything with ``send(request, **kwargs)`` and
+``close()``, which makes the cache testable offline with a stub in place of
+``HTTPAdapter``.
+"""
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.util.retry import Retry
+
+import tracing
+from db import DB_PATH
+
+CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "http_cache.db")
+MAX_CACHE_BYTES = 64 * 1024 * 1024
+
+MINUTE = 60
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+
+# (path pattern, TTL in seconds). First match wins; unmatched paths are not cached.
+ENDPOINT_TTLS = [
+    (re.compile(r"^/v1/me/player/recently-played"), 30),
+    (re.compile(r"^/v1/me/top/"), HOUR),
+    (re.compile(r"^/v1/me/?$"), HOUR),
+    (re.compile(r"^/v1/artists"), 3 * DAY),
+    (re.compile(r"^/v1/tracks"), 7 * DAY),
+    (re.compile(r"^/v1/audio-features"), 30 * DAY),
+]
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS responses (
+        cache_key    TEXT PRIMARY KEY,
+        url          TEXT NOT NULL,
+        status       INTEGER NOT NULL,
+        headers      TEXT NOT NULL,   -- JSON object
+        body         BLOB NOT NULL,
+        etag         TEXT,
+        expires_at   REAL NOT NULL,   -- unix seconds
+        last_access  REAL NOT NULL,   -- unix seconds, drives LRU eviction
+        size         INTEGER NOT NULL
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses(last_access);
+"""
+
+
+def ttl_for(url):
+    """Return the cache TTL (seconds) for a request URL, or None if uncached."""
+    path = urlsplit(url).path
+    for pattern, ttl in ENDPOINT_TTLS:
+        if pattern.match(path):
+            return ttl
+    return None
+
+
+class ResponseCache:
+    """Size-bounded LRU store of HTTP responses backed by SQLite."""
+
+    def __init__(self, path=CACHE_PATH, max_bytes=MAX_CACHE_BYTES, clock=time.time):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode = WAL;")
+        self._conn.executescript(SCHEMA)
+
+    def get(self, key):
+        """Return the stored entry for ``key`` as a dict, or None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT url, status, headers, body, etag, expires_at FROM responses WHERE cache_key = ?",
+                (key,),
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE responses SET last_access = ? WHERE cache_key = ?", (self.clock(), key)
+            )
+            self._conn.commit()
+        url, status, headers, body, etag, expires_at = row
+        return {
+            "url": url,
+            "status": status,
+            "headers": json.loads(headers),
+            "body": body,
+            "etag": etag,
+            "expires_at": expires_at,
+        }
+
+    def put(self, key, url, status, headers, body, etag, ttl):
+        """Store a response for ``ttl`` seconds, evicting LRU entries if over budget."""
+        now = self.clock()
+        with self._lock:
+            self._conn.execute("""
+                INSERT OR REPLACE INTO responses
+                    (cache_key, url, status, headers, body, etag, expires_at, last_access, size)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (key, url, status, json.dumps(dict(headers)), body, etag, now + ttl, now, len(body)))
+            self._evict()
+            self._conn.commit()
+
+    def count(self, outcome):
+        """Add one to the ``hits``, ``misses`` or ``revalidated`` counter."""
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def touch(self, key, ttl):
+        """Extend the freshness of an entry after a successful revalidation."""
+        now = self.clock()
+        with self._lock:
+            self._conn.execute(
+                "UPDATE responses SET expires_at = ?, last_access = ? WHERE cache_key = ?",
+                (now + ttl, now, key),
+            )
+            self._conn.commit()
+
+    def _evict(self):
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._conn.execute("SELECT cache_key, size FROM responses ORDER BY last_access")
+        doomed = []
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            doomed.append((key,))
+            total -= size
+        self._conn.executemany("DELETE FROM responses WHERE cache_key = ?", doomed)
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+
+    def stats(self):
+        """Hit/miss counters and current size of the cache."""
+        with self._lock:
+            entries, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        return {
+            "entries": entries,
+            "bytes": size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "revalidated": self.revalidated,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def cache_key(request):
+    """Key identifying a request's response: method and URL, plus the token for per-user endpoints."""
+    # /me/* responses are per user, so they are keyed on the bearer token too.
+    # Catalogue lookups (artists, tracks, audio features) are shared by everyone.
+    parts = [request.method, request.url]
+    if urlsplit(request.url).path.startswith("/v1/me"):
+        parts.append(request.headers.get("Authorization", ""))
+    return hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()
+
+
+def _build_response(request, entry):
+    response = requests.Response()
+    response.status_code = entry["status"]
+    response.reason = "OK"
+    response.headers = CaseInsensitiveDict(entry["headers"])
+    response._content = entry["body"]
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers) or "utf-8"
+    response.url = request.url
+    response.request = request
+    response.from_cache = True
+    return response
+
+
+class CachingAdapter(BaseAdapter):
+    """Transport adapter that serves GET requests from a ``ResponseCache``.
+
+    Args:
+        cache: ResponseCache to read and write.
+        inner: Transport used on a cache miss (defaults to a plain ``HTTPAdapter``).
+    """
+
+    def __init__(self, cache, inner=None):
+        super().__init__()
+        self.cache = cache
+        self.inner = inner or HTTPAdapter()
+
+    def send(self, request, **kwargs):
+        if not tracing.is_enabled():
+            return self._send(request, **kwargs)[0]
+        start = time.perf_counter()
+        response, source = self._send(request, **kwargs)
+        tracing.record_http(request.method, request.url, response.status_code, len(response.content or b""),
+                            (time.perf_counter() - start) * 1000, source)
+        return response
+
+    def _send(self, request, **kwargs):
+        """Returns ``(response, source)`` with source "network", "cache" or "revalidated"."""
+        ttl = ttl_for(request.url) if request.method == "GET" else None
+        if ttl is None:
+            return self.inner.send(request, **kwargs), "network"
+
+        key = cache_key(request)
+        entry = self.cache.get(key)
+        if entry is not None and entry["expires_at"] > self.cache.clock():
+            self.cache.count("hits")
+            return _build_response(request, entry), "cache"
+
+        if entry is not None and entry["etag"]:
+            request.headers["If-None-Match"] = entry["etag"]
+        response = self.inner.send(request, **kwargs)
+
+        if response.status_code == 304 and entry is not None:
+            self.cache.count("revalidated")
+            self.cache.touch(key, ttl)
+            return _build_response(request, entry), "revalidated"
+
+        self.cache.count("misses")
+        if response.status_code == 200:
+            self.cache.put(
+                key, request.url, response.status_code, response.headers,
+                response.content, response.headers.get("ETag"), ttl,
+            )
+        return response, "network"
+
+    def close(self):
+        self.inner.close()
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Process-wide ResponseCache stored next to the app database."""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = ResponseCache()
+        return _default_cache
+
+
+def cached_session(cache=None, inner=None, priority=None):
+    """Build a ``requests.Session`` for Spotipy that goes through the response cache.
+
+    The default transport sends cache misses through the shared request
+    scheduler (see ``scheduler``) at ``priority`` (background by default), over
+    an ``HTTPAdapter`` with the retry policy Spotipy installs on its own
+    sessions, since passing ``requests_session`` replaces it. 429s are left
+    to the scheduler, which paces every process by them.
+    """
+    if inner is None:
+        from scheduler import BACKGROUND, SchedulingAdapter
+
+        retry = Retry(
+            total=3,
+            connect=None,
+            read=False,
+            allowed_methods=frozenset(["GET", "POST", "PUT", "DELETE"]),
+            status=3,
+            backoff_factor=0.3,
+            status_forcelist=(500, 502, 503, 504),
+        )
+        inner = SchedulingAdapter(HTTPAdapter(max_retries=retry),
+                                  priority=BACKGROUND if priority is None else priority)
+    adapter = CachingAdapter(cache or get_cache(), inner=inner)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
@@ -0,0 +1,267 @@
+"""Bulk import of Spotify "Extended Streaming History" exports.
+
+The export is a set of JSON files (``Streaming_History_Audio_*.json`` or the
+older ``endsong_*.json``), each one large array of play entries. Files are
+parsed incrementally, never loaded whole, and written in large batched
+transactions. Each file is an ``import`` job (see ``jobs``) whose checkpoint,
+the byte offset reached in the file, is committed with every batch, so an
+interrupted import resumes where it stopped.
+
+The export has no artist IDs. Imported tracks point at placeholder artists
+(``import:<hash of the name>``) until an API load replaces the track row
+with real metadata.
+
+Usage:
+    python importer.py path/to/my_spotify_data/ --user-id <spotify user id>
+"""
+import argparse
+import codecs
+import glob
+import hashlib
+import json
+import os
+import time
+from datetime import datetime
+
+IMPORTED_ARTIST_PREFIX = "import:"
+BATCH_SIZE = 50_000  # Entries per transaction
+READ_CHUNK = 1 << 20  # Bytes read from disk at a time
+MIN_MS_PLAYED = 30_000  # Spotify counts a stream after 30 seconds
+HISTORY_PATTERNS = ("Streaming_History_Audio_*.json", "endsong_*.json")
+
+
+def imported_artist_id(name):
+    """Placeholder artist ID for an artist known only by name."""
+    return IMPORTED_ARTIST_PREFIX + hashlib.sha1(name.encode("utf-8")).hexdigest()[:16]
+
+
+def iter_json_array(path, start_offset=0, chunk_size=READ_CHUNK):
+    """Yield ``(entry, end_offset)`` for each object of a top-level JSON array.
+
+    ``end_offset`` is the byte offset just past the object, which is a valid
+    ``start_offset`` for resuming. Only one read chunk plus the object being
+    decoded is held in memory.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    buf = ""
+    base = start_offset  # Byte offset of buf[0]
+    with open(path, "rb") as f:
+        f.seek(start_offset)
+        eof = False
+        while True:
+            pos = 0
+            mark, byte_pos = 0, base  # buf[mark] sits at byte offset byte_pos
+            while True:
+                # Skip the array punctuation between objects
+                while pos < len(buf) and buf[pos] in " \t\r\n,[":
+                    pos += 1
+                if pos < len(buf) and buf[pos] == "]":
+                    return
+                if pos >= len(buf):
+                    break
+                try:
+                    entry, end = decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                    break  # Object continues in the next chunk
+                byte_pos += len(buf[mark:end].encode("utf-8"))
+                mark = pos = end
+                yield entry, byte_pos
+            base = byte_pos + len(buf[mark:pos].encode("utf-8"))
+            buf = buf[pos:]
+            if eof:
+                return
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buf += utf8.decode(chunk, final=eof)
+
+
+def _entry_rows(entry, user_id, min_ms_played):
+    """Map one export entry onto (artist, track, play) rows, or None to skip it."""
+    uri = entry.get("spotify_track_uri")
+    if not uri or (entry.get("ms_played") or 0) < min_ms_played:
+        return None  # Podcast episodes, audiobooks and skips
+    track_id = uri.rsplit(":", 1)[-1]
+    artist_name = entry.get("master_metadata_album_artist_name") or "Unknown Artist"
+    artist_id = imported_artist_id(artist_name)
+    played_at_ms = round(datetime.fromisoformat(entry["ts"].replace("Z", "+00:00")).timestamp() * 1000)
+    return (
+        (artist_id, artist_name, None),
+        (track_id, entry.get("master_metadata_track_name") or track_id, artist_id,
+         entry.get("master_metadata_album_album_name"), None, None, None),
+        (user_id, track_id, played_at_ms, None),
+    )
+
+
+def _write_rows(conn, rows):
+    """Insert one batch of mapped entries; returns the number of new plays."""
+    from db import bump_data_version, insert_play_events
+
+    artists, tracks, plays = {}, {}, []
+    for artist_row, track_row, play_row in rows:
+        artists[artist_row[0]] = artist_row
+        tracks[track_row[0]] = track_row
+        plays.append(play_row)
+
+    changes_before = conn.total_changes
+    conn.executemany("INSERT OR IGNORE INTO artists (artist_id, name, genres) VALUES (?, ?, ?)", artists.values())
+    conn.executemany("""
+        INSERT OR IGNORE INTO tracks (track_id, name, artist_id, album_name, release_date, duration_ms, popularity)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, tracks.values())
+    if conn.total_changes != changes_before:
+        bump_data_version(conn)
+
+    user_ids = {p[0] for p in plays}
+    conn.executemany("INSERT OR IGNORE INTO users (user_id) VALUES (?)", [(u,) for u in user_ids])
+    new_plays = insert_play_events(conn, plays)
+    if new_plays:
+        for user_id in user_ids:
+            bump_data_version(conn, user_id)
+    return new_plays
+
+
+def _import_job_key(path, user_id):
+    return f"{user_id}:{path}"
+
+
+def import_file(path, user_id, batch_size=BATCH_SIZE, min_ms_played=MIN_MS_PLAYED, progress=None):
+    """Import one export file, resuming from its last committed offset.
+
+    Returns:
+        Dict with ``entries`` parsed and ``plays`` inserted in this run.
+    """
+    import jobs
+
+    path = os.path.abspath(path)
+    size = os.path.getsize(path)
+    key = _import_job_key(path, user_id)
+    previous = jobs.latest("import", key)
+    if previous and previous["items_total"] == size and previous["status"] == "done":
+        return {"entries": 0, "plays": 0}  # Already imported
+    if previous and previous["items_total"] != size and previous["finished_at"] is None:
+        jobs.cancel(previous["job_id"])  # The file changed since the unfinished import: start over
+
+    job_id = jobs.submit("import", key, {"path": path, "user_id": user_id, "size_bytes": size,
+                                         "batch_size": batch_size, "min_ms_played": min_ms_played},
+                         items_total=size)
+    stats = jobs.run(job_id, progress=progress)
+    if stats is None:
+        raise RuntimeError(f"{path} is being imported by another process")
+    return stats
+
+
+def _import_job(job, progress=None):
+    """``jobs`` handler behind ``import_file``: one batch per ``batch_size`` entries.
+
+    The checkpoint holds the byte offset just past the last committed entry
+    and the file's running ``entries``/``plays`` totals; progress is in bytes.
+    """
+    path, user_id = job.params["path"], job.params["user_id"]
+    batch_size = job.params.get("batch_size", BATCH_SIZE)
+    min_ms_played = job.params.get("min_ms_played", MIN_MS_PLAYED)
+    checkpoint = job.checkpoint or {"byte_offset": 0, "entries": 0, "plays": 0}
+    offset = checkpoint["byte_offset"]
+    stats = {"entries": 0, "plays": 0}
+
+    def commit(rows, end_offset, entries):
+        nonlocal offset, checkpoint
+        new_checkpoint = dict(checkpoint, byte_offset=end_offset, entries=checkpoint["entries"] + entries)
+
+        def write(conn):
+            plays = _write_rows(conn, rows)
+            new_checkpoint["plays"] += plays  # Serialised after write runs, in the same transaction
+            return plays
+
+        plays = job.commit_batch(end_offset, write, new_checkpoint, end_offset - offset) or 0
+        checkpoint, offset = new_checkpoint, end_offset
+        stats["entries"] += entries
+        stats["plays"] += plays
+
+    rows = []
+    pending = 0
+    for entry, end_offset in iter_json_array(path, offset):
+        pending += 1
+        mapped = _entry_rows(entry, user_id, min_ms_played)
+        if mapped:
+            rows.append(mapped)
+        if pending >= batch_size:
+            commit(rows, end_offset, pending)
+            rows, pending = [], 0
+            if progress:
+                progress(path, stats)
+    if pending:
+        commit(rows, end_offset, pending)
+    return stats
+
+
+def find_history_files(paths):
+    """Expand directories into their export files, keeping explicit files as given."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for pattern in HISTORY_PATTERNS:
+                files.extend(sorted(glob.glob(os.path.join(path, "**", pattern), recursive=True)))
+        else:
+            files.append(path)
+    return files
+
+
+def import_history(paths, user_id, batch_size=BATCH_SIZE, min_ms_played=MIN_MS_PLAYED, progress=None):
+    """Import every export file under ``paths`` for one user.
+
+    Files already imported in full are skipped.
+
+    Returns:
+        Dict with totals and the overall ``rows_per_sec``.
+    """
+    import jobs
+
+    start = time.perf_counter()
+    totals = {"files": 0, "entries": 0, "plays": 0}
+    files = []
+    for path in find_history_files(paths):
+        previous = jobs.latest("import", _import_job_key(os.path.abspath(path), user_id))
+        if not (previous and previous["status"] == "done" and previous["items_total"] == os.path.getsize(path)):
+            files.append(path)
+
+    for path in files:
+        stats = import_file(path, user_id, batch_size, min_ms_played, progress)
+        totals["files"] += 1
+        totals["entries"] += stats["entries"]
+        totals["plays"] += stats["plays"]
+
+    totals["seconds"] = time.perf_counter() - start
+    totals["rows_per_sec"] = totals["entries"] / totals["seconds"] if totals["seconds"] else 0.0
+    return totals
+
+
+def main():
+    from db import init_db
+
+    parser = argparse.ArgumentParser(description="Import Spotify Extended Streaming History JSON files.")
+    parser.add_argument("paths", nargs="+", help="Export files or directories containing them")
+    parser.add_argument("--user-id", required=True, help="Spotify user ID the plays belong to")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--min-ms-played", type=int, default=MIN_MS_PLAYED)
+    args = parser.parse_args()
+
+    init_db()
+    start = time.perf_counter()
+
+    def progress(path, stats):
+        elapsed = time.perf_counter() - start
+        print(f"{os.path.basename(path)}: {stats['entries']:,} entries, "
+              f"{stats['plays']:,} new plays ({stats['entries'] / elapsed:,.0f} rows/s)")
+
+    totals = import_history(
+        args.paths, args.user_id, batch_size=args.batch_size, min_ms_played=args.min_ms_played, progress=progress,
+    )
+    print(f"Imported {totals['files']} files: {totals['entries']:,} entries, {totals['plays']:,} new plays "
+          f"in {totals['seconds']:.1f}s ({totals['rows_per_sec']:,.0f} rows/s)")
+
+
+if __name__ == "__main__":
+    main()
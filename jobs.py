@@ -0,0 +1,293 @@
+"""Durable, resumable ETL jobs.
+
+Long-running work (a history import, an audio-features backfill) runs as a
+job that is split into batches, and both are persisted in SQLite:
+
+- ``jobs`` holds one row per job: its kind, JSON parameters, status, the
+  checkpoint it resumes from and progress counters.
+- ``job_batches`` holds one row per committed batch, with its item count
+  and duration, for throughput.
+
+``Job.commit_batch`` writes a batch's rows, its ``job_batches`` row and the
+job's new checkpoint in one transaction. A crash therefore loses at most the
+batch in flight: the next run of the job picks up from the last committed
+checkpoint, and a batch whose key is already recorded is never written twice.
+
+``submit`` is idempotent: while a job for ``(kind, key)`` is unfinished,
+submitting it again returns the same job, so re-running a command resumes it.
+Jobs are claimed with an expiring lease (like ``refresher``'s refresh leases),
+renewed by every batch, so two processes never run the same job and a
+crashed owner's job can be taken over once its lease lapses.
+
+Run ``python jobs.py`` to list jobs with their progress and throughput.
+"""
+import argparse
+import importlib
+import json
+import os
+import socket
+import threading
+import time
+
+LEASE_SECONDS = 2 * 60  # A job whose owner stops committing batches can be taken over after this
+THROUGHPUT_BATCHES = 20  # Recent batches the items/s rate and ETA are computed over
+
+# kind -> "module:function" called as fn(job, **context); resolved lazily to keep imports one-way
+HANDLERS = {
+    "audio_features": "etl:_backfill_job",
+    "import": "importer:_import_job",
+}
+
+
+class LeaseLost(RuntimeError):
+    """The job's lease expired and another owner took it over; the batch was rolled back."""
+
+
+class Job:
+    """Handle passed to a job's handler.
+
+    Attributes:
+        job_id: Row ID in ``jobs``.
+        kind, key: What the job does and to what.
+        params: Handler arguments given to ``submit``.
+        checkpoint: Resume point of the last committed batch (None before the first).
+        items_done, items_total: Progress counters.
+    """
+
+    def __init__(self, row, owner):
+        self.job_id, self.kind, self.key, params, checkpoint, self.items_done, self.items_total = row
+        self.params = json.loads(params)
+        self.checkpoint = json.loads(checkpoint) if checkpoint else None
+        self.owner = owner
+        self._last_commit = time.time()
+
+    def set_total(self, items_total):
+        """Record how many items the job has in all (for progress and ETA)."""
+        from db import get_conn
+
+        with get_conn() as conn:
+            conn.execute("UPDATE jobs SET items_total = ? WHERE job_id = ?", (items_total, self.job_id))
+        self.items_total = items_total
+
+    def commit_batch(self, batch_key, write, checkpoint, items):
+        """Write one batch and advance the checkpoint, atomically.
+
+        Args:
+            batch_key: Identifies the batch within the job; a key committed
+                before makes this a no-op.
+            write: ``fn(conn)`` making the batch's writes on the transaction's
+                connection; should return a count (e.g. rows inserted).
+            checkpoint: JSON-serialisable resume point once this batch is in;
+                serialised after ``write`` runs, so ``write`` may fill in counts.
+            items: Work items the batch covers, added to ``items_done``.
+
+        Returns:
+            What ``write`` returned, or None when the batch was already committed.
+
+        Raises:
+            LeaseLost: Another owner holds the job now; nothing was written.
+        """
+        from db import get_conn
+
+        now = time.time()
+        with get_conn() as conn:
+            inserted = conn.execute("""
+                INSERT OR IGNORE INTO job_batches (job_id, batch_key, items, seconds, committed_at)
+                VALUES (?, ?, ?, ?, ?)
+            """, (self.job_id, str(batch_key), items, now - self._last_commit, now)).rowcount
+            if not inserted:
+                return None
+            result = write(conn)
+            renewed = conn.execute("""
+                UPDATE jobs SET checkpoint = ?, items_done = items_done + ?, batches_done = batches_done + 1,
+                                lease_expires_at = ?
+                WHERE job_id = ? AND owner = ?
+            """, (json.dumps(checkpoint), items, now + LEASE_SECONDS, self.job_id, self.owner)).rowcount
+            if not renewed:
+                raise LeaseLost(f"job {self.job_id} is now owned by another process")
+        self.checkpoint = checkpoint
+        self.items_done += items
+        self._last_commit = now
+        return result
+
+
+def _owner():
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+
+def submit(kind, key, params=None, items_total=None):
+    """Create a job, or return the unfinished job already queued for ``(kind, key)``.
+
+    Returns:
+        The job's ID.
+    """
+    from db import get_conn
+
+    if kind not in HANDLERS:
+        raise ValueError(f"unknown job kind {kind!r}")
+    with get_conn() as conn:
+        conn.execute("""
+            INSERT INTO jobs (kind, job_key, params, items_total, created_at) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (kind, job_key) WHERE finished_at IS NULL DO NOTHING
+        """, (kind, key, json.dumps(params or {}), items_total, time.time()))
+        return conn.execute(
+            "SELECT job_id FROM jobs WHERE kind = ? AND job_key = ? AND finished_at IS NULL", (kind, key)
+        ).fetchone()[0]
+
+
+def latest(kind, key):
+    """The most recent job for ``(kind, key)`` as a ``progress`` dict, or None."""
+    from db import get_read_conn
+
+    with get_read_conn() as conn:
+        row = conn.execute(
+            "SELECT job_id FROM jobs WHERE kind = ? AND job_key = ? ORDER BY job_id DESC LIMIT 1", (kind, key)
+        ).fetchone()
+    return progress(row[0]) if row else None
+
+
+def cancel(job_id):
+    """Stop an unfinished job from being resumed. Returns whether it was unfinished."""
+    from db import get_conn
+
+    with get_conn() as conn:
+        return conn.execute("""
+            UPDATE jobs SET status = 'cancelled', finished_at = ?, owner = NULL, lease_expires_at = NULL
+            WHERE job_id = ? AND finished_at IS NULL
+        """, (time.time(), job_id)).rowcount == 1
+
+
+def _claim(job_id, owner):
+    from db import get_conn
+
+    now = time.time()
+    with get_conn() as conn:
+        claimed = conn.execute("""
+            UPDATE jobs SET status = 'running', owner = ?, lease_expires_at = ?, attempts = attempts + 1,
+                            started_at = COALESCE(started_at, ?)
+            WHERE job_id = ? AND finished_at IS NULL
+              AND (owner IS NULL OR owner = ? OR lease_expires_at < ?)
+        """, (owner, now + LEASE_SECONDS, now, job_id, owner, now)).rowcount
+        if not claimed:
+            return None
+        return conn.execute(
+            "SELECT job_id, kind, job_key, params, checkpoint, items_done, items_total FROM jobs WHERE job_id = ?",
+            (job_id,),
+        ).fetchone()
+
+
+def _finish(job_id, owner, status, result=None, error=None):
+    from db import get_conn
+
+    with get_conn() as conn:
+        conn.execute("""
+            UPDATE jobs SET status = ?, result = ?, error = ?, owner = NULL, lease_expires_at = NULL,
+                            finished_at = CASE WHEN ? = 'done' THEN ? END
+            WHERE job_id = ? AND owner = ?
+        """, (status, json.dumps(result) if result is not None else None, error, status, time.time(),
+              job_id, owner))
+
+
+def run(job_id, **context):
+    """Run (or resume) a job in this thread until it finishes.
+
+    ``context`` is passed on to the handler, for things that can't be stored
+    in the job's parameters (a Spotipy client, a progress callback).
+
+    Returns:
+        The handler's result, or None when another live owner is running the job
+        or it has already finished.
+
+    Raises:
+        Whatever the handler raised; the job is left ``failed`` and resumable.
+    """
+    from tracing import span
+
+    owner = _owner()
+    row = _claim(job_id, owner)
+    if row is None:
+        return None
+    job = Job(row, owner)
+    module, name = HANDLERS[job.kind].split(":")
+    handler = getattr(importlib.import_module(module), name)
+    try:
+        with span("jobs.run", kind=job.kind, job_id=job_id):
+            result = handler(job, **context)
+    except LeaseLost:
+        raise  # The new owner carries on; leave its row alone
+    except BaseException as e:
+        _finish(job_id, owner, "failed", error=f"{type(e).__name__}: {e}")
+        raise
+    _finish(job_id, owner, "done", result=result)
+    return result
+
+
+def progress(job_id):
+    """Status, counters and throughput of one job.
+
+    ``items_per_sec`` is measured over the last ``THROUGHPUT_BATCHES`` batches
+    and ``eta_seconds`` extrapolates it to ``items_total`` (None when either is
+    unknown).
+    """
+    from db import get_read_conn
+
+    with get_read_conn() as conn:
+        row = conn.execute("""
+            SELECT job_id, kind, job_key, status, items_done, items_total, batches_done, attempts,
+                   error, checkpoint, created_at, started_at, finished_at
+            FROM jobs WHERE job_id = ?
+        """, (job_id,)).fetchone()
+        if row is None:
+            return None
+        items, seconds = conn.execute("""
+            SELECT SUM(items), SUM(seconds) FROM (
+                SELECT items, seconds FROM job_batches WHERE job_id = ? ORDER BY committed_at DESC LIMIT ?
+            )
+        """, (job_id, THROUGHPUT_BATCHES)).fetchone()
+
+    info = dict(zip(("job_id", "kind", "key", "status", "items_done", "items_total", "batches_done", "attempts",
+                     "error", "checkpoint", "created_at", "started_at", "finished_at"), row))
+    info["checkpoint"] = json.loads(info["checkpoint"]) if info["checkpoint"] else None
+    info["items_per_sec"] = items / seconds if seconds else None
+    remaining = (info["items_total"] - info["items_done"]) if info["items_total"] is not None else None
+    info["eta_seconds"] = (max(0, remaining) / info["items_per_sec"]
+                           if remaining is not None and info["items_per_sec"] and info["finished_at"] is None
+                           else None)
+    return info
+
+
+def list_jobs(unfinished_only=False, limit=50):
+    """``progress`` of the newest jobs, newest first."""
+    from db import get_read_conn
+
+    with get_read_conn() as conn:
+        job_ids = [row[0] for row in conn.execute(
+            f"SELECT job_id FROM jobs {'WHERE finished_at IS NULL' if unfinished_only else ''} "
+            "ORDER BY job_id DESC LIMIT ?", (limit,)
+        )]
+    return [progress(job_id) for job_id in job_ids]
+
+
+def main():
+    from db import init_db
+
+    parser = argparse.ArgumentParser(description="List ETL jobs with their progress.")
+    parser.add_argument("--unfinished", action="store_true", help="Only jobs that can still be resumed")
+    parser.add_argument("--cancel", type=int, metavar="JOB_ID", help="Cancel an unfinished job")
+    args = parser.parse_args()
+
+    init_db()
+    if args.cancel is not None:
+        print(f"job {args.cancel} {'cancelled' if cancel(args.cancel) else 'is not unfinished'}")
+        return
+    for info in list_jobs(unfinished_only=args.unfinished):
+        total = f"/{info['items_total']:,}" if info["items_total"] is not None else ""
+        rate = f", {info['items_per_sec']:,.0f} items/s" if info["items_per_sec"] else ""
+        eta = f", ETA {info['eta_seconds']:,.0f}s" if info["eta_seconds"] is not None else ""
+        print(f"#{info['job_id']} {info['kind']} {info['key']}: {info['status']}, "
+              f"{info['items_done']:,}{total} items in {info['batches_done']} batches{rate}{eta}"
+              + (f" ({info['error']})" if info["error"] and info["status"] == "failed" else ""))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""Memoization for the ``df_*`` read queries, keyed on the DB data version.
+
+Every ETL write bumps the data version in the same transaction as its rows:
+the shared counter when tracks, artists or features change, and the user's
+own counter when their plays or top tracks do. A cached frame for a user is
+labelled with both, so it is reused exactly until new data of theirs (or
+shared data) is committed, whatever other users' refreshes do. The versions
+live in SQLite, which keeps this correct when loads happen in a different
+process than the dashboards.
+
+The shared cache is bounded by the total size of its results as well as
+their number, so a few users with long histories can't pin an unbounded amount
+of memory, and many small frames don't crowd each other out at an entry count
+sized for large ones. Recent Activity pages are cached separately
+(``cached_page``): paging through a history creates one entry per cursor, and
+those must not evict every user's dashboard frames.
+
+Cached DataFrames are shared between callers and must be treated as read-only.
+``versioned`` builds the same decorator over another ``QueryCache``; ``charts``
+uses it for rendered figures.
+"""
+import functools
+import inspect
+import sys
+import threading
+from collections import OrderedDict
+
+MAX_ENTRIES = 256  # Query results kept...
+MAX_BYTES = 64 * 1024 * 1024  # ...up to this much memory in total (see ``result_bytes``)
+PAGE_MAX_ENTRIES = 32  # Recent Activity pages kept, in their own cache
+
+
+def result_bytes(result):
+    """Approximate memory held by a cached result: deep usage for pandas objects, summed over tuples."""
+    if isinstance(result, (tuple, list)):
+        return sys.getsizeof(result) + sum(result_bytes(item) for item in result)
+    memory_usage = getattr(result, "memory_usage", None)
+    if callable(memory_usage):
+        usage = memory_usage(deep=True)  # Per column for a DataFrame, a number for a Series
+        return int(usage.sum()) if hasattr(usage, "sum") else int(usage)
+    return sys.getsizeof(result)
+
+
+class QueryCache:
+    """Bounded LRU of query results, one entry per (function, arguments).
+
+    Args:
+        max_entries: Most results kept.
+        max_bytes: Most total ``result_bytes`` kept, or None for no size bound.
+            A single result over it is not cached at all.
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (data version tuple, result, size in bytes)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def lookup(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+            self.misses += 1
+            return False, None
+
+    def store(self, key, version, result):
+        size = result_bytes(result) if self.max_bytes is not None else 0
+        with self._lock:
+            current = self._entries.get(key)
+            if current is not None and current[0] > version:
+                return  # A newer result landed while this one was computed
+            if current is not None:
+                self._bytes -= self._entries.pop(key)[2]
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._entries[key] = (version, result, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or (
+                    self.max_bytes is not None and self._bytes > self.max_bytes):
+                self._bytes -= self._entries.popitem(last=False)[1][2]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries), "bytes": self._bytes}
+
+
+_cache = QueryCache(MAX_ENTRIES, MAX_BYTES)
+_pages = QueryCache(PAGE_MAX_ENTRIES)
+
+
+def versioned(cache):
+    """Decorator factory: memoize a function in ``cache`` until the next ETL write.
+
+    Functions with a ``user_id`` parameter are labelled with that user's data
+    version as well as the shared one. The version is read *before* running
+    the function, so a result can only ever be labelled with a version at or
+    below the data it contains. The undecorated function stays available as
+    ``fn.__wrapped__``.
+    """
+    def decorator(fn):
+        signature = inspect.signature(fn)
+        per_user = "user_id" in signature.parameters
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            from db import get_read_conn, get_data_version, get_user_data_version
+
+            with get_read_conn() as conn:
+                version = (get_data_version(conn),)
+                if per_user:
+                    user_id = signature.bind(*args, **kwargs).arguments["user_id"]
+                    version += (get_user_data_version(conn, user_id),)
+            key = (fn.__module__, fn.__qualname__, args, tuple(sorted(kwargs.items())))
+            found, result = cache.lookup(key, version)
+            if found:
+                return result
+            result = fn(*args, **kwargs)
+            cache.store(key, version, result)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def cached_query(fn):
+    """Memoize a ``df_*`` function in the shared query cache until the next ETL write."""
+    return versioned(_cache)(fn)
+
+
+def cached_page(fn):
+    """Like ``cached_query``, in the small cache kept for keyset-paginated pages."""
+    return versioned(_pages)(fn)
+
+
+def cache_stats():
+    """Hit/miss counters, entry count and size of the query cache."""
+    return _cache.stats()
+
+
+def page_cache_stats():
+    """Hit/miss counters and entry count of the page cache."""
+    return _pages.stats()
+
+
+def clear_cache():
+    _cache.clear()
+    _pages.clear()
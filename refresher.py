@@ -0,0 +1,263 @@
+"""Background refresh of every connected user's data.
+
+The dashboard only reads SQLite; this module keeps it current by running
+``etl.refresh_all`` followed by ``etl.backfill_audio_features`` for each
+user with a stored token (see ``spotify_client.save_user_token``) on a
+jittered schedule.
+
+- Each user is refreshed every ``REFRESH_INTERVAL`` seconds, +/- ``JITTER``,
+  so users connected at the same time don't hit the API in lockstep.
+- A per-user ``RateBudget`` caps refreshes per window, including ones asked for
+  from the page, and failures back off exponentially up to ``MAX_BACKOFF``
+  (the page's requests, the very first sync included, wait out the backoff too).
+- Refreshes are single-flight: concurrent requests for a user in one process
+  share the same future, and a lease row in ``refresh_leases`` keeps a second
+  process (the app's thread and ``python refresher.py``) from duplicating it.
+- Scheduled refreshes call Spotify at background priority; ones a user asked
+  for from the page go ahead of them in the request scheduler (see ``scheduler``).
+
+Run standalone with ``python refresher.py`` (``--once`` for a single pass), or
+in-process with ``Refresher().start()``.
+"""
+import argparse
+import logging
+import os
+import random
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+REFRESH_INTERVAL = 15 * 60  # Seconds between scheduled refreshes of one user
+JITTER = 0.2  # Fraction of the interval each schedule is randomly moved by
+MAX_BACKOFF = 6 * 60 * 60  # Longest wait after repeated failures
+BUDGET_REFRESHES = 8  # Refreshes allowed per user...
+BUDGET_WINDOW = 60 * 60  # ...per this many seconds
+LEASE_SECONDS = 10 * 60  # A crashed refresher's lease expires after this
+POLL_SECONDS = 5.0  # How often the loop looks for due users and new connections
+MAX_WORKERS = 2  # Users refreshed concurrently
+
+logger = logging.getLogger("spotify_insights.refresher")
+
+
+class RateBudget:
+    """Token bucket per key: ``capacity`` uses, refilled evenly over ``window`` seconds."""
+
+    def __init__(self, capacity=BUDGET_REFRESHES, window=BUDGET_WINDOW, clock=time.monotonic):
+        self.capacity = capacity
+        self.rate = capacity / window
+        self.clock = clock
+        self._buckets = {}  # key -> (tokens, last refill time)
+        self._lock = threading.Lock()
+
+    def _refill(self, key):
+        now = self.clock()
+        tokens, last = self._buckets.get(key, (self.capacity, now))
+        tokens = min(self.capacity, tokens + (now - last) * self.rate)
+        self._buckets[key] = (tokens, now)
+        return tokens
+
+    def try_acquire(self, key):
+        with self._lock:
+            tokens = self._refill(key)
+            if tokens < 1:
+                return False
+            self._buckets[key] = (tokens - 1, self._buckets[key][1])
+            return True
+
+    def retry_in(self, key):
+        """Seconds until ``key`` can spend again (0 if it can now)."""
+        with self._lock:
+            tokens = self._refill(key)
+            return 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+
+
+def _lease_owner():
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+
+def acquire_lease(user_id, owner, seconds=LEASE_SECONDS):
+    """Take the refresh lease for a user unless another live owner holds it."""
+    from db import get_conn
+
+    now = time.time()
+    with get_conn() as conn:
+        taken = conn.execute("""
+            INSERT INTO refresh_leases (user_id, owner, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+            WHERE refresh_leases.expires_at < ? OR refresh_leases.owner = excluded.owner
+        """, (user_id, owner, now + seconds, now)).rowcount
+    return taken == 1
+
+
+def release_lease(user_id, owner):
+    from db import get_conn
+
+    with get_conn() as conn:
+        conn.execute("DELETE FROM refresh_leases WHERE user_id = ? AND owner = ?", (user_id, owner))
+
+
+class Refresher:
+    """Schedules and runs per-user refreshes on a small thread pool.
+
+    Args:
+        interval: Seconds between scheduled refreshes of one user.
+        jitter: Fraction of ``interval`` each schedule is randomly moved by.
+        budget: RateBudget shared by scheduled and requested refreshes.
+        max_workers: Users refreshed concurrently.
+        client_factory: ``(user_id, priority) -> Spotipy client``; defaults to the stored-token client.
+        users: Callable returning the user IDs to keep in sync.
+    """
+
+    def __init__(self, interval=REFRESH_INTERVAL, jitter=JITTER, budget=None, max_workers=MAX_WORKERS,
+                 client_factory=None, users=None):
+        from spotify_client import connected_users, spotify_for_user
+
+        self.interval = interval
+        self.jitter = jitter
+        self.budget = budget or RateBudget()
+        self.client_factory = client_factory or spotify_for_user
+        self.users = users or connected_users
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="refresher")
+        self._lock = threading.Lock()
+        self._inflight = {}  # user_id -> Future
+        self._next_due = {}  # user_id -> time.monotonic() of the next scheduled refresh
+        self._failures = {}  # user_id -> consecutive failures
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _jittered(self, seconds):
+        return seconds * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _backoff_in(self, user_id):
+        """Seconds left of ``user_id``'s backoff after failed refreshes (0 if none); needs ``_lock``."""
+        if not self._failures.get(user_id):
+            return 0.0
+        return max(0.0, self._next_due.get(user_id, 0.0) - time.monotonic())
+
+    def retry_in(self, user_id):
+        """Seconds until ``request`` will start a refresh for ``user_id`` (0 if it would now)."""
+        with self._lock:
+            backoff = self._backoff_in(user_id)
+        return max(backoff, self.budget.retry_in(user_id))
+
+    def request(self, user_id, interactive=False):
+        """Refresh ``user_id`` now, unless one is already running, it is backing off or the budget is spent.
+
+        With ``interactive`` its API calls are scheduled ahead of background ones,
+        for a user waiting on the page.
+
+        Returns:
+            The Future of the (possibly already running) refresh, or None when
+            the user's backoff or budget doesn't allow one yet (see ``retry_in``).
+        """
+        with self._lock:
+            future = self._inflight.get(user_id)
+            if future is not None:
+                return future
+            if self._backoff_in(user_id) > 0 or not self.budget.try_acquire(user_id):
+                return None
+            future = self._inflight[user_id] = self._pool.submit(self._refresh, user_id, interactive)
+        future.add_done_callback(lambda _: self._done(user_id))
+        return future
+
+    def _done(self, user_id):
+        with self._lock:
+            self._inflight.pop(user_id, None)
+
+    def _refresh(self, user_id, interactive=False):
+        import etl
+        from scheduler import BACKGROUND, INTERACTIVE
+        from tracing import span
+
+        owner = _lease_owner()
+        if not acquire_lease(user_id, owner):
+            # Another process is refreshing this user; check back on the normal schedule
+            with self._lock:
+                self._next_due[user_id] = time.monotonic() + self._jittered(self.interval)
+            return None
+        try:
+            with span("refresher.refresh", user_id=user_id):
+                sp = self.client_factory(user_id, INTERACTIVE if interactive else BACKGROUND)
+                result = etl.refresh_all(sp, user_id=user_id)
+                # Tracks that arrived without features (recent plays, imports) are filled in here
+                result["audio_features"] = etl.backfill_audio_features(sp)
+        except Exception:
+            with self._lock:
+                failures = self._failures[user_id] = self._failures.get(user_id, 0) + 1
+                delay = min(MAX_BACKOFF, self.interval * 2 ** failures)
+                self._next_due[user_id] = time.monotonic() + self._jittered(delay)
+            logger.exception("Refresh failed for %s (attempt %d), next try in %.0fs", user_id, failures, delay)
+            raise
+        finally:
+            release_lease(user_id, owner)
+        with self._lock:
+            self._failures.pop(user_id, None)
+            self._next_due[user_id] = time.monotonic() + self._jittered(self.interval)
+        return result
+
+    def run_due(self):
+        """Start refreshes for every user whose schedule has come up. Returns their futures."""
+        now = time.monotonic()
+        started = []
+        for user_id in self.users():
+            with self._lock:
+                # New users start at a random point in the first interval
+                due = self._next_due.setdefault(user_id, now + random.uniform(0, self.jitter * self.interval))
+            if due <= now and user_id not in self._inflight:
+                future = self.request(user_id)
+                if future is None:
+                    with self._lock:
+                        self._next_due[user_id] = now + self.budget.retry_in(user_id)
+                else:
+                    started.append(future)
+        return started
+
+    def run_forever(self, poll=POLL_SECONDS):
+        while not self._stop.is_set():
+            self.run_due()
+            self._stop.wait(poll)
+
+    def start(self):
+        """Run the schedule on a daemon thread; returns self."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run_forever, name="refresher", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, wait=True):
+        self._stop.set()
+        if self._thread is not None and wait:
+            self._thread.join()
+        self._pool.shutdown(wait=wait)
+
+
+def main():
+    from concurrent.futures import wait
+    from db import init_db
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description="Keep every connected user's Spotify data in sync.")
+    parser.add_argument("--once", action="store_true", help="Refresh every connected user once and exit")
+    parser.add_argument("--interval", type=float, default=REFRESH_INTERVAL, help="Seconds between refreshes")
+    args = parser.parse_args()
+
+    load_dotenv()
+    init_db()
+    refresher = Refresher(interval=args.interval)
+    if args.once:
+        futures = [future for future in map(refresher.request, refresher.users()) if future is not None]
+        wait(futures)
+        for future in futures:
+            if future.exception():
+                print(f"refresh failed: {future.exception()}")
+        refresher.stop()
+        return
+    try:
+        refresher.run_forever()
+    except KeyboardInterrupt:
+        refresher.stop(wait=False)
+
+
+if __name__ == "__main__":
+    main()
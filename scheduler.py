@@ -0,0 +1,320 @@
+"""Rate-limit-aware scheduling of Spotify Web API requests.
+
+Every request that reaches the network goes through a ``SchedulingAdapter``,
+which sits under ``http_cache.CachingAdapter``, so cache hits cost nothing. It
+hands each request to the process-wide ``RequestScheduler``, which does four
+things:
+
+- Token bucket. A ``SharedTokenBucket`` row in the HTTP cache database refills
+  at ``RATE`` requests/s up to ``BURST``. Every process on the host (the app
+  server, ``python refresher.py``, imports) spends from the same row.
+- Retry-After. A 429 empties the bucket and blocks it for every process until
+  ``Retry-After`` has passed. The request then waits for its turn again, up to
+  ``MAX_RETRIES`` times, before the 429 is handed back to Spotipy.
+- Priority. ``INTERACTIVE`` requests (a user waiting on the page) go before
+  ``BACKGROUND`` ones (scheduled refreshes, backfills). In a process, waiters
+  queue by priority, then by arrival. Across processes, background requests
+  leave ``BACKGROUND_RESERVE`` tokens in the bucket for interactive ones.
+- Coalescing. Identical GETs that are in flight at the same time in one
+  process (same URL, and the same token for ``/me`` endpoints) share one
+  network call.
+
+``RequestScheduler.stats()`` reports queue depth and wait times per priority,
+plus counts of requests, coalesced calls and 429s.
+"""
+import heapq
+import itertools
+import sqlite3
+import threading
+import time
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from http_cache import CACHE_PATH, cache_key
+
+INTERACTIVE = 0
+BACKGROUND = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BACKGROUND: "background"}
+
+RATE = 10.0  # Requests per second, summed over every process on this host
+BURST = 20  # Requests that may go out back to back after a quiet spell
+BACKGROUND_RESERVE = 4  # Tokens background requests leave for interactive ones
+MAX_RETRIES = 3  # 429s the scheduler absorbs before handing the response back
+DEFAULT_RETRY_AFTER = 1.0  # Seconds to hold off after a 429 without a Retry-After header
+MAX_SLEEP = 0.25  # Longest nap between bucket checks, so the queue order is re-read often
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS rate_buckets (
+        name           TEXT PRIMARY KEY,
+        tokens         REAL NOT NULL,
+        refilled_at    REAL NOT NULL,            -- unix seconds ``tokens`` was computed at
+        blocked_until  REAL NOT NULL DEFAULT 0   -- unix seconds; set from Retry-After
+    );
+"""
+
+
+class SharedTokenBucket:
+    """Token bucket stored in SQLite, so separate processes draw from the same budget."""
+
+    def __init__(self, path=CACHE_PATH, name="spotify", rate=RATE, burst=BURST, clock=time.time):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self._lock = threading.Lock()
+        # Autocommit mode: every change below runs in an explicit BEGIN IMMEDIATE
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode = WAL;")
+        self._conn.execute("PRAGMA synchronous = NORMAL;")
+        self._conn.executescript(SCHEMA)
+        self._conn.execute(
+            "INSERT OR IGNORE INTO rate_buckets (name, tokens, refilled_at) VALUES (?, ?, ?)",
+            (name, burst, clock()),
+        )
+
+    def _update(self, fn):
+        # Read, refill, apply ``fn`` and write back in one write transaction
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                tokens, refilled_at, blocked_until = self._conn.execute(
+                    "SELECT tokens, refilled_at, blocked_until FROM rate_buckets WHERE name = ?", (self.name,)
+                ).fetchone()
+                now = self.clock()
+                tokens = min(self.burst, tokens + max(0.0, now - refilled_at) * self.rate)
+                tokens, refilled_at, blocked_until, result = fn(now, tokens, max(now, refilled_at), blocked_until)
+                self._conn.execute(
+                    "UPDATE rate_buckets SET tokens = ?, refilled_at = ?, blocked_until = ? WHERE name = ?",
+                    (tokens, refilled_at, blocked_until, self.name),
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return result
+
+    def try_acquire(self, reserve=0):
+        """Take one token if at least ``reserve`` would be left (capped below ``burst``).
+
+        Returns:
+            0.0 when a token was taken, otherwise the seconds to wait before trying again.
+        """
+        reserve = min(reserve, self.burst - 1)
+
+        def take(now, tokens, refilled_at, blocked_until):
+            if now < blocked_until:
+                return tokens, refilled_at, blocked_until, blocked_until - now
+            if tokens >= 1 + reserve:
+                return tokens - 1, refilled_at, blocked_until, 0.0
+            return tokens, refilled_at, blocked_until, (1 + reserve - tokens) / self.rate
+
+        return self._update(take)
+
+    def block(self, seconds):
+        """Spend every token and hold all requests for ``seconds`` (after a 429)."""
+        def drain(now, tokens, refilled_at, blocked_until):
+            until = max(blocked_until, now + seconds)
+            return 0.0, until, until, None  # Refilling resumes once the block is over
+
+        self._update(drain)
+
+    def peek(self):
+        """``(tokens, seconds still blocked)`` as of now, without spending anything."""
+        return self._update(lambda now, tokens, refilled_at, blocked_until: (
+            tokens, refilled_at, blocked_until, (tokens, max(0.0, blocked_until - now))))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class _Flight:
+    """One network call that identical concurrent requests wait on."""
+
+    def __init__(self, ticket):
+        self.ticket = ticket  # The leader's queue entry, promoted if an interactive request joins
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
+def _copy_response(request, response):
+    copy = requests.Response()
+    copy.status_code = response.status_code
+    copy.reason = response.reason
+    copy.headers = CaseInsensitiveDict(response.headers)
+    copy._content = response.content
+    copy.encoding = response.encoding
+    copy.url = request.url
+    copy.request = request
+    return copy
+
+
+class RequestScheduler:
+    """Orders, paces and coalesces the requests of one process.
+
+    Args:
+        bucket: SharedTokenBucket to spend from (the default one next to the HTTP cache).
+        max_retries: 429s absorbed per request.
+        background_reserve: Tokens background requests leave for interactive ones.
+    """
+
+    def __init__(self, bucket=None, max_retries=MAX_RETRIES, background_reserve=BACKGROUND_RESERVE):
+        self.bucket = bucket or SharedTokenBucket()
+        self.max_retries = max_retries
+        self.background_reserve = background_reserve
+        self._cond = threading.Condition()
+        self._queue = []  # Heap of [priority, arrival] tickets waiting for a token
+        self._arrivals = itertools.count()
+        self._inflight = {}  # Request key -> _Flight
+        self._counts = {"requests": 0, "coalesced": 0, "throttled": 0, "retried": 0}
+        self._waits = {name: {"count": 0, "total_ms": 0.0, "max_ms": 0.0} for name in PRIORITY_NAMES.values()}
+
+    def _count(self, name):
+        with self._cond:
+            self._counts[name] += 1
+
+    def _ticket(self, priority):
+        ticket = [priority, next(self._arrivals)]
+        with self._cond:
+            heapq.heappush(self._queue, ticket)
+        return ticket
+
+    def _wait_turn(self, ticket):
+        """Block until ``ticket`` heads the queue and a token is taken; returns the wait in seconds."""
+        start = time.monotonic()
+        try:
+            while True:
+                with self._cond:
+                    while self._queue[0] is not ticket:
+                        self._cond.wait()
+                reserve = 0 if ticket[0] == INTERACTIVE else self.background_reserve
+                delay = self.bucket.try_acquire(reserve)
+                if delay <= 0:
+                    break
+                time.sleep(min(delay, MAX_SLEEP))
+        finally:
+            with self._cond:
+                self._queue.remove(ticket)
+                heapq.heapify(self._queue)
+                self._cond.notify_all()
+        waited = time.monotonic() - start
+        with self._cond:
+            agg = self._waits[PRIORITY_NAMES[ticket[0]]]
+            agg["count"] += 1
+            agg["total_ms"] += waited * 1000
+            agg["max_ms"] = max(agg["max_ms"], waited * 1000)
+        return waited
+
+    def _promote(self, ticket, priority):
+        with self._cond:
+            if priority < ticket[0] and ticket in self._queue:
+                ticket[0] = priority
+                heapq.heapify(self._queue)
+                self._cond.notify_all()
+
+    def send(self, transport, request, priority, **kwargs):
+        """Send ``request`` through ``transport`` once it is this request's turn."""
+        if request.method != "GET":
+            return self._send(transport, request, self._ticket(priority), **kwargs)
+
+        key = cache_key(request)
+        with self._cond:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight(self._ticket(priority))
+            else:
+                self._counts["coalesced"] += 1
+        if not leader:
+            self._promote(flight.ticket, priority)
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return _copy_response(request, flight.response)
+
+        try:
+            flight.response = self._send(transport, request, flight.ticket, **kwargs)
+            flight.response.content  # Read the body now, so followers can share it
+            return flight.response
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._cond:
+                del self._inflight[key]
+            flight.done.set()
+
+    def _send(self, transport, request, ticket, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self._count("retried")
+                with self._cond:
+                    ticket[1] = next(self._arrivals)  # Back of its priority class
+                    heapq.heappush(self._queue, ticket)
+            self._wait_turn(ticket)
+            self._count("requests")
+            response = transport.send(request, **kwargs)
+            if response.status_code != 429:
+                return response
+            self._count("throttled")
+            try:
+                retry_after = float(response.headers.get("Retry-After", DEFAULT_RETRY_AFTER))
+            except ValueError:
+                retry_after = DEFAULT_RETRY_AFTER
+            self.bucket.block(retry_after)
+            if attempt == self.max_retries:
+                return response
+
+    def stats(self):
+        """Queue depth and waits per priority, plus request, coalesced, retry and 429 counts."""
+        tokens, blocked_for = self.bucket.peek()
+        with self._cond:
+            queued = {name: 0 for name in PRIORITY_NAMES.values()}
+            for priority, _ in self._queue:
+                queued[PRIORITY_NAMES[priority]] += 1
+            return {
+                **self._counts,
+                "queued": queued,
+                "in_flight": len(self._inflight),
+                "waits": {name: dict(agg) for name, agg in self._waits.items()},
+                "tokens": round(tokens, 2),
+                "blocked_for": round(blocked_for, 3),
+            }
+
+
+class SchedulingAdapter(BaseAdapter):
+    """Transport adapter that sends every request through a ``RequestScheduler``.
+
+    Args:
+        inner: Transport that does the actual I/O (defaults to a plain ``HTTPAdapter``).
+        scheduler: RequestScheduler to queue on (defaults to the process-wide one).
+        priority: ``INTERACTIVE`` or ``BACKGROUND``, for every request of this adapter.
+    """
+
+    def __init__(self, inner=None, scheduler=None, priority=BACKGROUND):
+        super().__init__()
+        self.inner = inner or HTTPAdapter()
+        self.scheduler = scheduler or get_scheduler()
+        self.priority = priority
+
+    def send(self, request, **kwargs):
+        return self.scheduler.send(self.inner, request, self.priority, **kwargs)
+
+    def close(self):
+        self.inner.close()
+
+
+_default_scheduler = None
+_default_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """Process-wide RequestScheduler on the bucket next to the HTTP cache."""
+    global _default_scheduler
+    with _default_scheduler_lock:
+        if _default_scheduler is None:
+            _default_scheduler = RequestScheduler()
+        return _default_scheduler
@@ -0,0 +1,472 @@
+"""Track similarity over ``audio_features`` for "more like this" lookups.
+
+All feature vectors live in one contiguous float32 matrix. Each column is
+z-scored with the catalogue's mean and std, then each row is L2-normalised,
+so cosine similarity is a plain dot product. A batch of queries is one BLAS
+matmul followed by ``argpartition``.
+
+Large catalogues (``IVF_MIN_TRACKS`` and up) also get an inverted-file index.
+k-means centroids split the rows into contiguous lists, and a query only
+scans the ``nprobe`` lists closest to it.
+
+The index persists under ``INDEX_DIR`` as ``.npy`` files opened with
+``mmap_mode="r"``, so startup maps it instead of rebuilding it. ``get_index()``
+picks up tracks added since the last load by ``audio_features`` rowid,
+whenever the DB data version moves. New rows go to a small in-memory tail that
+is appended to raw tail files on save, so the mapped base matrix is neither
+copied nor rewritten; once the tail passes ``REBUILD_TAIL_FRACTION`` of the
+index it is merged into the base (and the IVF rebuilt) and the whole index is
+written again. Updated feature values for tracks already in the index are only
+picked up by a rebuild.
+"""
+import json
+import os
+import threading
+
+import numpy as np
+
+from db import DB_PATH
+
+INDEX_DIR = os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "similarity")
+FEATURES = ("danceability", "energy", "key", "loudness", "mode", "speechiness",
+            "acousticness", "instrumentalness", "liveness", "valence", "tempo")
+IVF_MIN_TRACKS = 200_000  # Catalogue size from which an IVF index is built
+IVF_NPROBE = 8  # Lists scanned per query
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE = 100_000  # Rows used to train the centroids
+MAX_SCORE_CELLS = 1 << 24  # Query rows x candidates scored per matmul (64 MB of float32)
+REBUILD_TAIL_FRACTION = 0.1  # Merge the tail (and rebuild the IVF) once this share of rows is in it
+TAIL_VECTORS = "tail_vectors.f32"  # Raw float32 rows appended since the base was written
+TAIL_TRACK_IDS = "tail_track_ids.txt"  # Their track IDs, one per line
+
+
+def _normalize(features, mean, std):
+    vectors = ((np.asarray(features, dtype=np.float32) - mean) / std).astype(np.float32)
+    vectors = np.nan_to_num(vectors, copy=False)  # Missing features count as average
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _top_k(scores, k):
+    """Column indices of the ``k`` largest scores per row, best first."""
+    k = min(k, scores.shape[1])
+    if k == 0:
+        return np.empty((scores.shape[0], 0), dtype=np.int64)
+    part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, part, axis=1), axis=1)
+    return np.take_along_axis(part, order, axis=1)
+
+
+def kmeans(vectors, n_clusters, iterations=KMEANS_ITERATIONS, sample=KMEANS_SAMPLE, seed=0):
+    """Spherical k-means on a sample of unit vectors. Returns unit-norm centroids."""
+    rng = np.random.default_rng(seed)
+    if len(vectors) > sample:
+        vectors = vectors[rng.choice(len(vectors), sample, replace=False)]
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assign = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, vectors)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        empty = norms[:, 0] == 0
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]  # Reseed empty clusters
+        norms[empty] = 1.0
+        centroids = sums / norms
+    return centroids.astype(np.float32)
+
+
+class SimilarityIndex:
+    """Normalised feature matrix plus optional IVF lists.
+
+    Rows are numbered across the base matrix and then the tail. Rows
+    ``[0, ivf_rows)`` are grouped by IVF list (``offsets[i]:offsets[i + 1]``
+    is list i); rows added afterwards are always scanned.
+
+    Args:
+        vectors: (n, len(FEATURES)) float32 base matrix of normalised rows.
+        track_ids: Array of n track IDs, row-aligned with ``vectors``.
+        mean, std: Per-feature statistics used to normalise new rows.
+        max_rowid: Highest ``audio_features`` rowid included.
+        centroids, offsets: IVF lists, or None for brute force only.
+        tail_vectors, tail_ids: Rows added after the base, in memory.
+    """
+
+    def __init__(self, vectors, track_ids, mean, std, max_rowid=0, centroids=None, offsets=None,
+                 tail_vectors=None, tail_ids=None):
+        self.vectors = vectors
+        self.track_ids = track_ids
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.std = np.asarray(std, dtype=np.float32)
+        self.max_rowid = max_rowid
+        self.centroids = centroids
+        self.offsets = offsets
+        self.tail_vectors = np.empty((0, len(FEATURES)), dtype=np.float32) if tail_vectors is None else tail_vectors
+        self.tail_ids = np.empty(0, dtype=str) if tail_ids is None else tail_ids
+        self._positions = None
+        self._saved = None  # (path, tail rows) while the base matrix matches the one saved under path
+
+    def __len__(self):
+        return len(self.track_ids) + len(self.tail_ids)
+
+    @property
+    def ivf_rows(self):
+        return int(self.offsets[-1]) if self.offsets is not None else 0
+
+    @property
+    def positions(self):
+        """track_id -> row, built on first use."""
+        if self._positions is None:
+            self._positions = dict(zip(self.track_ids.tolist() + self.tail_ids.tolist(), range(len(self))))
+        return self._positions
+
+    def track_id(self, row):
+        base = len(self.track_ids)
+        return str(self.track_ids[row] if row < base else self.tail_ids[row - base])
+
+    def _rows(self, start, stop):
+        """Rows ``[start, stop)``; only copied when the range spans the base and the tail."""
+        base = len(self.vectors)
+        if stop <= base:
+            return self.vectors[start:stop]
+        if start >= base:
+            return self.tail_vectors[start - base:stop - base]
+        return np.concatenate([self.vectors[start:], self.tail_vectors[:stop - base]])
+
+    def _take(self, rows):
+        """Rows at the given positions, from the base or the tail."""
+        rows = np.asarray(rows, dtype=np.int64)
+        in_base = rows < len(self.vectors)
+        out = np.empty((len(rows), len(FEATURES)), dtype=np.float32)
+        out[in_base] = self.vectors[rows[in_base]]
+        out[~in_base] = self.tail_vectors[rows[~in_base] - len(self.vectors)]
+        return out
+
+    # ---------- Building ----------
+
+    @classmethod
+    def from_features(cls, track_ids, features, max_rowid=0, ivf=None):
+        """Build from raw feature rows (``FEATURES`` order).
+
+        ``ivf`` forces the IVF index on or off; by default it is built from
+        ``IVF_MIN_TRACKS`` tracks.
+        """
+        features = np.asarray(features, dtype=np.float64).reshape(-1, len(FEATURES))
+        mean = np.nanmean(features, axis=0) if len(features) else np.zeros(len(FEATURES))
+        std = np.nanstd(features, axis=0) if len(features) else np.ones(len(FEATURES))
+        mean = np.nan_to_num(mean)
+        std = np.where(np.nan_to_num(std) > 0, np.nan_to_num(std), 1.0)
+        index = cls(_normalize(features, mean, std), np.asarray(track_ids, dtype=str), mean, std, max_rowid)
+        if ivf or (ivf is None and len(index) >= IVF_MIN_TRACKS):
+            index.build_ivf()
+        return index
+
+    @classmethod
+    def from_db(cls, ivf=None):
+        """Build from every row of ``audio_features``."""
+        from db import get_read_conn
+
+        with get_read_conn() as conn:
+            rows = conn.execute(
+                f"SELECT rowid, track_id, {', '.join(FEATURES)} FROM audio_features ORDER BY rowid"
+            ).fetchall()
+        if not rows:
+            return cls.from_features([], [], ivf=False)
+        max_rowid = rows[-1][0]
+        track_ids = [row[1] for row in rows]
+        features = np.array([row[2:] for row in rows], dtype=np.float64)  # None -> nan
+        return cls.from_features(track_ids, features, max_rowid, ivf)
+
+    def compact(self):
+        """Merge the tail into the base matrix (one copy of the whole index)."""
+        if not len(self.tail_ids):
+            return
+        self.vectors = np.concatenate([self.vectors, self.tail_vectors])
+        self.track_ids = np.concatenate([self.track_ids, self.tail_ids])
+        self.tail_vectors = self.tail_vectors[:0]
+        self.tail_ids = self.tail_ids[:0]
+        self._saved = None
+
+    def build_ivf(self, n_lists=None, iterations=KMEANS_ITERATIONS):
+        """Cluster all rows into ``n_lists`` (default ~sqrt(n)) lists and reorder rows by list."""
+        self.compact()
+        n = len(self)
+        if n == 0:
+            return
+        n_lists = n_lists or max(1, int(np.sqrt(n)))
+        vectors = np.ascontiguousarray(self.vectors)
+        centroids = kmeans(vectors, min(n_lists, n), iterations)
+        assign = np.empty(n, dtype=np.int64)
+        step = max(1, MAX_SCORE_CELLS // len(centroids))
+        for start in range(0, n, step):
+            assign[start:start + step] = np.argmax(vectors[start:start + step] @ centroids.T, axis=1)
+        order = np.argsort(assign, kind="stable")
+        self.vectors = vectors[order]
+        self.track_ids = self.track_ids[order]
+        self.centroids = centroids
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=len(centroids)))])
+        self._positions = None
+        self._saved = None
+
+    def add(self, track_ids, features, max_rowid=None):
+        """Append tracks to the tail, normalised with the existing statistics. Returns rows added.
+
+        The tail is merged into the base (rebuilding the IVF, if any) once it
+        holds more than ``REBUILD_TAIL_FRACTION`` of the rows.
+        """
+        known = self.positions
+        rows = [(track_id, row) for track_id, row in zip(track_ids, features) if track_id not in known]
+        if max_rowid is not None:
+            self.max_rowid = max(self.max_rowid, max_rowid)
+        if not rows:
+            return 0
+        new_ids = np.asarray([track_id for track_id, _ in rows], dtype=str)
+        new_vectors = _normalize(np.array([row for _, row in rows], dtype=np.float64), self.mean, self.std)
+        start = len(self)
+        self.tail_vectors = np.concatenate([self.tail_vectors, new_vectors])
+        self.tail_ids = np.concatenate([self.tail_ids, new_ids])
+        for i, track_id in enumerate(new_ids.tolist(), start):
+            known[track_id] = i
+        if self.offsets is not None and len(self) - self.ivf_rows > REBUILD_TAIL_FRACTION * len(self):
+            self.build_ivf()
+        elif self.offsets is None and len(self) >= IVF_MIN_TRACKS:
+            self.build_ivf()
+        elif len(self.tail_ids) > REBUILD_TAIL_FRACTION * len(self):
+            self.compact()
+        return len(rows)
+
+    def sync(self):
+        """Add ``audio_features`` rows newer than ``max_rowid``. Returns rows added."""
+        from db import get_read_conn
+
+        with get_read_conn() as conn:
+            rows = conn.execute(
+                f"SELECT rowid, track_id, {', '.join(FEATURES)} FROM audio_features WHERE rowid > ? ORDER BY rowid",
+                (self.max_rowid,),
+            ).fetchall()
+        if not rows:
+            return 0
+        return self.add([row[1] for row in rows], [row[2:] for row in rows], rows[-1][0])
+
+    # ---------- Queries ----------
+
+    def _scan(self, queries, candidates, k, exclude):
+        """Top-k over candidate row ranges for each query; returns (rows, scores) lists."""
+        best_rows = []
+        best_scores = []
+        for q, ranges, skip in zip(queries, candidates, exclude):
+            rows = np.concatenate([np.arange(a, b) for a, b in ranges]) if len(ranges) > 1 else None
+            block = self._take(rows) if rows is not None else self._rows(*ranges[0])
+            scores = block @ q
+            if skip is not None:
+                local = np.nonzero(rows == skip)[0] if rows is not None else [skip - ranges[0][0]]
+                for i in local:
+                    if 0 <= i < len(scores):
+                        scores[i] = -np.inf
+            top = _top_k(scores[None, :], k)[0]
+            best_rows.append(rows[top] if rows is not None else top + ranges[0][0])
+            best_scores.append(scores[top])
+        return best_rows, best_scores
+
+    def search(self, queries, k=10, exclude=None, nprobe=IVF_NPROBE):
+        """k nearest rows for a batch of normalised query vectors.
+
+        Args:
+            queries: (b, len(FEATURES)) normalised vectors.
+            k: Neighbours per query.
+            exclude: Optional row per query to leave out (the query track itself).
+            nprobe: IVF lists scanned per query; ignored without an IVF index.
+
+        Returns:
+            (rows, scores): two (b, k) arrays, best first. Rows are -1 where fewer
+            than k candidates exist.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        b = len(queries)
+        exclude = [None] * b if exclude is None else list(exclude)
+        out_rows = np.full((b, k), -1, dtype=np.int64)
+        out_scores = np.full((b, k), -np.inf, dtype=np.float32)
+        if len(self) == 0 or b == 0:
+            return out_rows, out_scores
+
+        if self.offsets is None:
+            # Brute force: one matmul per block of queries, sized to bound memory
+            step = max(1, MAX_SCORE_CELLS // len(self))
+            for start in range(0, b, step):
+                scores = queries[start:start + step] @ self.vectors.T
+                if len(self.tail_ids):
+                    scores = np.hstack([scores, queries[start:start + step] @ self.tail_vectors.T])
+                for i, skip in enumerate(exclude[start:start + step]):
+                    if skip is not None:
+                        scores[i, skip] = -np.inf
+                top = _top_k(scores, k + 1)[:, :k]
+                out_rows[start:start + step, :top.shape[1]] = top
+                out_scores[start:start + step, :top.shape[1]] = np.take_along_axis(scores, top, axis=1)
+        else:
+            probes = _top_k(queries @ self.centroids.T, min(nprobe, len(self.centroids)))
+            tail = (self.ivf_rows, len(self))
+            candidates = [
+                [(int(self.offsets[p]), int(self.offsets[p + 1])) for p in row] + ([tail] if tail[1] > tail[0] else [])
+                for row in probes
+            ]
+            rows, scores = self._scan(queries, candidates, k, exclude)
+            for i, (r, s) in enumerate(zip(rows, scores)):
+                keep = np.isfinite(s)[:k]
+                out_rows[i, :keep.sum()] = r[:k][keep]
+                out_scores[i, :keep.sum()] = s[:k][keep]
+        out_rows[~np.isfinite(out_scores)] = -1
+        return out_rows, out_scores
+
+    def neighbors(self, track_ids, k=10, nprobe=IVF_NPROBE):
+        """Most similar tracks for each of ``track_ids``.
+
+        Returns:
+            One list of ``(track_id, score)`` per input, best first; empty for
+            tracks without audio features.
+        """
+        positions = self.positions
+        found = [(i, positions[t]) for i, t in enumerate(track_ids) if t in positions]
+        result = [[] for _ in track_ids]
+        if not found:
+            return result
+        rows = np.array([row for _, row in found])
+        top_rows, top_scores = self.search(self._take(rows), k, exclude=rows, nprobe=nprobe)
+        for (i, _), neighbour_rows, scores in zip(found, top_rows, top_scores):
+            result[i] = [(self.track_id(r), float(s)) for r, s in zip(neighbour_rows, scores) if r >= 0]
+        return result
+
+    # ---------- Persistence ----------
+
+    def save(self, path=INDEX_DIR):
+        """Write the index under ``path``; ``meta.json`` is replaced last.
+
+        When ``path`` already holds this base matrix, only the tail rows added
+        since are appended to the tail files. Otherwise the base is written as
+        ``.npy`` files and the tail files are started afresh.
+        """
+        path = os.path.abspath(path)
+        if self._saved is not None and self._saved[0] == path:
+            if self._saved[1] != len(self.tail_ids):
+                self._append_tail(path, self._saved[1])
+                self._write_meta(path)
+            self._saved = (path, len(self.tail_ids))
+            return
+        os.makedirs(path, exist_ok=True)
+        arrays = {"vectors": np.ascontiguousarray(self.vectors, dtype=np.float32), "track_ids": self.track_ids}
+        if self.offsets is not None:
+            arrays["centroids"] = self.centroids
+            arrays["offsets"] = self.offsets
+        for name, array in arrays.items():
+            tmp = os.path.join(path, f"{name}.{os.getpid()}.tmp.npy")
+            np.save(tmp, array)
+            os.replace(tmp, os.path.join(path, f"{name}.npy"))
+        self._write_meta(path, tail_rows=0)
+        self._append_tail(path, 0)
+        if len(self.tail_ids):
+            self._write_meta(path)
+        self._saved = (path, len(self.tail_ids))
+
+    def _append_tail(self, path, saved_rows):
+        """Append tail rows from ``saved_rows`` on, first cutting off anything a torn append left behind."""
+        id_bytes = sum(len(track_id.encode()) + 1 for track_id in self.tail_ids[:saved_rows].tolist())
+        with open(os.path.join(path, TAIL_VECTORS), "ab") as f:
+            f.truncate(saved_rows * len(FEATURES) * 4)
+            np.ascontiguousarray(self.tail_vectors[saved_rows:], dtype=np.float32).tofile(f)
+        with open(os.path.join(path, TAIL_TRACK_IDS), "ab") as f:
+            f.truncate(id_bytes)
+            f.write("".join(f"{track_id}\n" for track_id in self.tail_ids[saved_rows:].tolist()).encode())
+
+    def _write_meta(self, path, tail_rows=None):
+        meta = {"features": list(FEATURES), "mean": self.mean.tolist(), "std": self.std.tolist(),
+                "max_rowid": self.max_rowid, "rows": len(self.track_ids),
+                "tail_rows": len(self.tail_ids) if tail_rows is None else tail_rows,
+                "ivf": self.offsets is not None}
+        tmp = os.path.join(path, f"meta.{os.getpid()}.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp, os.path.join(path, "meta.json"))
+
+    @classmethod
+    def load(cls, path=INDEX_DIR, mmap=True):
+        """Open a saved index, memory-mapping its base arrays. Returns None if absent or stale.
+
+        The tail files are read into memory up to the row count in ``meta.json``;
+        anything past it is an append that never got recorded and is ignored.
+        """
+        path = os.path.abspath(path)
+        try:
+            with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+                meta = json.load(f)
+            mode = "r" if mmap else None
+            vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode=mode)
+            track_ids = np.load(os.path.join(path, "track_ids.npy"), mmap_mode=mode)
+            centroids = offsets = None
+            if meta["ivf"]:
+                centroids = np.load(os.path.join(path, "centroids.npy"))
+                offsets = np.load(os.path.join(path, "offsets.npy"))
+            tail_rows = meta.get("tail_rows", 0)
+            tail_vectors = tail_ids = None
+            if tail_rows:
+                tail_vectors = np.fromfile(os.path.join(path, TAIL_VECTORS), dtype=np.float32,
+                                           count=tail_rows * len(FEATURES))
+                tail_vectors = tail_vectors.reshape(-1, len(FEATURES))
+                with open(os.path.join(path, TAIL_TRACK_IDS), encoding="utf-8") as f:
+                    tail_ids = np.asarray(f.read().split("\n")[:tail_rows], dtype=str)
+        except (OSError, ValueError, KeyError):
+            return None
+        if meta.get("features") != list(FEATURES) or len(vectors) != meta["rows"] or len(track_ids) != meta["rows"]:
+            return None  # Written by another version or caught mid-save
+        if tail_rows and (len(tail_vectors) != tail_rows or len(tail_ids) != tail_rows):
+            return None
+        index = cls(vectors, track_ids, meta["mean"], meta["std"], meta["max_rowid"], centroids, offsets,
+                    tail_vectors, tail_ids)
+        index._saved = (path, tail_rows)
+        return index
+
+
+_index = None
+_index_version = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """Process-wide index: loaded from disk (or built) once, then kept in sync with the DB."""
+    global _index, _index_version
+    from db import get_read_conn, get_data_version
+
+    with get_read_conn() as conn:
+        version = get_data_version(conn)
+        feature_rows = conn.execute("SELECT MAX(rowid) FROM audio_features").fetchone()[0] or 0
+    with _index_lock:
+        if _index is None:
+            _index = SimilarityIndex.load()
+            if _index is None or _index.max_rowid > feature_rows:
+                _index = SimilarityIndex.from_db()  # Missing, or built against a different database
+                _index.save()
+        if version != _index_version:
+            if _index.sync():
+                _index.save()
+            _index_version = version
+        return _index
+
+
+def similar_tracks(track_id, k=10):
+    """Tracks that sound most like ``track_id`` as a DataFrame (track, artist, similarity)."""
+    import pandas as pd
+    from db import get_read_conn
+
+    neighbours = get_index().neighbors([track_id], k)[0]
+    columns = ["track_id", "track_name", "artist_name", "similarity"]
+    if not neighbours:
+        return pd.DataFrame(columns=columns)
+    ids = [track_id for track_id, _ in neighbours]
+    with get_read_conn() as conn:
+        names = {
+            row[0]: row[1:] for row in conn.execute(f"""
+                SELECT t.track_id, t.name, a.name FROM tracks t JOIN artists a ON t.artist_id = a.artist_id
+                WHERE t.track_id IN ({','.join('?' * len(ids))})
+            """, ids)
+        }
+    return pd.DataFrame(
+        [(tid, *names.get(tid, (tid, None)), score) for tid, score in neighbours], columns=columns
+    )
@@ -1,12 +1,21 @@
 import os
 import spotipy
+from spotipy.cache_handler import CacheFileHandler, MemoryCacheHandler
 from spotipy.oauth2 import SpotifyOAuth
+from db import DB_PATH, user_file_key
+from http_cache import cached_session
+from scheduler import BACKGROUND, INTERACTIVE
+from tracing import span
+
+SCOPE = "user-top-read user-read-recently-played"
+# One Spotipy token cache per connected user, read by the background refresher
+TOKEN_DIR = os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), ".spotify_tokens")
 
 def get_spotify():
     client_id = os.getenv("SPOTIFY_CLIENT_ID")
     client_secret = os.getenv("SPOTIFY_CLIENT_SECRET")
     redirect_uri = os.getenv("SPOTIFY_REDIRECT_URI", "http://localhost:8888/callback")
-    scope = "user-top-read user-read-recently-played"
+    scope = SCOPE
     if not client_id or not client_secret:
         raise RuntimeError("Missing Spotify credentials in environment variables.")
     sp = spotipy.Spotify(auth_manager=SpotifyOAuth(
@@ -14,5 +23,101 @@ def get_spotify():
         client_secret=client_secret,
         redirect_uri=redirect_uri,
         scope=scope
-    ))
-    return sp
\ No newline at end of file
+    ), requests_session=cached_session(priority=INTERACTIVE))
+    return sp
+
+def token_path(user_id):
+    # Hashed, so distinct IDs (e.g. "a.b" and "a_b") never share a token file
+    return os.path.join(TOKEN_DIR, f"{user_file_key(user_id)}.json")
+
+def oauth_manager(user_id=None, **kwargs):
+    """SpotifyOAuth for the app's credentials.
+
+    With ``user_id`` the token (including its refresh token) is cached in that
+    user's file under ``TOKEN_DIR``. Without it the token is only held in memory
+    by this manager, so one built per browser session never sees another
+    visitor's token (Spotipy's shared ``.cache`` file is never read).
+    """
+    cache_handler = CacheFileHandler(cache_path=token_path(user_id)) if user_id else MemoryCacheHandler()
+    return SpotifyOAuth(
+        client_id=os.getenv("SPOTIFY_CLIENT_ID"),
+        client_secret=os.getenv("SPOTIFY_CLIENT_SECRET"),
+        redirect_uri=os.getenv("SPOTIFY_REDIRECT_URI", "http://localhost:8888/callback"),
+        scope=SCOPE,
+        cache_handler=cache_handler,
+        **kwargs,
+    )
+
+def save_user_token(user_id, token_info):
+    """Store a user's token so the refresher can act for them after the session ends."""
+    from db import get_conn
+
+    os.makedirs(TOKEN_DIR, mode=0o700, exist_ok=True)
+    CacheFileHandler(cache_path=token_path(user_id)).save_token_to_cache(token_info)
+    with get_conn() as conn:
+        conn.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
+
+def connected_users():
+    """IDs of users with a stored token, i.e. the ones the refresher keeps in sync."""
+    from db import get_read_conn
+
+    with get_read_conn() as conn:
+        user_ids = [row[0] for row in conn.execute("SELECT user_id FROM users ORDER BY user_id")]
+    return [user_id for user_id in user_ids if os.path.exists(token_path(user_id))]
+
+def spotify_for_user(user_id, priority=BACKGROUND):
+    """Spotipy client that refreshes the stored token for ``user_id`` as needed.
+
+    ``priority`` is the scheduler priority of its requests (``scheduler.INTERACTIVE``
+    when someone is waiting on the result).
+    """
+    return spotipy.Spotify(auth_manager=oauth_manager(user_id), requests_session=cached_session(priority=priority))
+
+def spotify_for_token(token, priority=INTERACTIVE):
+    """Spotipy client for an access token, sharing the on-disk response cache."""
+    return spotipy.Spotify(auth=token, requests_session=cached_session(priority=priority))
+
+def _scheduled(fn):
+    """Whether the client behind the Spotipy method ``fn`` sends through the request scheduler."""
+    from scheduler import SchedulingAdapter
+
+    session = getattr(getattr(fn, "__self__", None), "_session", None)
+    if session is None or not hasattr(session, "get_adapter"):
+        return False
+    adapter = session.get_adapter("https://api.spotify.com/v1/")
+    while adapter is not None:  # CachingAdapter -> SchedulingAdapter -> HTTPAdapter
+        if isinstance(adapter, SchedulingAdapter):
+            return True
+        adapter = getattr(adapter, "inner", None)
+    return False
+
+def call_with_backoff(fn, *args, max_attempts=5, base_delay=1.0, max_delay=60.0, **kwargs):
+    """Call a Spotipy method, retrying on 429/5xx with Retry-After aware backoff.
+
+    urllib3 retries 5xx; this covers the case where those retries are
+    exhausted. 429s are retried here only for clients outside the request
+    scheduler (e.g. ``FakeSpotify``): a scheduled client has already waited
+    out and retried its 429s, so one that still comes back is raised at once
+    rather than multiplying the scheduler's attempts. A ``Retry-After`` header
+    is honoured when present, otherwise the delay grows exponentially with jitter.
+    """
+    import random
+    import time
+    from spotipy.exceptions import SpotifyException
+
+    retry_429 = not _scheduled(fn)
+    with span(f"spotify.{getattr(fn, '__name__', 'call')}") as s:
+        for attempt in range(1, max_attempts + 1):
+            try:
+                return fn(*args, **kwargs)
+            except SpotifyException as e:
+                retryable = (e.http_status == 429 and retry_429) or e.http_status >= 500
+                if not retryable or attempt == max_attempts:
+                    raise
+                retry_after = (e.headers or {}).get("Retry-After")
+                if retry_after is not None:
+                    delay = float(retry_after)
+                else:
+                    delay = base_delay * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+                s.set(retries=attempt)
+                time.sleep(min(delay, max_delay))
@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+# The modules live at the repository root, next to app.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def tmp_db(tmp_path, monkeypatch):
+    """Point ``db`` at a fresh, migrated database under ``tmp_path``."""
+    import db
+    from query_cache import clear_cache
+
+    db.close_all()
+    clear_cache()  # Versions restart at 0 in every fresh database
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "spotify_insights.db"))
+    db.init_db()
+    yield db
+    db.close_all()
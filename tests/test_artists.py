@@ -0,0 +1,21 @@
+"""Artist enrichment resolves every artist once, including ones Spotify doesn't know."""
+import etl
+from fake_spotify import FakeSpotify, spotify_id
+
+
+def test_unknown_artist_is_not_refetched(tmp_db):
+    sp = FakeSpotify(n_tracks=50, n_artists=5)
+    known, unknown = spotify_id("artist", 0), spotify_id("artist", 99)  # Only 5 artists exist
+    artists = {known: "Known", unknown: "Ghost"}
+
+    rows = etl.enrich_artists(sp, artists)
+    with tmp_db.get_conn() as conn:
+        etl._upsert_artists(conn.cursor(), rows)
+        genres = dict(conn.execute("SELECT artist_id, genres FROM artists"))
+
+    assert genres[unknown] == ""
+    assert genres[known] == ", ".join(sp.artist(known)["genres"])
+    assert sp.calls["artists"] == 1
+
+    assert etl.enrich_artists(sp, artists) == []
+    assert sp.calls["artists"] == 1
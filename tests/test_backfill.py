@@ -0,0 +1,78 @@
+"""Audio-features backfill: rejected IDs become misses, failed chunks are retried next run."""
+import pytest
+from requests.exceptions import ConnectionError
+
+import etl
+from fake_spotify import FakeSpotify, spotify_id
+
+BAD_ID = "not-a-track-id"  # Malformed, so Spotify rejects any request containing it
+
+
+class FlakySpotify(FakeSpotify):
+    """Drops the connection on the first request for any chunk containing one of ``fail_once``."""
+
+    def __init__(self, fail_once, **kwargs):
+        super().__init__(**kwargs)
+        self.fail_once = set(fail_once)
+        self.requested = []
+
+    def audio_features(self, tracks=[]):
+        self.requested.append(list(tracks))
+        failing = self.fail_once.intersection(tracks)
+        if failing:
+            self.fail_once -= failing
+            raise ConnectionError("Connection reset by peer")
+        return super().audio_features(tracks)
+
+
+def store_tracks(db, track_ids):
+    with db.get_conn() as conn:
+        conn.executemany("INSERT INTO tracks (track_id, name) VALUES (?, ?)",
+                         [(track_id, track_id) for track_id in track_ids])
+
+
+def stored(db, table):
+    with db.get_read_conn() as conn:
+        return {row[0] for row in conn.execute(f"SELECT track_id FROM {table}")}
+
+
+@pytest.fixture
+def library(tmp_db):
+    # Chunks of 10: the bad ID lands in the second, track 25 in the third
+    track_ids = [spotify_id("track", n) for n in range(40)]
+    track_ids.insert(15, BAD_ID)
+    store_tracks(tmp_db, track_ids)
+    return track_ids
+
+
+def test_bad_id_is_recorded_as_a_miss(tmp_db, library):
+    sp = FlakySpotify(fail_once=(), n_tracks=40)
+
+    stats = etl.backfill_audio_features(sp, max_workers=2, chunk_size=10)
+
+    assert stats == {"requested": 41, "stored": 40, "missed": 1, "failed": 0}
+    assert stored(tmp_db, "audio_features_misses") == {BAD_ID}
+    assert stored(tmp_db, "audio_features") == set(library) - {BAD_ID}
+
+    # Nothing is left to ask for
+    calls = sp.calls["audio-features"]
+    assert etl.backfill_audio_features(sp, max_workers=2, chunk_size=10)["requested"] == 0
+    assert sp.calls["audio-features"] == calls
+
+
+def test_failed_chunk_is_fetched_on_next_run(tmp_db, library):
+    sp = FlakySpotify(fail_once=[spotify_id("track", 25)], n_tracks=40)
+    failed_chunk = library[20:30]
+
+    first = etl.backfill_audio_features(sp, max_workers=2, chunk_size=10)
+
+    assert first == {"requested": 41, "stored": 30, "missed": 1, "failed": 1}
+    assert stored(tmp_db, "audio_features").isdisjoint(failed_chunk)
+
+    sp.requested.clear()
+    second = etl.backfill_audio_features(sp, max_workers=2, chunk_size=10)
+
+    assert second == {"requested": 10, "stored": 10, "missed": 0, "failed": 0}
+    assert sp.requested == [failed_chunk]
+    assert stored(tmp_db, "audio_features") == set(library) - {BAD_ID}
+    assert stored(tmp_db, "audio_features_misses") == {BAD_ID}
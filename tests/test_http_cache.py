@@ -0,0 +1,133 @@
+"""ResponseCache and CachingAdapter with a stub in place of the network."""
+import json
+import threading
+
+import pytest
+import requests
+
+from http_cache import CachingAdapter, ResponseCache, ttl_for
+
+API = "https://api.spotify.com/v1"
+
+
+class StubTransport:
+    """Answers every GET with a JSON body and an ETag, and 304 when the ETag still matches."""
+
+    def __init__(self):
+        self.requests = []
+        self.etag = '"v1"'
+
+    def send(self, request, **kwargs):
+        self.requests.append(request)
+        response = requests.Response()
+        response.request, response.url = request, request.url
+        if request.headers.get("If-None-Match") == self.etag:
+            response.status_code, response._content = 304, b""
+        else:
+            response.status_code = 200
+            response._content = json.dumps({"url": request.url, "etag": self.etag}).encode("utf-8")
+        response.headers["ETag"] = self.etag
+        return response
+
+    def close(self):
+        pass
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def transport():
+    return StubTransport()
+
+
+@pytest.fixture
+def session(tmp_path, clock, transport):
+    cache = ResponseCache(str(tmp_path / "http_cache.db"), clock=clock)
+    session = requests.Session()
+    session.mount("https://", CachingAdapter(cache, inner=transport))
+    yield session
+    cache.close()
+
+
+def get(session, path, token="token-a"):
+    return session.get(f"{API}{path}", headers={"Authorization": f"Bearer {token}"})
+
+
+def cache_of(session):
+    return session.get_adapter(API).cache
+
+
+def test_fresh_responses_are_served_until_their_ttl_expires(session, clock, transport):
+    path = "/artists/0TnOYISbd1XYRBk9myaseg"
+    ttl = ttl_for(f"{API}{path}")
+
+    first = get(session, path)
+    clock.now += ttl - 1
+    second = get(session, path)
+    clock.now += 2
+    transport.etag = '"v2"'
+    third = get(session, path)
+
+    assert len(transport.requests) == 2
+    assert second.from_cache and second.json() == first.json()
+    assert third.json()["etag"] == '"v2"'
+    assert cache_of(session).stats()["hits"] == 1
+
+
+def test_stale_entry_is_revalidated_with_its_etag(session, clock, transport):
+    path = "/me/top/tracks?time_range=short_term"
+    first = get(session, path)
+    clock.now += ttl_for(f"{API}{path}") + 1
+
+    revalidated = get(session, path)
+    again = get(session, path)
+
+    assert transport.requests[-1].headers["If-None-Match"] == '"v1"'
+    assert len(transport.requests) == 2  # The 304 made the entry fresh again
+    assert revalidated.status_code == 200 and revalidated.json() == first.json()
+    assert again.from_cache
+    assert cache_of(session).stats()["revalidated"] == 1
+
+
+def test_me_endpoints_are_cached_per_token(session, transport):
+    get(session, "/me/player/recently-played?limit=50", token="token-a")
+    get(session, "/me/player/recently-played?limit=50", token="token-b")
+    get(session, "/me/player/recently-played?limit=50", token="token-a")
+    # Catalogue lookups are shared by every user
+    get(session, "/audio-features?ids=abc", token="token-a")
+    get(session, "/audio-features?ids=abc", token="token-b")
+
+    sent = [(r.path_url, r.headers["Authorization"]) for r in transport.requests]
+    assert sent == [
+        ("/v1/me/player/recently-played?limit=50", "Bearer token-a"),
+        ("/v1/me/player/recently-played?limit=50", "Bearer token-b"),
+        ("/v1/audio-features?ids=abc", "Bearer token-a"),
+    ]
+
+
+def test_counters_add_up_under_concurrent_use(session):
+    get(session, "/artists/0TnOYISbd1XYRBk9myaseg")
+
+    def worker():
+        for _ in range(50):
+            get(session, "/artists/0TnOYISbd1XYRBk9myaseg")
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stats = cache_of(session).stats()
+    assert (stats["hits"], stats["misses"]) == (400, 1)
@@ -0,0 +1,81 @@
+"""History import from synthetic Extended Streaming History files."""
+import json
+
+import pytest
+
+import importer
+from fake_spotify import spotify_id
+
+N_ENTRIES = 40
+
+
+def entry(i):
+    base = {"ts": f"2023-01-01T{i // 60:02d}:{i % 60:02d}:00Z", "ms_played": 60_000,
+            "master_metadata_track_name": f"Track ☃ {i}",
+            "master_metadata_album_artist_name": f"Artiste é {i % 5}",
+            "master_metadata_album_album_name": "Album ü",
+            "spotify_track_uri": f"spotify:track:{spotify_id('track', i)}"}
+    if i % 10 == 3:
+        base.update(spotify_track_uri=None, episode_name="A podcast")  # Not a track
+    elif i % 10 == 7:
+        base.update(ms_played=5_000)  # Skipped before it counted
+    return base
+
+
+N_PLAYS = sum(1 for i in range(N_ENTRIES) if i % 10 not in (3, 7))
+
+
+@pytest.fixture
+def history_file(tmp_path):
+    path = tmp_path / "my_spotify_data" / "Streaming_History_Audio_2023_0.json"
+    path.parent.mkdir()
+    # Indented like the real export, with non-ASCII names so characters span read chunks
+    path.write_text(json.dumps([entry(i) for i in range(N_ENTRIES)], indent=2, ensure_ascii=False), encoding="utf-8")
+    return path
+
+
+def play_count(db, user_id="listener"):
+    with db.get_read_conn() as conn:
+        return conn.execute(
+            "SELECT COUNT(*) FROM plays WHERE user_id = ?", (user_id,)
+        ).fetchone()[0]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64, 1 << 20])
+def test_parses_entries_split_across_read_chunks(history_file, chunk_size):
+    parsed = [item for item, _ in importer.iter_json_array(history_file, chunk_size=chunk_size)]
+
+    assert parsed == [entry(i) for i in range(N_ENTRIES)]
+
+
+def test_resumes_from_any_yielded_byte_offset(history_file):
+    offsets = [offset for _, offset in importer.iter_json_array(history_file, chunk_size=64)]
+
+    resumed = [item for item, _ in importer.iter_json_array(history_file, start_offset=offsets[16], chunk_size=64)]
+
+    assert resumed == [entry(i) for i in range(17, N_ENTRIES)]
+    assert offsets[-1] < history_file.stat().st_size  # Up to the closing bracket
+
+
+def test_interrupted_import_resumes_from_its_checkpoint(tmp_db, history_file):
+    def crash(path, stats):
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        importer.import_file(history_file, "listener", batch_size=10, progress=crash)
+    assert play_count(tmp_db) == 8  # The first batch of 10 entries was committed
+
+    stats = importer.import_file(history_file, "listener", batch_size=10)
+
+    assert stats["entries"] == N_ENTRIES - 10
+    assert play_count(tmp_db) == N_PLAYS
+
+
+def test_rerun_skips_an_imported_file(tmp_db, history_file):
+    first = importer.import_history([history_file.parent], "listener", batch_size=16)
+    again = importer.import_history([history_file.parent], "listener", batch_size=16)
+
+    assert (first["files"], first["entries"], first["plays"]) == (1, N_ENTRIES, N_PLAYS)
+    assert (again["files"], again["entries"], again["plays"]) == (0, 0, 0)
+    assert importer.import_file(history_file, "listener") == {"entries": 0, "plays": 0}
+    assert play_count(tmp_db) == N_PLAYS
@@ -0,0 +1,121 @@
+"""Migrating a database written by the original single-user schema to the current one."""
+import sqlite3
+
+import pytest
+
+import db
+
+# Schema of the first release, before user_version was tracked
+BASELINE_DDL = """
+    CREATE TABLE artists (
+        artist_id       TEXT PRIMARY KEY,
+        name            TEXT NOT NULL,
+        genres          TEXT
+    );
+    CREATE TABLE tracks (
+        track_id        TEXT PRIMARY KEY,
+        name            TEXT NOT NULL,
+        artist_id       INTEGER,
+        album_name      TEXT,
+        release_date    TEXT,
+        duration_ms     INTEGER,
+        popularity      INTEGER,
+        FOREIGN KEY (artist_id) REFERENCES artists(artist_id)
+    );
+    CREATE TABLE audio_features (
+        track_id        TEXT PRIMARY KEY,
+        danceability    REAL,
+        energy          REAL,
+        key             INTEGER,
+        loudness        REAL,
+        mode            INTEGER,
+        speechiness     REAL,
+        acousticness    REAL,
+        instrumentalness REAL,
+        liveness        REAL,
+        valence         REAL,
+        tempo           REAL,
+        FOREIGN KEY (track_id) REFERENCES tracks(track_id)
+    );
+    CREATE TABLE plays (
+        play_id    TEXT PRIMARY KEY,
+        track_id   TEXT NOT NULL,
+        played_at  TEXT NOT NULL,
+        context    TEXT,
+        FOREIGN KEY (track_id) REFERENCES tracks(track_id)
+    );
+    CREATE INDEX idx_plays_played_at ON plays(played_at);
+"""
+
+ARTISTS = [("artist0", "Artist Zero", "pop, indie pop"), ("artist1", "Artist One", ""), ("artist2", "Artist Two", None)]
+TRACKS = [(f"track{n}", f"Track {n}", f"artist{n % 3}", "Album", "2020-01-01", 200_000, 90 - n) for n in range(6)]
+FEATURES = [(f"track{n}", 0.5, 0.6, 1, -5.0, 1, 0.1, 0.2, 0.0, 0.1, 0.7, 120.0) for n in range(4)]
+# Spotify's played_at comes with and without milliseconds
+PLAYED_AT = [f"2024-03-{day:02d}T{hour:02d}:15:30{'.250' if hour % 2 else ''}Z" for day in (1, 2) for hour in range(10)]
+PLAYS = [(f"track{i % 6}::{played_at}", f"track{i % 6}", played_at, "playlist" if i % 3 else None)
+         for i, played_at in enumerate(PLAYED_AT)]
+
+
+@pytest.fixture
+def migrated(tmp_path, monkeypatch):
+    path = tmp_path / "spotify_insights.db"
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE_DDL)
+    conn.executemany("INSERT INTO artists VALUES (?, ?, ?)", ARTISTS)
+    conn.executemany("INSERT INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?)", TRACKS)
+    conn.executemany("INSERT INTO audio_features VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", FEATURES)
+    conn.executemany("INSERT INTO plays VALUES (?, ?, ?, ?)", PLAYS)
+    conn.commit()
+    conn.close()
+
+    db.close_all()
+    monkeypatch.setattr(db, "DB_PATH", str(path))
+    db.init_db()
+    yield db
+    db.close_all()
+
+
+def canonical(played_at):
+    return played_at if "." in played_at else played_at.replace("Z", ".000Z")
+
+
+def assert_consistent(conn):
+    assert conn.execute("PRAGMA foreign_key_check").fetchall() == []
+    assert conn.execute("PRAGMA integrity_check").fetchall() == [("ok",)]
+
+
+def test_baseline_database_migrates_to_current_schema(migrated):
+    with migrated.get_read_conn() as conn:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == migrated.SCHEMA_VERSION
+        counts = {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                  for table in ("artists", "tracks", "audio_features", "play_events", "users")}
+        assert counts == {"artists": 3, "tracks": 6, "audio_features": 4, "play_events": 20, "users": 1}
+
+        plays = conn.execute("SELECT user_id, play_id, track_id, played_at, context FROM plays").fetchall()
+        assert sorted(plays) == sorted(
+            (migrated.LEGACY_USER_ID, f"{track_id}::{canonical(played_at)}", track_id, canonical(played_at), context)
+            for _, track_id, played_at, context in PLAYS
+        )
+
+        # The old popularity order is the legacy user's medium_term snapshot
+        assert conn.execute(
+            "SELECT track_id FROM top_tracks WHERE time_range = 'medium_term' ORDER BY rank"
+        ).fetchall() == [(row[0],) for row in TRACKS]
+        assert conn.execute("SELECT SUM(plays) FROM play_daily_counts").fetchone()[0] == 20
+        assert conn.execute("SELECT SUM(plays) FROM play_hour_counts").fetchone()[0] == 20
+        assert conn.execute(
+            "SELECT g.name FROM artist_genres ag JOIN genres g USING (genre_id) ORDER BY 1"
+        ).fetchall() == [("indie pop",), ("pop",)]
+        assert conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'import_files'").fetchone()[0] == 0
+        assert_consistent(conn)
+
+
+def test_legacy_rows_can_be_handed_to_a_real_user(migrated):
+    migrated.assign_legacy_data("real-user")
+
+    with migrated.get_read_conn() as conn:
+        assert conn.execute("SELECT user_id FROM users").fetchall() == [("real-user",)]
+        assert conn.execute("SELECT user_id, COUNT(*) FROM plays GROUP BY 1").fetchall() == [("real-user", 20)]
+        assert conn.execute("SELECT DISTINCT user_id FROM top_tracks").fetchall() == [("real-user",)]
+        assert conn.execute("SELECT DISTINCT user_id FROM play_daily_counts").fetchall() == [("real-user",)]
+        assert_consistent(conn)
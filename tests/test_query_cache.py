@@ -0,0 +1,53 @@
+"""Query cache bounds: total result size, and a separate cache for Recent Activity pages."""
+import pandas as pd
+
+import etl
+from fake_spotify import FakeSpotify
+from query_cache import QueryCache, cache_stats, page_cache_stats, result_bytes
+
+
+def frame(rows):
+    return pd.DataFrame({"track_name": [f"track {i}" for i in range(rows)], "plays": range(rows)})
+
+
+def test_size_bound_evicts_least_recently_used():
+    small, large = frame(10), frame(1_000)
+    cache = QueryCache(max_entries=100, max_bytes=result_bytes(large) + result_bytes(small))
+    cache.store("a", (1,), small)
+    cache.store("b", (1,), small)
+    assert cache.lookup("a", (1,)) == (True, small)  # "b" is now the least recently used
+
+    cache.store("c", (1,), large)
+
+    assert cache.lookup("b", (1,)) == (False, None)
+    assert cache.lookup("a", (1,))[0] and cache.lookup("c", (1,))[0]
+    assert cache.stats()["bytes"] == result_bytes(small) + result_bytes(large)
+
+
+def test_result_over_the_bound_is_not_cached():
+    cache = QueryCache(max_entries=100, max_bytes=result_bytes(frame(10)))
+    cache.store("a", (1,), frame(10))
+    cache.store("a", (2,), frame(1_000))  # Replaces the old entry, but too big to keep
+
+    assert cache.lookup("a", (1,)) == (False, None)
+    assert cache.lookup("a", (2,)) == (False, None)
+    assert cache.stats() == {"hits": 0, "misses": 2, "entries": 0, "bytes": 0}
+
+
+def test_paging_does_not_evict_dashboard_queries(tmp_db):
+    sp = FakeSpotify(n_tracks=200, n_plays=400, recent_window=400, user_id="alice")
+    etl.refresh_all(sp, user_id="alice")
+    etl.df_top_tracks("alice")
+    hits = cache_stats()["hits"]
+
+    before, pages = None, 0
+    while True:
+        _, before = etl.df_recent_activity_page("alice", before=before, limit=5)
+        pages += 1
+        if before is None:
+            break
+
+    assert pages > 64
+    assert page_cache_stats()["entries"] < pages
+    etl.df_top_tracks("alice")
+    assert cache_stats()["hits"] == hits + 1
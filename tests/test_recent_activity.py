@@ -0,0 +1,66 @@
+"""Keyset pagination of Recent Activity when plays share a timestamp."""
+import pytest
+
+import etl
+
+START_MS = 1_700_000_000_000
+N_PLAYS = 30
+
+
+@pytest.fixture
+def history(tmp_db):
+    # Four plays per timestamp (e.g. an import of one session), on different tracks
+    artists = [(f"artist{n}", f"Artist {n}", None) for n in range(3)]
+    tracks = [(f"track{n}", f"Track {n}", f"artist{n % 3}", None, None, None, None) for n in range(12)]
+    plays = [("listener", f"track{(i * 5) % 12}", START_MS + (i // 4) * 1000, ("album", "playlist")[i % 2])
+             for i in range(N_PLAYS)]
+    other = [("someone-else", "track0", START_MS + 500, "album")]
+    with tmp_db.get_conn() as conn:
+        etl._write_batch(conn.cursor(), "listener", artists, tracks, plays_data=plays)
+        etl._write_batch(conn.cursor(), "someone-else", plays_data=other)
+    return plays
+
+
+def stored_play_ids(db, context=None):
+    with db.get_read_conn() as conn:
+        return {row[0] for row in conn.execute(
+            "SELECT play_id FROM plays WHERE user_id = 'listener' AND (? IS NULL OR context = ?)", (context, context)
+        )}
+
+
+def all_pages(limit, **filters):
+    pages, cursor = [], None
+    while True:
+        df, cursor = etl.df_recent_activity_page("listener", before=cursor, limit=limit, **filters)
+        pages.append(df)
+        if cursor is None:
+            return pages
+
+
+@pytest.mark.parametrize("limit", [1, 3, 4, 5, 7, 30, 50])
+def test_pages_cover_every_play_once_in_order(tmp_db, history, limit):
+    pages = all_pages(limit)
+
+    play_ids = [play_id for df in pages for play_id in df["play_id"]]
+    assert len(play_ids) == len(set(play_ids)) == N_PLAYS
+    assert set(play_ids) == stored_play_ids(tmp_db)
+    played_at = [value for df in pages for value in df["played_at"]]
+    assert played_at == sorted(played_at, reverse=True)
+    # Full pages up to the last, which is never empty unless there are no plays at all
+    assert [len(df) for df in pages[:-1]] == [limit] * (len(pages) - 1)
+    assert 0 < len(pages[-1]) <= limit
+    assert len(pages) == -(-N_PLAYS // limit)
+
+
+def test_filtered_pages_with_ties(tmp_db, history):
+    pages = all_pages(4, context="album")
+
+    play_ids = [play_id for df in pages for play_id in df["play_id"]]
+    assert len(play_ids) == len(set(play_ids)) == N_PLAYS // 2
+    assert set(play_ids) == stored_play_ids(tmp_db, context="album")
+
+
+def test_empty_history_is_one_empty_page(tmp_db):
+    df, cursor = etl.df_recent_activity_page("nobody", limit=5)
+
+    assert df.empty and cursor is None
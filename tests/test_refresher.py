@@ -0,0 +1,64 @@
+"""Requested refreshes, the first sync included, respect the failure backoff and the budget."""
+import pytest
+
+import etl
+import refresher
+from fake_spotify import FakeSpotify
+
+
+class Flaky:
+    """client_factory whose first ``failures`` clients fail; the rest are FakeSpotify."""
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+
+    def __call__(self, user_id, priority):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise ConnectionError("Spotify unreachable")
+        return FakeSpotify(n_tracks=50, n_plays=20, recent_window=20, user_id=user_id)
+
+
+@pytest.fixture
+def make_refresher(tmp_db):
+    made = []
+
+    def make(factory, budget=None):
+        r = refresher.Refresher(interval=60, jitter=0, budget=budget, client_factory=factory, users=lambda: ["alice"])
+        made.append(r)
+        return r
+
+    yield make
+    for r in made:
+        r.stop()
+
+
+def test_failed_first_sync_backs_off(make_refresher, monkeypatch):
+    factory = Flaky(failures=1)
+    r = make_refresher(factory)
+
+    assert etl.sync_status("alice")["last_synced_at"] is None
+    with pytest.raises(ConnectionError):
+        r.request("alice", interactive=True).result()
+    # Every rerun of the page asks again; none of them reaches Spotify during the backoff
+    for _ in range(5):
+        assert r.request("alice", interactive=True) is None
+    assert factory.calls == 1
+    assert 60 < r.retry_in("alice") <= 120
+
+    now = refresher.time.monotonic()
+    monkeypatch.setattr(refresher.time, "monotonic", lambda: now + 121)
+    r.request("alice", interactive=True).result()
+    assert etl.sync_status("alice")["last_synced_at"] is not None
+    assert r.retry_in("alice") == 0
+
+
+def test_requests_spend_the_budget(make_refresher):
+    factory = Flaky(failures=0)
+    r = make_refresher(factory, budget=refresher.RateBudget(capacity=1, window=3600))
+
+    r.request("alice", interactive=True).result()
+    assert r.request("alice", interactive=True) is None
+    assert factory.calls == 1
+    assert r.retry_in("alice") > 0
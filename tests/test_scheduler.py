@@ -0,0 +1,129 @@
+"""RequestScheduler against the fake Web API, through a real Spotipy client."""
+import threading
+import time
+
+import pytest
+import requests
+import spotipy
+from spotipy.exceptions import SpotifyException
+
+from fake_spotify import FakeSpotify, FakeSpotifyTransport, spotify_id
+from scheduler import BACKGROUND, INTERACTIVE, RequestScheduler, SchedulingAdapter, SharedTokenBucket
+from spotify_client import call_with_backoff
+
+
+class RecordingTransport(FakeSpotifyTransport):
+    """FakeSpotifyTransport that remembers the order requests reached it in."""
+
+    def __init__(self, fake):
+        super().__init__(fake)
+        self.sent = []
+
+    def send(self, request, **kwargs):
+        self.sent.append(request.url.rsplit("/", 1)[-1])
+        return super().send(request, **kwargs)
+
+
+def client(transport, scheduler, priority=BACKGROUND):
+    session = requests.Session()
+    session.mount("https://", SchedulingAdapter(transport, scheduler, priority))
+    return spotipy.Spotify(auth="test-token", requests_session=session, retries=0)
+
+
+def run_threads(targets):
+    threads = [threading.Thread(target=target) for target in targets]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+@pytest.fixture
+def bucket_path(tmp_path):
+    return str(tmp_path / "http_cache.db")
+
+
+def test_retry_after_is_waited_out_before_retrying(bucket_path):
+    fake = FakeSpotify(rate_limit=2)
+    scheduler = RequestScheduler(SharedTokenBucket(bucket_path, rate=1000, burst=100))
+    sp = client(FakeSpotifyTransport(fake), scheduler)
+
+    start = time.monotonic()
+    artists = [call_with_backoff(sp.artist, spotify_id("artist", i))["id"] for i in range(4)]
+
+    assert artists == [spotify_id("artist", i) for i in range(4)]
+    # The third call was throttled; nothing was sent again until Retry-After had passed
+    assert fake.rate_limited == 1
+    assert time.monotonic() - start >= 0.5
+    stats = scheduler.stats()
+    assert (stats["throttled"], stats["retried"], stats["requests"]) == (1, 1, 5)
+
+
+def test_exhausted_429_is_not_retried_again_by_call_with_backoff(bucket_path):
+    fake = FakeSpotify(rate_limit=0)  # Every call is throttled
+    scheduler = RequestScheduler(SharedTokenBucket(bucket_path, rate=1000, burst=100), max_retries=0)
+    sp = client(FakeSpotifyTransport(fake), scheduler)
+
+    with pytest.raises(SpotifyException) as raised:
+        call_with_backoff(sp.artist, spotify_id("artist", 0), base_delay=0.01)
+
+    assert raised.value.http_status == 429
+    assert sum(fake.calls.values()) == 1
+
+
+def test_processes_sharing_a_bucket_are_paced_together(bucket_path):
+    fake = FakeSpotify()
+    # Two schedulers with their own connection stand in for two processes
+    schedulers = [RequestScheduler(SharedTokenBucket(bucket_path, rate=40, burst=1)) for _ in range(2)]
+    clients = [client(FakeSpotifyTransport(fake), scheduler) for scheduler in schedulers]
+
+    def worker(n):
+        return lambda: [clients[n].artist(spotify_id("artist", n * 10 + i)) for i in range(10)]
+
+    start = time.monotonic()
+    run_threads([worker(0), worker(1)])
+
+    assert sum(fake.calls.values()) == 20
+    assert time.monotonic() - start >= 19 / 40 * 0.9  # One token up front, then 40/s
+
+
+def test_interactive_requests_go_first(bucket_path):
+    fake = FakeSpotify()
+    bucket = SharedTokenBucket(bucket_path, rate=100, burst=1)
+    scheduler = RequestScheduler(bucket)
+    transport = RecordingTransport(fake)
+    background = client(transport, scheduler, BACKGROUND)
+    interactive = client(transport, scheduler, INTERACTIVE)
+
+    bucket.block(0.3)  # Hold everything until the queue has built up
+    threads = [threading.Thread(target=background.artist, args=(spotify_id("artist", i),)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    wait_for(lambda: scheduler.stats()["queued"]["background"] == 4)
+    threads.append(threading.Thread(target=interactive.artist, args=(spotify_id("artist", 99),)))
+    threads[-1].start()
+    for thread in threads:
+        thread.join()
+
+    assert transport.sent[0] == spotify_id("artist", 99)
+    assert len(transport.sent) == 5
+
+
+def test_identical_requests_in_flight_share_one_call(bucket_path):
+    fake = FakeSpotify(latency=0.2)
+    scheduler = RequestScheduler(SharedTokenBucket(bucket_path, rate=1000, burst=100))
+    clients = [client(FakeSpotifyTransport(fake), scheduler, priority) for priority in (BACKGROUND, INTERACTIVE) * 4]
+    results = []
+
+    run_threads([lambda sp=sp: results.append(sp.artist(spotify_id("artist", 7))) for sp in clients])
+
+    assert fake.calls["artists/{id}"] == 1
+    assert scheduler.stats()["coalesced"] == 7
+    assert len(results) == 8 and all(result == results[0] for result in results)
@@ -0,0 +1,81 @@
+"""Similarity index: new rows are appended to a tail instead of rewriting the saved matrix."""
+import os
+
+import numpy as np
+import pytest
+
+from similarity import FEATURES, TAIL_TRACK_IDS, TAIL_VECTORS, SimilarityIndex
+
+
+def catalogue(n, start=0, seed=0):
+    rng = np.random.default_rng(seed)
+    return [f"track{i}" for i in range(start, start + n)], rng.random((n, len(FEATURES)))
+
+
+def stat(path, name):
+    st = os.stat(os.path.join(path, name))
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+@pytest.fixture(params=[False, True], ids=["brute", "ivf"])
+def saved(request, tmp_path):
+    track_ids, features = catalogue(400)
+    index = SimilarityIndex.from_features(track_ids, features, max_rowid=400, ivf=request.param)
+    index.save(str(tmp_path))
+    return index, str(tmp_path)
+
+
+def test_added_rows_are_appended_not_rewritten(saved):
+    index, path = saved
+    base = stat(path, "vectors.npy")
+    track_ids, features = catalogue(20, start=400, seed=1)
+    features[0] = catalogue(400)[1][7]  # A copy of track7
+
+    assert index.add(track_ids, features, max_rowid=420) == 20
+    index.save(path)
+
+    assert stat(path, "vectors.npy") == base
+    assert os.path.getsize(os.path.join(path, TAIL_VECTORS)) == 20 * len(FEATURES) * 4
+    loaded = SimilarityIndex.load(path)
+    assert len(loaded) == 420 and loaded.max_rowid == 420
+    queries = ["track7", "track400", "track419", "track3"]
+    assert loaded.neighbors(queries, k=5) == index.neighbors(queries, k=5)
+    assert loaded.neighbors(["track7"], k=1)[0][0][0] == "track400"
+
+
+def test_tail_is_merged_past_threshold(saved):
+    index, path = saved
+    index.add(*catalogue(20, start=400, seed=1))
+    index.save(path)
+    base = stat(path, "vectors.npy")
+
+    index.add(*catalogue(40, start=420, seed=2))  # Tail now over REBUILD_TAIL_FRACTION
+    index.save(path)
+
+    assert len(index.tail_ids) == 0
+    assert stat(path, "vectors.npy") != base
+    assert os.path.getsize(os.path.join(path, TAIL_VECTORS)) == 0
+    loaded = SimilarityIndex.load(path)
+    assert len(loaded) == 460 and len(loaded.tail_ids) == 0
+    assert loaded.neighbors(["track0", "track459"], k=5) == index.neighbors(["track0", "track459"], k=5)
+
+
+def test_unrecorded_append_is_ignored(saved):
+    index, path = saved
+    index.add(*catalogue(10, start=400, seed=1))
+    index.save(path)
+    # A save that died after writing tail rows but before updating meta.json
+    with open(os.path.join(path, TAIL_VECTORS), "ab") as f:
+        f.write(b"\0" * (3 * len(FEATURES) * 4 + 5))
+    with open(os.path.join(path, TAIL_TRACK_IDS), "a") as f:
+        f.write("ghost1\nghost2\ngho")
+
+    loaded = SimilarityIndex.load(path)
+    assert len(loaded) == 410
+    assert "ghost1" not in loaded.positions
+
+    loaded.add(*catalogue(5, start=410, seed=2))
+    loaded.save(path)
+    reloaded = SimilarityIndex.load(path)
+    assert reloaded.tail_ids.tolist() == [f"track{i}" for i in range(400, 415)]
+    assert reloaded.neighbors(["track412"], k=3) == loaded.neighbors(["track412"], k=3)
@@ -0,0 +1,84 @@
+"""Trigger-maintained summary tables agree with a full rebuild_summaries()."""
+import pytest
+
+import etl
+from fake_spotify import FakeSpotify
+
+
+def summaries(conn):
+    # Triggers leave emptied rows at zero where a rebuild has none; float sums are rounded
+    return {
+        "hours": conn.execute(
+            "SELECT user_id, weekday, hour, plays FROM play_hour_counts WHERE plays != 0 ORDER BY 1, 2, 3"
+        ).fetchall(),
+        "days": conn.execute(
+            "SELECT user_id, day, plays FROM play_daily_counts WHERE plays != 0 ORDER BY 1, 2"
+        ).fetchall(),
+        "mood": [
+            (user_id, time_range, tracks, round(danceability, 9), round(energy, 9), round(valence, 9))
+            for user_id, time_range, tracks, danceability, energy, valence in conn.execute("""
+                SELECT user_id, time_range, tracks, danceability_sum, energy_sum, valence_sum
+                FROM mood_totals WHERE tracks != 0 ORDER BY 1, 2
+            """)
+        ],
+    }
+
+
+def assert_matches_rebuild(db):
+    with db.get_conn() as conn:
+        maintained = summaries(conn)
+        db.rebuild_summaries(conn)
+        rebuilt = summaries(conn)
+        conn.rollback()
+    assert maintained == rebuilt
+    assert maintained["hours"] and maintained["days"] and maintained["mood"]
+
+
+@pytest.fixture
+def listeners(tmp_db):
+    # Same catalogue, different histories: tracks (and their features) are shared
+    fakes = [FakeSpotify(n_tracks=200, n_plays=150, recent_window=150, features_missing=0.4,
+                         user_id=user_id, seed=seed) for seed, user_id in enumerate(("alice", "bob"))]
+    for sp in fakes:
+        etl.refresh_all(sp, user_id=sp.user_id)
+    return fakes
+
+
+def test_inserts_match_rebuild(tmp_db, listeners):
+    assert_matches_rebuild(tmp_db)
+
+
+def test_more_plays_and_new_top_tracks_match_rebuild(tmp_db, listeners):
+    for sp in listeners:
+        sp.listen(40)
+        sp.seed += 10  # Different top tracks, so every snapshot is replaced
+        etl.refresh_all(sp, user_id=sp.user_id)
+
+    assert_matches_rebuild(tmp_db)
+
+
+def test_deletes_match_rebuild(tmp_db, listeners):
+    with tmp_db.get_conn() as conn:
+        conn.execute("DELETE FROM play_events WHERE played_at_ms % 3 = 0")
+        conn.execute("DELETE FROM top_tracks WHERE rank > 30")
+
+    assert_matches_rebuild(tmp_db)
+
+
+def test_late_and_changed_audio_features_match_rebuild(tmp_db, listeners):
+    with tmp_db.get_read_conn() as conn:
+        missing = [row[0] for row in conn.execute("SELECT track_id FROM audio_features_misses")]
+        stored = [row[0] for row in conn.execute("SELECT track_id FROM audio_features LIMIT 20")]
+    assert missing
+
+    # Features Spotify had no answer for arrive later (insert trigger) ...
+    late = etl.fetch_audio_features(FakeSpotify(n_tracks=200), missing)
+    # ... and stored ones are revised (update trigger)
+    revised = [(row[0], 0.5, 0.25, *row[3:10], 0.75, row[11])
+               for row in etl.fetch_audio_features(FakeSpotify(n_tracks=200, seed=7), stored)]
+    with tmp_db.get_conn() as conn:
+        cursor = conn.cursor()
+        etl._upsert_audio_features(cursor, late)
+        etl._upsert_audio_features(cursor, revised)
+
+    assert_matches_rebuild(tmp_db)
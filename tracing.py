@@ -0,0 +1,305 @@
+"""Lightweight tracing for the ETL and dashboard hot paths.
+
+Records three kinds of measurements in process memory:
+
+- spans: named, nested wall-time sections (``span()`` / ``@traced``),
+- HTTP calls per Spotify endpoint, with bytes and whether the response cache
+  served them (recorded by ``http_cache.CachingAdapter``),
+- SQL statements on ``db`` connections, with ``EXPLAIN QUERY PLAN`` kept for
+  statements slower than ``SLOW_SQL_MS``.
+
+Tracing is off unless ``SPOTIFY_INSIGHTS_TRACE`` is set or ``enable()`` is
+called. When off, ``span()`` returns a shared no-op context manager and the
+SQL and HTTP hooks are a single flag check.
+
+Collected metrics are available as ``snapshot()`` (a JSON-ready dict),
+``export_json(path)`` and, for log shippers, ``log_metrics()``.
+"""
+import functools
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+
+SLOW_SQL_MS = 50.0  # Statements slower than this get their query plan recorded
+MAX_EVENTS = 2_000  # Most recent spans kept individually, besides the aggregates
+MAX_STATEMENTS = 500  # Distinct SQL statements tracked
+
+logger = logging.getLogger("spotify_insights.trace")
+
+# Set by the operator; the dashboard only offers its Diagnostics panel when this is on
+ENABLED_BY_ENV = os.getenv("SPOTIFY_INSIGHTS_TRACE", "").lower() in ("1", "true", "yes", "on")
+_enabled = ENABLED_BY_ENV
+_lock = threading.Lock()
+_local = threading.local()
+
+_ID_SEGMENT = re.compile(r"/[0-9A-Za-z]{22}(?=/|$)")
+
+
+def is_enabled():
+    return _enabled
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+class _Metrics:
+    def __init__(self):
+        self.started_at = time.time()
+        self.events = deque(maxlen=MAX_EVENTS)  # Individual spans, newest last
+        self.spans = {}  # name -> {"count", "total_ms", "max_ms", "errors"}
+        self.http = {}  # "GET /v1/..." -> {"count", "bytes", "total_ms", "cached", "status": {}}
+        self.sql = {}  # statement -> {"count", "total_ms", "max_ms", "plan"}
+
+
+_metrics = _Metrics()
+
+
+def reset():
+    """Drop everything recorded so far."""
+    global _metrics
+    with _lock:
+        _metrics = _Metrics()
+
+
+# ---------- Spans ----------
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("name", "attrs", "start", "parent")
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        """Attach attributes (row counts, retries...) to the span."""
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            stack = _local.stack = []
+        self.parent = stack[-1].name if stack else None
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed_ms = (time.perf_counter() - self.start) * 1000
+        _local.stack.pop()
+        with _lock:
+            agg = _metrics.spans.setdefault(self.name, {"count": 0, "total_ms": 0.0, "max_ms": 0.0, "errors": 0})
+            agg["count"] += 1
+            agg["total_ms"] += elapsed_ms
+            agg["max_ms"] = max(agg["max_ms"], elapsed_ms)
+            if exc_type is not None:
+                agg["errors"] += 1
+            _metrics.events.append({
+                "name": self.name,
+                "parent": self.parent,
+                "start": time.time() - elapsed_ms / 1000,
+                "ms": round(elapsed_ms, 3),
+                "error": exc_type.__name__ if exc_type else None,
+                **self.attrs,
+            })
+        return False
+
+
+def span(name, **attrs):
+    """Context manager timing a named section; a no-op while tracing is off.
+
+    Example:
+        with span("etl.write_batch", plays=len(plays)) as s:
+            ...
+            s.set(inserted=n)
+    """
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name, attrs)
+
+
+def traced(name=None):
+    """Decorator form of ``span``; the span name defaults to ``module.function``."""
+    def decorator(fn):
+        span_name = name or f"{fn.__module__}.{fn.__qualname__}"
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            with _Span(span_name, {}):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+# ---------- HTTP ----------
+
+def endpoint_name(method, url):
+    """``GET /v1/artists/{id}`` style key: no host, query string or Spotify IDs."""
+    path = url.split("://", 1)[-1]
+    path = path[path.find("/"):] if "/" in path else "/"
+    path = path.split("?", 1)[0]
+    return f"{method} {_ID_SEGMENT.sub('/{id}', path)}"
+
+
+def record_http(method, url, status, nbytes, elapsed_ms, source):
+    """Count one HTTP exchange. ``source`` is "network", "cache" or "revalidated"."""
+    key = endpoint_name(method, url)
+    with _lock:
+        agg = _metrics.http.setdefault(
+            key, {"count": 0, "bytes": 0, "total_ms": 0.0, "cached": 0, "status": {}}
+        )
+        agg["count"] += 1
+        agg["bytes"] += nbytes
+        agg["total_ms"] += elapsed_ms
+        if source != "network":
+            agg["cached"] += 1
+        agg["status"][str(status)] = agg["status"].get(str(status), 0) + 1
+
+
+# ---------- SQL ----------
+
+def _statement_key(sql):
+    return " ".join(sql.split())
+
+
+def _record_sql(conn, sql, params, elapsed_ms, many=False):
+    key = _statement_key(sql)
+    with _lock:
+        agg = _metrics.sql.get(key)
+        if agg is None:
+            if len(_metrics.sql) >= MAX_STATEMENTS:
+                return
+            agg = _metrics.sql[key] = {"count": 0, "total_ms": 0.0, "max_ms": 0.0, "plan": None}
+        agg["count"] += 1
+        agg["total_ms"] += elapsed_ms
+        agg["max_ms"] = max(agg["max_ms"], elapsed_ms)
+        need_plan = elapsed_ms >= SLOW_SQL_MS and agg["plan"] is None and not many
+    if need_plan and key.split(" ", 1)[0].upper() in ("SELECT", "WITH"):
+        try:
+            rows = sqlite3.Connection.execute(conn, "EXPLAIN QUERY PLAN " + sql, params).fetchall()
+        except sqlite3.Error:
+            return
+        with _lock:
+            agg["plan"] = [row[-1] for row in rows]
+
+
+class TracingCursor(sqlite3.Cursor):
+    """Cursor that times its statements, including the rows fetched afterwards."""
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._trace_sql = sql
+            _record_sql(self.connection, sql, parameters, (time.perf_counter() - start) * 1000)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _record_sql(self.connection, sql, (), (time.perf_counter() - start) * 1000, many=True)
+
+    def fetchall(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            self._record_fetch(start)
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        try:
+            return super().fetchmany(self.arraysize if size is None else size)
+        finally:
+            self._record_fetch(start)
+
+    def _record_fetch(self, start):
+        sql = getattr(self, "_trace_sql", None)
+        if sql is not None:
+            with _lock:
+                agg = _metrics.sql.get(_statement_key(sql))
+                if agg is not None:
+                    agg["total_ms"] += (time.perf_counter() - start) * 1000
+
+
+class TracingConnection(sqlite3.Connection):
+    """``sqlite3.connect`` factory that routes statements through ``TracingCursor`` when tracing is on."""
+
+    def cursor(self, factory=sqlite3.Cursor):
+        if _enabled and factory is sqlite3.Cursor:
+            factory = TracingCursor
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        if not _enabled:
+            return super().execute(sql, parameters)
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        if not _enabled:
+            return super().executemany(sql, seq_of_parameters)
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+# ---------- Export ----------
+
+def snapshot():
+    """Everything recorded so far as a JSON-serialisable dict."""
+    with _lock:
+        return {
+            "enabled": _enabled,
+            "started_at": _metrics.started_at,
+            "spans": {name: dict(agg) for name, agg in _metrics.spans.items()},
+            "http": {key: {**agg, "status": dict(agg["status"])} for key, agg in _metrics.http.items()},
+            "sql": {sql: dict(agg) for sql, agg in _metrics.sql.items()},
+            "slow_sql": [
+                {"sql": sql, **agg} for sql, agg in _metrics.sql.items() if agg["max_ms"] >= SLOW_SQL_MS
+            ],
+            "events": list(_metrics.events),
+        }
+
+
+def export_json(path):
+    """Write ``snapshot()`` to ``path`` as JSON."""
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(snapshot(), f, indent=2, default=str)
+
+
+def log_metrics(level=logging.INFO):
+    """Emit the aggregates (without individual events) as one structured log line."""
+    data = snapshot()
+    data.pop("events")
+    logger.log(level, json.dumps(data, default=str))